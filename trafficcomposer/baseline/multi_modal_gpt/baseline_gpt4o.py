@@ -5,6 +5,7 @@ from openai import OpenAI
 
 import datetime
 import json
+import argparse
 from tqdm import tqdm
 
 import time
@@ -34,9 +35,16 @@ from trafficcomposer.baseline.multi_modal_gpt.config_baseline_gpt4o import (
     BASELINE_GPT4O_SAVE_PATH,
 )
 
-from trafficcomposer.gen_visual_ir.utils import is_image_file
+from trafficcomposer.gen_visual_ir.utils import SceneIndex
 from trafficcomposer.gen_textual_ir.gpt_text_parser import OpenAIClientRunner
 from trafficcomposer.gen_textual_ir.gen_textual_ir import post_process
+from trafficcomposer.ir_io import ir_file_name, IR_FORMATS
+from trafficcomposer.ir_store import (
+    open_ir_writer,
+    next_shard_name,
+    IRShardReader,
+    IR_LAYOUTS,
+)
 from multi_modal_gen_prompt import gen_multi_modal_prompt
 
 
@@ -47,7 +55,14 @@ def main(
     resume=False,
     gpt_model="gpt-4o",
     debug=False,
+    ir_format="yaml",
+    ir_layout="files",
 ):
+    """
+    ir_format: str, the format of the saved baseline IRs, one of `ir_io.IR_FORMATS`.
+    ir_layout: str, "files" saves one IR file per scene; "shard" appends a new shard to save_dir, see `ir_store`.
+    resume: bool, skip the scenes whose IR already exists in save_dir, in either layout.
+    """
 
     # ## Build save directory
     if os.path.exists(save_dir):
@@ -70,81 +85,107 @@ def main(
         print(f"Creating directory: {save_dir}")
         os.makedirs(save_dir)
 
-    # ## Generate the source image name list
-    ls_source_img_names = os.listdir(source_image_dir)
-    ls_source_img_names = [x for x in ls_source_img_names if is_image_file(x)]
-    ls_source_img_names.sort()
-
-    # ## load the description file name list
-    ls_description_files = os.listdir(description_dir)
-    ls_description_files = [x for x in ls_description_files if x.endswith(".txt")]
-    ls_description_files.sort()
+    # ## pair the image and the description file by scene id
+    scene_index = SceneIndex(
+        {
+            "image": (source_image_dir, None),
+            "description": (description_dir, ".txt"),
+        }
+    )
+    scene_index.report_incomplete()
 
     gpt_runner = OpenAIClientRunner(model=gpt_model)
 
-    for idx, source_img_name in enumerate(tqdm(ls_source_img_names)):
-        source_img_name_no_ext = ".".join(source_img_name.split(".")[:-1])
-        source_img_path = os.path.join(source_image_dir, source_img_name)
-        assert os.path.exists(source_img_path), f"{source_img_path} does not exist"
-
-        # ## locate the traffic description file
-        description_file_name = ls_description_files[idx]
-        assert description_file_name.startswith(
-            f"{source_img_name_no_ext}."
-        ), f"{description_file_name} does not match {source_img_name}"
-
-        desc_file_path = os.path.join(description_dir, description_file_name)
-        assert os.path.join(description_dir, desc_file_path), f"{desc_file_path} does not exist"
-        with open(desc_file_path, "r") as scenario_file:
-            traffic_scenario_description = scenario_file.readlines()
-        traffic_scenario_description = "".join(traffic_scenario_description)
-
-        if traffic_scenario_description == "":
-            print(f"file {desc_file_path} is empty")
-            continue
-
-        save_file_name = os.path.basename(desc_file_path)
-        if save_file_name.endswith(".txt"):
-            save_file_name = save_file_name[:-4] + ".yaml"
-        save_path = os.path.join(save_dir, save_file_name)
-        if resume and os.path.exists(save_path):
-            print(f"Skipping {source_img_name} as {save_path} already exists.")
-            continue
-
-        if debug:
-            print(f"========== Input ==========")
-            print(f"source_img_path: {source_img_path}")
-            print(f"desc_file_path: {desc_file_path}")
-            print(traffic_scenario_description)
+    # ## In the shard layout, the IRs of the previous runs are kept in the existing shards
+    if resume and ir_layout == "shard":
+        existing_shard_reader = IRShardReader(save_dir)
+
+    with open_ir_writer(
+        save_dir,
+        fmt=ir_format,
+        layout=ir_layout,
+        shard_name=next_shard_name(save_dir),
+    ) as writer:
+        for scene_id, source_img_path, desc_file_path in tqdm(
+            scene_index, total=len(scene_index)
+        ):
+            with open(desc_file_path, "r") as scenario_file:
+                traffic_scenario_description = scenario_file.readlines()
+            traffic_scenario_description = "".join(traffic_scenario_description)
+
+            if traffic_scenario_description == "":
+                print(f"file {desc_file_path} is empty")
+                continue
+
+            if resume:
+                if ir_layout == "shard":
+                    is_existing = scene_id in existing_shard_reader
+                else:
+                    is_existing = os.path.exists(
+                        os.path.join(save_dir, ir_file_name(scene_id, ir_format))
+                    )
+                if is_existing:
+                    print(f"Skipping {scene_id} as its IR already exists in {save_dir}.")
+                    continue
+
+            if debug:
+                print(f"========== Input ==========")
+                print(f"source_img_path: {source_img_path}")
+                print(f"desc_file_path: {desc_file_path}")
+                print(traffic_scenario_description)
+                print()
+
+            prompt = gen_multi_modal_prompt(
+                traffic_description=traffic_scenario_description,
+                image_path=source_img_path,
+            )
+            baseline_ir = gpt_runner(prompt)
+
+            baseline_ir = post_process(baseline_ir)
+            if baseline_ir is None:
+                print(f"WARNING: Cannot extract the IR for {scene_id}! Skipping...")
+                continue
+
+            print(f"========== Output ==========")
+            print(baseline_ir)
             print()
 
-        prompt = gen_multi_modal_prompt(
-            traffic_description=traffic_scenario_description,
-            image_path=source_img_path,
-        )
-        baseline_ir = gpt_runner(prompt)
-        time.sleep(1)
+            writer.write(scene_id, baseline_ir)
 
-        baseline_ir = post_process(baseline_ir)
+            # # ## Save results to YAML files
+            # with open(os.path.join(save_dir, f"{source_img_name}.yaml"), "w") as f:
+            #     yaml.dump(baseline_ir, f)
 
-        print(f"========== Output ==========")
-        print(baseline_ir)
-        print()
+            # # ## Save results to JSON files
+            # with open(os.path.join(self.save_dir, f"{source_img_name}.json"), "w") as f:
+            #     json.dump(merged_ir, f)
 
-        with open(save_path, "w") as fp:
-            # json.dump(scenario_info, fp)
-            fp.write(baseline_ir)
 
-        # # ## Save results to YAML files
-        # with open(os.path.join(save_dir, f"{source_img_name}.yaml"), "w") as f:
-        #     yaml.dump(baseline_ir, f)
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate the IRs of the GPT-4o baseline from the images and the descriptions"
+    )
+    parser.add_argument(
+        "--ir_format",
+        type=str,
+        default="yaml",
+        choices=IR_FORMATS,
+        help="the format of the saved baseline IRs",
+    )
+    parser.add_argument(
+        "--ir_layout",
+        type=str,
+        default="files",
+        choices=IR_LAYOUTS,
+        help="save one baseline IR file per scene, or pack them into shards",
+    )
+    args = parser.parse_args()
 
-        # # ## Save results to JSON files
-        # with open(os.path.join(self.save_dir, f"{source_img_name}.json"), "w") as f:
-        #     json.dump(merged_ir, f)
+    return args
 
 
 if __name__ == "__main__":
+    args = parse_args()
     # gpt_model = "gpt-4o-mini"
     gpt_model = "gpt-4o"
     main(
@@ -154,4 +195,6 @@ if __name__ == "__main__":
         gpt_model=gpt_model,
         resume=True,    # Set to True to ignore existing files in the save directory.
         debug=True,
+        ir_format=args.ir_format,
+        ir_layout=args.ir_layout,
     )
@@ -3,9 +3,12 @@ from tqdm import tqdm
 import time
 import re
 import yaml
+import asyncio
 
 
 from trafficcomposer.gen_textual_ir.text_parser_gen_prompt import gen_prompt
+from trafficcomposer.ir_io import ir_file_name
+from trafficcomposer.ir_store import open_ir_writer, next_shard_name, IRShardReader
 
 
 def post_process(content, start_keyword="<YAML>", end_keyword="</YAML>"):
@@ -15,6 +18,8 @@ def post_process(content, start_keyword="<YAML>", end_keyword="</YAML>"):
         content (str): The string to extract content from.
         start_keyword (str): The keyword that marks the beginning of the content.
         end_keyword (str): The keyword that marks the end of the content.
+    Returns:
+        dict: The parsed IR, or None if the content cannot be extracted or parsed.
     """
     pattern = f"{start_keyword}(.*?){end_keyword}"
 
@@ -59,23 +64,58 @@ def post_process(content, start_keyword="<YAML>", end_keyword="</YAML>"):
             else:
                 entry['position_relation'] = "None"
 
-        ans = yaml.dump(yaml_data, default_flow_style=False)
-
-        return ans
+        return yaml_data
     else:
         return None
 
 
-def gen_textual_ir(
-    dir_description, save_dir, llm_runner, is_continue=False, debug=False
+def gen_single_textual_ir(traffic_scenario_description, llm_runner, debug=False):
+    """
+    Generate the textual IR of one scenario description.
+    Args:
+        traffic_scenario_description (str): The content of the scenario description file.
+        llm_runner (callable): Maps the prompt to the raw output of the LLM, or None if the call failed.
+    Returns:
+        dict: The textual IR, or None if the LLM call failed or the IR cannot be extracted.
+    """
+    prompt = gen_prompt(traffic_scenario_description)
+    textual_ir = llm_runner(prompt)
+    if debug:
+        print(f"===== Raw Output of GPT: =====")
+        print(textual_ir)
+        print(f"-- End of Raw Output of GPT --")
+    if textual_ir is None:
+        return None
+
+    return post_process(textual_ir)
+
+
+async def gen_single_textual_ir_async(
+    traffic_scenario_description, llm_runner, debug=False
 ):
     """
-    The main function to generate Te
+    The same as `gen_single_textual_ir`, with an async LLM runner.
     Args:
-        dir_description (str): The path of the folder containing the scenario description files (.txt).
+        llm_runner (async callable): Maps the prompt to the raw output of the LLM, or None if the call failed, see `gpt_text_parser.AsyncOpenAIClientRunner`.
     """
+    prompt = gen_prompt(traffic_scenario_description)
+    textual_ir = await llm_runner(prompt)
+    if debug:
+        print(f"===== Raw Output of GPT: =====")
+        print(textual_ir)
+        print(f"-- End of Raw Output of GPT --")
+    if textual_ir is None:
+        return None
+
+    return post_process(textual_ir)
 
-    # ## Build save directory
+
+def build_save_dir(save_dir, is_continue=False):
+    """
+    Create save_dir, or ask the user what to do with the existing one.
+    Returns:
+        bool: False if the user chooses to exit.
+    """
     if os.path.exists(save_dir):
         while True:
             dir_operation = input(
@@ -88,7 +128,7 @@ def gen_textual_ir(
                 break
             elif dir_operation.lower() == "exit":
                 print("Exiting...")
-                return
+                return False
             elif dir_operation.lower() in ("continue", ""):
                 print("Continuing without modifying the original directory...")
                 break
@@ -101,21 +141,40 @@ def gen_textual_ir(
         input(
             "WARNING: Running in continue mode! This will NOT update the existing files in the save directory! Press ENTER to continue; Press Ctrl-c to exit."
         )
+    return True
+
 
+def load_descriptions(
+    dir_description, save_dir, is_continue=False, ir_format="yaml", ir_layout="files"
+):
+    """
+    The scenario descriptions to generate the textual IRs of, sorted by file name.
+    In the continue mode, the descriptions whose IR already exists in save_dir are skipped, and so are the empty files.
+    Returns:
+        list: (scene_id, desc_file_path, traffic_scenario_description) of each description.
+    """
     ls_description_txt = os.listdir(dir_description)
     ls_description_txt = [i for i in ls_description_txt if i.endswith(".txt")]
     ls_description_txt.sort()
 
-    for desc_file_name in tqdm(ls_description_txt):
+    # ## In the shard layout, the IRs of the previous runs are kept in the existing shards
+    if is_continue and ir_layout == "shard":
+        existing_shard_reader = IRShardReader(save_dir)
+
+    ls_description = []
+    for desc_file_name in ls_description_txt:
         desc_file_path = os.path.join(dir_description, desc_file_name)
 
-        save_file_name = os.path.basename(desc_file_path)
-        if save_file_name.endswith(".txt"):
-            save_file_name = save_file_name[:-4] + ".yaml"
-        save_path = os.path.join(save_dir, save_file_name)
-        if is_continue and os.path.exists(save_path):
-            print(f"WARNING: File {save_path} already exists! Skipping...")
-            continue
+        scene_id = desc_file_name[:-4]
+        save_path = os.path.join(save_dir, ir_file_name(scene_id, ir_format))
+        if is_continue:
+            if ir_layout == "shard":
+                is_existing = scene_id in existing_shard_reader
+            else:
+                is_existing = os.path.exists(save_path)
+            if is_existing:
+                print(f"WARNING: IR of {scene_id} already exists! Skipping...")
+                continue
 
         with open(desc_file_path, "r") as scenario_file:
             traffic_scenario_description = scenario_file.readlines()
@@ -124,29 +183,165 @@ def gen_textual_ir(
             print(f"WARNING: file {desc_file_path} is empty! Skipping...")
             continue
 
-        if debug:
-            print(f"===== File: {desc_file_path} =====")
-            print(f"===== Input: =====")
-            print(traffic_scenario_description)
-            print(f"-- End of Input --")
+        ls_description.append(
+            (scene_id, desc_file_path, traffic_scenario_description)
+        )
+    return ls_description
 
-        prompt = gen_prompt(traffic_scenario_description)
-        textual_ir = llm_runner(prompt)
-        if debug:
-            print(f"===== Raw Output of GPT: =====")
-            print(textual_ir)
-            print(f"-- End of Raw Output of GPT --")
-        time.sleep(1)
 
-        textual_ir = post_process(textual_ir)
+def print_description(desc_file_path, traffic_scenario_description):
+    print(f"===== File: {desc_file_path} =====")
+    print(f"===== Input: =====")
+    print(traffic_scenario_description)
+    print(f"-- End of Input --")
 
-        print(f"Output:")
-        print(textual_ir)
-        print()
 
-        with open(save_path, "w") as fp:
-            # json.dump(scenario_info, fp)
-            fp.write(textual_ir)
+def save_textual_ir(
+    writer, save_dir, scene_id, desc_file_path, textual_ir, debug=False
+):
+    """
+    Returns:
+        bool: Whether the textual IR is saved, i.e., it was extracted from the output of the LLM.
+    """
+    if textual_ir is None:
+        print(f"WARNING: Cannot extract the IR for {desc_file_path}! Skipping...")
+        return False
+
+    print(f"Output:")
+    print(textual_ir)
+    print()
+
+    writer.write(scene_id, textual_ir)
 
-        if debug:
-            print(f"Saved to {save_path}")
+    if debug:
+        print(f"Saved {scene_id} to {save_dir}")
+    return True
+
+
+def gen_textual_ir(
+    dir_description,
+    save_dir,
+    llm_runner,
+    is_continue=False,
+    debug=False,
+    ir_format="yaml",
+    ir_layout="files",
+):
+    """
+    The main function to generate the textual IRs, one LLM call at a time; see `gen_textual_ir_async` for concurrent calls.
+    Args:
+        dir_description (str): The path of the folder containing the scenario description files (.txt).
+        ir_format (str): The format of the saved textual IRs, one of `ir_io.IR_FORMATS`.
+        ir_layout (str): "files" saves one textual IR file per description; "shard" appends a new shard to save_dir, see `ir_store`.
+    """
+    if not build_save_dir(save_dir, is_continue):
+        return
+    ls_description = load_descriptions(
+        dir_description,
+        save_dir,
+        is_continue=is_continue,
+        ir_format=ir_format,
+        ir_layout=ir_layout,
+    )
+
+    num_saved = 0
+    t_start = time.time()
+    with open_ir_writer(
+        save_dir,
+        fmt=ir_format,
+        layout=ir_layout,
+        shard_name=next_shard_name(save_dir),
+    ) as writer:
+        for scene_id, desc_file_path, traffic_scenario_description in tqdm(
+            ls_description
+        ):
+            if debug:
+                print_description(desc_file_path, traffic_scenario_description)
+
+            textual_ir = gen_single_textual_ir(
+                traffic_scenario_description, llm_runner, debug=debug
+            )
+            num_saved += save_textual_ir(
+                writer, save_dir, scene_id, desc_file_path, textual_ir, debug=debug
+            )
+    wall_time = time.time() - t_start
+    print(
+        f"Generated {num_saved} of {len(ls_description)} textual IRs in {wall_time:.2f}s "
+        f"({len(ls_description) / max(wall_time, 1e-9):.2f} descriptions/s)"
+    )
+
+
+async def _gen_textual_irs_concurrently(
+    ls_description, writer, save_dir, llm_runner, concurrency, debug=False
+):
+    """
+    Returns:
+        int: The number of saved textual IRs.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def gen_one(scene_id, desc_file_path, traffic_scenario_description):
+        async with semaphore:
+            if debug:
+                print_description(desc_file_path, traffic_scenario_description)
+            textual_ir = await gen_single_textual_ir_async(
+                traffic_scenario_description, llm_runner, debug=debug
+            )
+        return scene_id, desc_file_path, textual_ir
+
+    ls_task = [asyncio.ensure_future(gen_one(*item)) for item in ls_description]
+    num_saved = 0
+    # ## Each IR is written as soon as its call completes, in the event loop thread, so the writer needs no lock
+    for future in tqdm(asyncio.as_completed(ls_task), total=len(ls_task)):
+        scene_id, desc_file_path, textual_ir = await future
+        num_saved += save_textual_ir(
+            writer, save_dir, scene_id, desc_file_path, textual_ir, debug=debug
+        )
+    return num_saved
+
+
+def gen_textual_ir_async(
+    dir_description,
+    save_dir,
+    llm_runner,
+    concurrency=8,
+    is_continue=False,
+    debug=False,
+    ir_format="yaml",
+    ir_layout="files",
+):
+    """
+    The same as `gen_textual_ir`, with up to `concurrency` LLM calls in flight at a time.
+    The textual IRs are written in the order their calls complete, with the same file names, or to the same new shard.
+    Args:
+        llm_runner (async callable): Maps the prompt to the raw output of the LLM, or None if the call failed, see `gpt_text_parser.AsyncOpenAIClientRunner`.
+        concurrency (int): The maximum number of concurrent LLM calls, bounded in practice by the rate limits of the provider.
+    """
+    assert concurrency >= 1, f"The concurrency should be at least 1, got {concurrency}"
+    if not build_save_dir(save_dir, is_continue):
+        return
+    ls_description = load_descriptions(
+        dir_description,
+        save_dir,
+        is_continue=is_continue,
+        ir_format=ir_format,
+        ir_layout=ir_layout,
+    )
+
+    t_start = time.time()
+    with open_ir_writer(
+        save_dir,
+        fmt=ir_format,
+        layout=ir_layout,
+        shard_name=next_shard_name(save_dir),
+    ) as writer:
+        num_saved = asyncio.run(
+            _gen_textual_irs_concurrently(
+                ls_description, writer, save_dir, llm_runner, concurrency, debug=debug
+            )
+        )
+    wall_time = time.time() - t_start
+    print(
+        f"Generated {num_saved} of {len(ls_description)} textual IRs with {concurrency} concurrent calls in {wall_time:.2f}s "
+        f"({len(ls_description) / max(wall_time, 1e-9):.2f} descriptions/s)"
+    )
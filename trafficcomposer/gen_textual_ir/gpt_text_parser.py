@@ -1,7 +1,9 @@
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import time
 import os
+import asyncio
+import argparse
 from tqdm import tqdm
 import sys
 from dotenv import load_dotenv
@@ -11,7 +13,10 @@ print(
     f"Added Project Root to sys.path: {os.path.join(os.path.dirname(__file__), '../..')}"
 )
 
-from trafficcomposer.gen_textual_ir.gen_textual_ir import gen_textual_ir
+from trafficcomposer.gen_textual_ir.gen_textual_ir import (
+    gen_textual_ir,
+    gen_textual_ir_async,
+)
 from trafficcomposer.gen_textual_ir.config_textual import (
     DESCRIPTION_DIR,
     TEXTUAL_IR_SAVE_DIR,
@@ -49,13 +54,71 @@ class OpenAIClientRunner:
         return self.try_call_gpt(prompt, max_tries=3)
 
 
+class AsyncOpenAIClientRunner:
+    """
+    The same as `OpenAIClientRunner` with the async client, so that many calls can wait on the API at the same time
+    """
+
+    def __init__(self, model="gpt-4o"):
+        self.model = model
+        self.client = AsyncOpenAI()
+
+    async def call_gpt(self, prompt):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=prompt,
+        )
+        return response.choices[0].message.content
+
+    async def try_call_gpt(self, prompt, max_tries=3):
+        for _ in range(max_tries):
+            try:
+                return await self.call_gpt(prompt)
+            except Exception as e:
+                print(e)
+                # ## only this call waits, the other calls go on
+                await asyncio.sleep(5)
+        return None
+
+    async def __call__(self, prompt):
+        return await self.try_call_gpt(prompt, max_tries=3)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate the textual IRs of the scenario descriptions with GPT"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="the maximum number of concurrent LLM calls; 0 to call the LLM one at a time with the sync client",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
 if __name__ == "__main__":
+    args = parse_args()
+
     model = "gpt-4o"
     save_dir = TEXTUAL_IR_SAVE_DIR
 
     # model = "gpt-4o-mini"
     # save_dir = GPT4O_MINI_TEXTUAL_IR_SAVE_DIR
 
+    if args.concurrency > 0:
+        gen_textual_ir_async(
+            dir_description=DESCRIPTION_DIR,
+            save_dir=save_dir,
+            llm_runner=AsyncOpenAIClientRunner(model=model),
+            concurrency=args.concurrency,
+            is_continue=False,  # Set to True to ignore existing files in the save directory.
+            debug=True,
+        )
+        sys.exit(0)
+
     llm_runner = OpenAIClientRunner(model=model)
     gen_textual_ir(
         dir_description=DESCRIPTION_DIR,
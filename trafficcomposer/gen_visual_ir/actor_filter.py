@@ -0,0 +1,138 @@
+"""
+Road-relevant actors of the actor detection.
+
+YOLOv10 detects the 80 COCO classes, most of which are never actors of a traffic scenario (benches,
+kites, ...), but every detected box is still assigned to a lane by `VisualIRGenerator.gen_visual_ir`
+and ends up as an actor of the merged IR. Two filters keep the detection on the road:
+    - the class allow-list: the actor types of the scenario IR (see `DCT_ACTOR_TYPE2COCO`), mapped to
+      the COCO class ids passed to YOLO as `classes`, so the other classes are dropped at detection time
+    - the road region of interest: the image rows from the top of the road down to the bottom, from
+      the highest point of the detected lanes (`roi="lanes"`) or a fixed horizon row (`roi="horizon"`);
+      only this part of the image is passed to YOLO, and the boxes are shifted back to the full image
+
+Run `python actor_filter.py [label dir]` to count the boxes kept by the class allow-list on label files.
+"""
+
+import os
+
+import yaml
+import numpy as np
+
+COCO_YAML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "coco.yaml")
+# ## {actor type of the scenario IR: COCO class names}, the types of the textual IR, see `text_parser_gen_prompt.py`
+DCT_ACTOR_TYPE2COCO = {
+    "car": ["car"],
+    "truck": ["truck"],
+    "bus": ["bus"],
+    "pedestrian": ["person"],
+    "cyclist": ["bicycle", "motorcycle"],
+}
+ACTOR_TYPES = tuple(DCT_ACTOR_TYPE2COCO.keys())
+ROI_MODES = ("lanes", "horizon")
+
+
+def load_coco_names():
+    """
+    return: {class_id: class_name} of the COCO classes detected by YOLOv10
+    """
+    with open(COCO_YAML_PATH, "r") as f:
+        return yaml.load(f, Loader=yaml.FullLoader)["names"]
+
+
+def allowed_class_ids(dct_names, actor_types=ACTOR_TYPES):
+    """
+    dct_names: {class_id: class_name}, e.g., the `names` of coco.yaml or of the YOLO model
+    return: sorted list of int, the class ids of the actor types
+    """
+    for actor_type in actor_types:
+        assert (
+            actor_type in DCT_ACTOR_TYPE2COCO
+        ), f"Unknown actor type {actor_type}, should be one of {ACTOR_TYPES}"
+    set_names = {
+        name for actor_type in actor_types for name in DCT_ACTOR_TYPE2COCO[actor_type]
+    }
+    return sorted(class_id for class_id, name in dct_names.items() if name in set_names)
+
+
+def filter_labels(arr_labels, class_ids):
+    """
+    Keep the actors of the allowed classes
+    arr_labels: np.ndarray of shape (num_actors, 5), see `yolo_label.load_yolo_labels`
+    """
+    return arr_labels[np.isin(arr_labels[:, 0], class_ids)]
+
+
+def road_roi_top(img_h, roi, lanes=None, horizon=0.4, margin=0.05):
+    """
+    The top row of the road region of an image, 0 for the full image
+    roi: "lanes" for the highest point of the lanes raised by margin * img_h, so the actors at the far end
+        of the lanes are kept, or the full image if there is no lane; "horizon" for the row horizon * img_h
+    lanes: list of np.ndarray of shape (num_points, 2), the lanes in the pixels of the image
+    """
+    assert roi in ROI_MODES, f"Unknown ROI {roi}, should be one of {ROI_MODES}"
+    if roi == "horizon":
+        return int(horizon * img_h)
+    ls_y = [np.min(lane[:, 1]) for lane in lanes or [] if len(lane) > 0]
+    if len(ls_y) == 0:
+        return 0
+    return min(max(int(min(ls_y) - margin * img_h), 0), img_h - 1)
+
+
+def shift_labels(arr_xyxy_roi, arr_cls, roi_top, img_h, img_w):
+    """
+    The labels in the full image of the boxes detected in the road region
+    arr_xyxy_roi: np.ndarray of shape (num_actors, 4), the boxes in the pixels of the road region
+    return: np.ndarray of shape (num_actors, 5), normalized to the full image, see `yolo_label`
+    """
+    arr_xyxy = np.asarray(arr_xyxy_roi, dtype=np.float64).reshape(-1, 4).copy()
+    arr_xyxy[:, [1, 3]] += roi_top
+    x1, y1, x2, y2 = arr_xyxy.T
+    return np.column_stack(
+        [
+            np.asarray(arr_cls, dtype=np.float64),
+            (x1 + x2) / 2 / img_w,
+            (y1 + y2) / 2 / img_h,
+            (x2 - x1) / img_w,
+            (y2 - y1) / img_h,
+        ]
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    from yolo_label import load_yolo_labels
+
+    dct_coco = load_coco_names()
+    class_ids = allowed_class_ids(dct_coco)
+    print(f"Allowed COCO classes: {[dct_coco[class_id] for class_id in class_ids]}")
+
+    # ## shifting the boxes of the road region back matches the boxes of the full image
+    rng = np.random.default_rng(0)
+    arr_top_left = rng.uniform([0, 300], [1000, 600], size=(50, 2))
+    arr_xyxy = np.hstack([arr_top_left, arr_top_left + rng.uniform(10, 120, (50, 2))])
+    arr_labels = shift_labels(arr_xyxy - [0, 288, 0, 288], np.zeros(50), 288, 720, 1280)
+    x_center, y_center, width, height = arr_labels[:, 1:].T
+    assert np.allclose(
+        np.column_stack(
+            [
+                (x_center - width / 2) * 1280,
+                (y_center - height / 2) * 720,
+                (x_center + width / 2) * 1280,
+                (y_center + height / 2) * 720,
+            ]
+        ),
+        arr_xyxy,
+    )
+    print("The boxes of the road region are shifted back to the full image.")
+
+    if len(sys.argv) > 1:
+        num_total, num_kept = 0, 0
+        for fn in sorted(os.listdir(sys.argv[1])):
+            if fn.endswith(".txt"):
+                arr_labels = load_yolo_labels(os.path.join(sys.argv[1], fn))
+                num_total += len(arr_labels)
+                num_kept += len(filter_labels(arr_labels, class_ids))
+        print(
+            f"{num_kept} of {num_total} boxes are of the actor types {list(ACTOR_TYPES)}"
+        )
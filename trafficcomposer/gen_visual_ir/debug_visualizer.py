@@ -0,0 +1,160 @@
+"""
+Debug visualization of the visual IR, off the hot path of `VisualIRGenerator.gen_visual_ir`.
+
+`DebugVisualizer.submit` only puts the lane lines, the actor boxes and the assigned lanes of a
+scene to a bounded queue; background threads decode the image once and render one composite
+image per scene to `save_dir/<scene id>.jpg`:
+    - the lane dividing lines, numbered from left to right
+    - the box of each actor, colored by its lane index, with the index on top
+    - the actors without a lane in red, with their bottom corners marked
+    - the ego vehicle at the bottom of the image
+Only a sample of the scenes is rendered if sample_rate < 1. The sample is decided by the hash
+of the scene id, so the same scenes are rendered in every run.
+"""
+
+import os
+import queue
+import hashlib
+import threading
+import traceback
+
+import cv2
+
+from utils import get_scene_id
+
+# ## BGR colors of the lanes, cycled by lane index
+_LANE_COLORS = [
+    (0, 255, 0),
+    (255, 128, 0),
+    (0, 255, 255),
+    (255, 0, 255),
+    (255, 255, 0),
+    (0, 128, 255),
+]
+_UNASSIGNED_COLOR = (0, 0, 255)
+_LINE_COLOR = (255, 255, 255)
+_EGO_COLOR = (128, 128, 128)
+
+# ## The end marker put to the queue for each worker
+_END = None
+
+
+def is_sampled(scene_id, sample_rate):
+    """
+    Whether scene_id is in the sample, deterministic across runs and processes
+    """
+    if sample_rate >= 1:
+        return True
+    digest = hashlib.blake2b(scene_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64 < sample_rate
+
+
+def render_scene(img, ls_lines, ls_xyxy, ls_lane_idx, ego_xyxy):
+    """
+    Draw the lane lines, the actor boxes and the ego vehicle on img in place
+    ls_lines: list of lines, each being a list of tuples [(x1, y1), (x2, y2), ...] or an int array of shape (num_points, 2), ranked from left to right
+    ls_xyxy: list of [x1, y1, x2, y2], the boxes of the actors
+    ls_lane_idx: list of int or None, the lane index of each actor
+    ego_xyxy: [x1, y1, x2, y2], the box of the ego vehicle
+    """
+    for line_idx, line in enumerate(ls_lines):
+        for pt_start, pt_end in zip(line, line[1:]):
+            cv2.line(img, tuple(pt_start), tuple(pt_end), _LINE_COLOR, 2)
+        cv2.putText(
+            img,
+            str(line_idx),
+            tuple(line[0]),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1,
+            _LINE_COLOR,
+            2,
+        )
+
+    for xyxy, lane_idx in zip(ls_xyxy, ls_lane_idx):
+        if lane_idx is None:
+            color = _UNASSIGNED_COLOR
+            cv2.circle(img, (xyxy[0], xyxy[3]), 10, color, -1)
+            cv2.circle(img, (xyxy[2], xyxy[3]), 10, color, -1)
+        else:
+            color = _LANE_COLORS[lane_idx % len(_LANE_COLORS)]
+        cv2.rectangle(img, (xyxy[0], xyxy[1]), (xyxy[2], xyxy[3]), color, 2)
+        cv2.putText(
+            img,
+            "?" if lane_idx is None else str(lane_idx),
+            (xyxy[0], max(xyxy[1] - 5, 0)),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.8,
+            color,
+            2,
+        )
+
+    cv2.rectangle(
+        img, (ego_xyxy[0], ego_xyxy[1] - 20), (ego_xyxy[2], ego_xyxy[3]), _EGO_COLOR, -1
+    )
+    return img
+
+
+class DebugVisualizer(object):
+    """
+    Render the debug images of the scenes in background threads, see the module docstring.
+    Use it as a context manager, or call `close` to wait for the pending images.
+    """
+
+    def __init__(self, save_dir, sample_rate=1.0, num_workers=1, queue_size=32):
+        self.save_dir = save_dir
+        self.sample_rate = sample_rate
+        os.makedirs(save_dir, exist_ok=True)
+
+        # ## The generator blocks when the queue is full instead of piling up the scenes in memory
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.ls_threads = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(num_workers)
+        ]
+        for thread in self.ls_threads:
+            thread.start()
+
+    def submit(self, source_img_path, ls_lines, ls_xyxy, ls_lane_idx, ego_xyxy):
+        """
+        Queue the scene of source_img_path for rendering, see `render_scene` for the arguments
+        """
+        scene_id = get_scene_id(os.path.basename(source_img_path))
+        if not is_sampled(scene_id, self.sample_rate):
+            return
+        self.queue.put(
+            (scene_id, source_img_path, ls_lines, ls_xyxy, ls_lane_idx, ego_xyxy)
+        )
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is _END:
+                self.queue.task_done()
+                break
+            scene_id, source_img_path = task[:2]
+            try:
+                img = cv2.imread(source_img_path)
+                assert img is not None, f"Cannot read the image {source_img_path}"
+                render_scene(img, *task[2:])
+                cv2.imwrite(os.path.join(self.save_dir, f"{scene_id}.jpg"), img)
+            except Exception:
+                print(f"WARNING: Cannot visualize scene {scene_id}! Skipping...")
+                traceback.print_exc()
+            self.queue.task_done()
+
+    def flush(self):
+        """
+        Wait for the queued images without stopping the workers
+        """
+        self.queue.join()
+
+    def close(self):
+        for _ in self.ls_threads:
+            self.queue.put(_END)
+        for thread in self.ls_threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
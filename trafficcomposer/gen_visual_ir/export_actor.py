@@ -0,0 +1,177 @@
+"""
+Export YOLOv10 to ONNX or OpenVINO for the CPU backends of `extract_actor.py`, and check it against the eager model.
+
+How to use this script:
+    python export_actor.py --backend onnx --check_dir <image dir>
+    python export_actor.py --backend openvino --int8 --check_dir <image dir>
+The exported model is cached by `extract_actor.load_yolo_model` in `yolo_exports/`, so later runs of
+`extract_actor.py --backend ...` load it without exporting again.
+
+With `--check_dir`, both models detect the actors of the images in the directory:
+    - box agreement: the share of the boxes matched one to one across the two models with an IoU of at least `--iou_threshold`
+    - class agreement: the share of the matched boxes with the same class
+and the throughput of both is printed.
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from utils import gen_img_list
+from yolo_label import xywhn_to_xyxy
+from extract_actor import YoloActorDetector, YOLO_BACKENDS
+
+
+def box_iou(arr_xyxy_a, arr_xyxy_b):
+    """
+    return: np.ndarray of shape (len(arr_xyxy_a), len(arr_xyxy_b)), the IoU of each pair of boxes
+    """
+    top_left = np.maximum(arr_xyxy_a[:, None, :2], arr_xyxy_b[None, :, :2])
+    bottom_right = np.minimum(arr_xyxy_a[:, None, 2:], arr_xyxy_b[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(arr_xyxy_a[:, 2:] - arr_xyxy_a[:, :2], axis=1)
+    area_b = np.prod(arr_xyxy_b[:, 2:] - arr_xyxy_b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def match_labels(labels_a, labels_b, img_size, iou_threshold=0.8):
+    """
+    Match the boxes of the two labels one to one, greedily by IoU
+    labels_a, labels_b: np.ndarray of shape (num_actors, 5), see `extract_actor.result_to_labels`
+    img_size: (img_h, img_w)
+    return: (the number of matched boxes, the number of them with the same class)
+    """
+    if len(labels_a) == 0 or len(labels_b) == 0:
+        return 0, 0
+    img_h, img_w = img_size
+    iou = box_iou(
+        xywhn_to_xyxy(labels_a[:, 1:5], img_w, img_h),
+        xywhn_to_xyxy(labels_b[:, 1:5], img_w, img_h),
+    )
+    num_matched, num_same_class = 0, 0
+    while True:
+        idx_a, idx_b = np.unravel_index(np.argmax(iou), iou.shape)
+        if iou[idx_a, idx_b] < iou_threshold:
+            break
+        num_matched += 1
+        num_same_class += int(labels_a[idx_a, 0] == labels_b[idx_b, 0])
+        iou[idx_a, :] = -1
+        iou[:, idx_b] = -1
+    return num_matched, num_same_class
+
+
+def run_detector(detector, ls_img_path, batch_size, repeat=2):
+    """
+    return: (seconds per run of all the images, the (labels, (img_h, img_w)) of each image)
+    """
+    ls_batch = [
+        ls_img_path[start : start + batch_size]
+        for start in range(0, len(ls_img_path), batch_size)
+    ]
+    # ## warm up, e.g., the graph compilation of OpenVINO
+    detector.detect_batch(ls_batch[0], ls_batch[0])
+    t_start = time.time()
+    for _ in range(repeat):
+        ls_result = [
+            item
+            for ls_batch_path in ls_batch
+            for item in detector.detect_batch(ls_batch_path, ls_batch_path)
+        ]
+    return (time.time() - t_start) / repeat, ls_result
+
+
+def check_exported(
+    ls_img_path,
+    backend,
+    int8=False,
+    batch_size=8,
+    iou_threshold=0.8,
+    min_agreement=0.95,
+):
+    """
+    Compare the actors detected by the eager and the exported models on the images, and time both
+    return: bool, whether both the box and the class agreements are at least min_agreement
+    """
+    dct_result = {}
+    for name, dct_kwargs in [
+        ("eager", {"backend": "torch"}),
+        (backend + ("-int8" if int8 else ""), {"backend": backend, "int8": int8}),
+    ]:
+        detector = YoloActorDetector(save_dir=None, **dct_kwargs)
+        dct_result[name] = run_detector(detector, ls_img_path, batch_size)
+        print(
+            f"{name}: {len(ls_img_path) / dct_result[name][0]:.2f} images/s with batch size {batch_size}"
+        )
+    (eager_seconds, ls_eager), (exported_seconds, ls_exported) = dct_result.values()
+    print(f"Speedup of the exported model: {eager_seconds / exported_seconds:.2f}x")
+
+    num_eager, num_exported, num_matched, num_same_class = 0, 0, 0, 0
+    for (labels_eager, img_size), (labels_exported, _) in zip(ls_eager, ls_exported):
+        num_eager += len(labels_eager)
+        num_exported += len(labels_exported)
+        matched, same_class = match_labels(
+            labels_eager, labels_exported, img_size, iou_threshold=iou_threshold
+        )
+        num_matched += matched
+        num_same_class += same_class
+    box_agreement = num_matched / max(num_eager, num_exported, 1)
+    class_agreement = num_same_class / max(num_matched, 1)
+    print(
+        f"{num_eager} eager boxes, {num_exported} exported boxes on {len(ls_img_path)} images: "
+        f"box agreement {box_agreement:.3f} (IoU >= {iou_threshold}), class agreement {class_agreement:.3f}"
+    )
+    return box_agreement >= min_agreement and class_agreement >= min_agreement
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Export YOLOv10 to ONNX or OpenVINO and check it"
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="onnx",
+        choices=[backend for backend in YOLO_BACKENDS if backend != "torch"],
+    )
+    parser.add_argument(
+        "--int8", action="store_true", help="quantize the OpenVINO model to int8"
+    )
+    parser.add_argument(
+        "--check_dir",
+        type=str,
+        default=None,
+        help="the directory of the images to check and time the exported model against the eager model",
+    )
+    parser.add_argument(
+        "--num_check", type=int, default=64, help="the number of images to check"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=8, help="the batch size of the check"
+    )
+    parser.add_argument("--iou_threshold", type=float, default=0.8)
+    parser.add_argument(
+        "--min_agreement",
+        type=float,
+        default=0.95,
+        help="the smallest box and class agreements to pass, lower it for int8",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # ## export and cache the model
+    YoloActorDetector(save_dir=None, backend=args.backend, int8=args.int8)
+
+    if args.check_dir is not None:
+        ls_img_path = gen_img_list(args.check_dir)[: args.num_check]
+        assert len(ls_img_path) > 0, f"No image in {args.check_dir}"
+        assert check_exported(
+            ls_img_path,
+            args.backend,
+            int8=args.int8,
+            batch_size=args.batch_size,
+            iou_threshold=args.iou_threshold,
+            min_agreement=args.min_agreement,
+        ), "The exported model does not agree with the eager model"
@@ -0,0 +1,228 @@
+"""
+Export the CLRNet network to ONNX or TorchScript for the CPU backends of `extract_lane.py`.
+
+How to use this script:
+    python export_lane.py clrnet/configs/clrnet/clr_dla34_culane.py --load_from culane_dla34.pth --output culane_dla34.onnx
+    python export_lane.py clrnet/configs/clrnet/clr_dla34_culane.py --load_from culane_dla34.pth --output culane_dla34.pt
+The format is decided by the suffix of the output, see `extract_lane.EXPORTED_MODEL_SUFFIXES`.
+Only the network up to the predictions of its heads is exported; `heads.get_lanes`, which decodes
+the lanes with NMS, still runs in PyTorch, so the decoding is the same for every backend.
+
+With `--check_dir`, the exported network is checked and timed against the eager network on CPU
+on the images in the directory: the `.lines.txt` content of each image must have the same lanes,
+with the x of the points at the same y within `--tolerance` pixels.
+"""
+
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from utils import gen_img_list
+from lane_io import format_lanes_txt, parse_lanes_txt
+from extract_lane import (
+    load_cfg,
+    MyClrnetRunner,
+    MyInferDataset,
+    EXPORTED_MODEL_SUFFIXES,
+)
+
+
+class ClrnetExportWrapper(torch.nn.Module):
+    """
+    The network on a tensor of images instead of the batch dict, returning the predictions of the heads in eval mode
+    """
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, img):
+        return self.net(img)
+
+
+def export_clrnet(net, cfg, output_path, opset_version=17):
+    """
+    Export the network for an input of shape (batch, 3, cfg.img_h, cfg.img_w), the batch size being dynamic
+    """
+    wrapper = ClrnetExportWrapper(net).eval()
+    img = torch.randn(2, 3, cfg.img_h, cfg.img_w)
+    with torch.no_grad():
+        if output_path.endswith(EXPORTED_MODEL_SUFFIXES["onnxruntime"]):
+            # ## grid_sample of the ROI gathering needs opset 16
+            torch.onnx.export(
+                wrapper,
+                img,
+                output_path,
+                input_names=["img"],
+                output_names=["predictions"],
+                dynamic_axes={"img": {0: "batch"}, "predictions": {0: "batch"}},
+                opset_version=opset_version,
+            )
+        else:
+            assert output_path.endswith(
+                EXPORTED_MODEL_SUFFIXES["torchscript"]
+            ), f"Unknown output {output_path}, should end with one of {list(EXPORTED_MODEL_SUFFIXES.values())}"
+            traced = torch.jit.trace(wrapper, img)
+            traced = torch.jit.freeze(traced)
+            traced.save(output_path)
+    return output_path
+
+
+def max_lane_diff(lanes_txt_a, lanes_txt_b):
+    """
+    The largest difference of x between the points at the same y of the two `.lines.txt` contents,
+    or inf if they have different numbers of lanes or a lane without any common y
+    """
+    lanes_a, lanes_b = parse_lanes_txt(lanes_txt_a), parse_lanes_txt(lanes_txt_b)
+    if len(lanes_a) != len(lanes_b):
+        return float("inf")
+    max_diff = 0.0
+    for lane_a, lane_b in zip(lanes_a, lanes_b):
+        # ## The points are sampled at the same ys; a point near the image border may be kept by one backend only
+        _, idx_a, idx_b = np.intersect1d(
+            np.round(lane_a[:, 1], 3), np.round(lane_b[:, 1], 3), return_indices=True
+        )
+        if len(idx_a) == 0:
+            return float("inf")
+        max_diff = max(max_diff, np.abs(lane_a[idx_a, 0] - lane_b[idx_b, 0]).max())
+    return max_diff
+
+
+def run_batches(runner, dataset, ls_batch, repeat=3):
+    """
+    return: (seconds per run of all the batches, the `.lines.txt` content of each image)
+    """
+    # ## warm up, e.g., the memory allocation and the graph optimization of ONNX Runtime
+    runner.infer_batch(ls_batch[0])
+    t_start = time.time()
+    for _ in range(repeat):
+        ls_output = [runner.infer_batch(data) for data in ls_batch]
+    seconds = (time.time() - t_start) / repeat
+
+    ls_lanes_txt = []
+    for data, output in zip(ls_batch, ls_output):
+        for _, lanes in dataset.to_image_lanes(output, data["meta"]):
+            ls_lanes_txt.append(format_lanes_txt(lanes))
+    return seconds, ls_lanes_txt
+
+
+def check_exported(cfg_eager, cfg_exported, ls_img_path, tolerance):
+    """
+    Compare the lanes of the eager and the exported networks on the images, and time both
+    return: bool, whether all the images pass
+    """
+    dataset = MyInferDataset(image_paths=ls_img_path, cfg=cfg_eager)
+    ls_batch = []
+    for start in range(0, len(dataset), cfg_eager.infer_batch_size):
+        ls_sample = [
+            dataset[idx]
+            for idx in range(
+                start, min(start + cfg_eager.infer_batch_size, len(dataset))
+            )
+        ]
+        ls_batch.append(torch.utils.data.default_collate(ls_sample))
+
+    dct_result = {}
+    for name, cfg in [("eager", cfg_eager), ("exported", cfg_exported)]:
+        runner = MyClrnetRunner(cfg)
+        runner.net.eval()
+        dct_result[name] = run_batches(runner, dataset, ls_batch)
+        print(
+            f"{name}: {dct_result[name][0] / len(ls_batch) * 1000:.1f} ms per batch of {cfg.infer_batch_size}, "
+            f"{len(dataset) / dct_result[name][0]:.2f} images/s"
+        )
+    print(
+        f"Speedup of the exported network: {dct_result['eager'][0] / dct_result['exported'][0]:.2f}x"
+    )
+
+    num_failed = 0
+    for img_path, lanes_txt_eager, lanes_txt_exported in zip(
+        ls_img_path, dct_result["eager"][1], dct_result["exported"][1]
+    ):
+        diff = max_lane_diff(lanes_txt_eager, lanes_txt_exported)
+        if diff > tolerance:
+            num_failed += 1
+            print(f"WARNING: The lanes of {img_path} differ by {diff:.2f} pixels!")
+    print(
+        f"{len(ls_img_path) - num_failed} of {len(ls_img_path)} images within {tolerance} pixels."
+    )
+    return num_failed == 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export CLRNet to ONNX or TorchScript")
+    parser.add_argument("config", help="CLRNet config file path")
+    parser.add_argument(
+        "--load_from", default=None, help="the checkpoint file to load from"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="the exported network, .onnx for ONNX Runtime or .pt for TorchScript",
+    )
+    parser.add_argument(
+        "--opset_version", type=int, default=17, help="the ONNX opset version"
+    )
+    parser.add_argument(
+        "--check_dir",
+        type=str,
+        default=None,
+        help="the directory of the images to check and time the exported network against the eager network",
+    )
+    parser.add_argument(
+        "--num_check", type=int, default=48, help="the number of images to check"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=2.0,
+        help="the largest difference in pixels of the lanes of the two networks",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=8, help="the batch size of the check"
+    )
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="the intra-op threads on CPU"
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = parse_args()
+    cfg = load_cfg(
+        args.config,
+        load_from=args.load_from,
+        device="cpu",
+        batch_size=args.batch_size,
+        num_threads=args.num_threads,
+        lane_format="txt",
+    )
+    runner = MyClrnetRunner(cfg)
+    export_clrnet(runner.model, cfg, args.output, opset_version=args.opset_version)
+    print(f"Exported CLRNet to {args.output}")
+
+    if args.check_dir is None:
+        return
+    cfg_exported = load_cfg(
+        args.config,
+        load_from=args.load_from,
+        device="cpu",
+        batch_size=args.batch_size,
+        num_threads=args.num_threads,
+        lane_format="txt",
+        exported_model=args.output,
+    )
+    ls_img_path = gen_img_list(args.check_dir)[: args.num_check]
+    assert len(ls_img_path) > 0, f"No image in {args.check_dir}"
+    assert check_exported(
+        cfg, cfg_exported, ls_img_path, args.tolerance
+    ), "The exported network does not match the eager network"
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,27 @@ This script is used to extract the actor from the image using YOLOv10 model.
 The model is pretrained on the COCO dataset.
 The input images are stored in the IMAGE_DIR.
 The output images are stored in the OBJ_DETECTION_RESULT_SAVE_DIR.
+The results are streamed one batch at a time by default, so the memory stays flat however many images there are;
+the throughput and the peak memory are printed along the way. `--no_stream` keeps all the results until the end.
+On CPU, `--backend onnx` or `--backend openvino` (optionally with `--int8`) runs the model exported by `load_yolo_model`,
+with the same labels; `export_actor.py` checks an exported model against the eager one.
+If a model worker (`model_worker.py`) is running the same model, the images are detected by it instead
+of loading the model in this process, see `--no_worker`.
+`--actor_types` only detects the actors of the scenario types, and `--roi` only the road region of each image,
+see `actor_filter`.
 """
 
 from ultralytics import YOLOv10
 
 import sys
 import os
+import time
+import argparse
+import shutil
+import resource
+import cv2
+import numpy as np
+from tqdm import tqdm
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../.."))
 from trafficcomposer.gen_visual_ir.config_visual import (
@@ -19,17 +34,515 @@ from trafficcomposer.gen_visual_ir.config_visual import (
     OBJ_DETECTION_RESULT_SAVE_DIR,
 )
 
-from utils import gen_img_list, copy_dir
+from utils import gen_img_list, make_staging_dir, publish_dir
+from image_size import save_image_sizes, IMAGE_SIZES_FILE_NAME
+from model_worker import connect_worker, actor_model_info, DEFAULT_ADDRESS
+from yolo_label import save_yolo_labels
+from lane_io import load_lanes, LANE_FILE_SUFFIXES
+from actor_filter import (
+    allowed_class_ids,
+    load_coco_names,
+    road_roi_top,
+    shift_labels,
+    ACTOR_TYPES,
+    ROI_MODES,
+)
+
+# ## The backends of `load_yolo_model`: the eager PyTorch model, or the format of `model.export`
+YOLO_BACKENDS = ("torch", "onnx", "openvino")
+# ## The exported models are cached here, next to the other weight files
+YOLO_EXPORT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "yolo_exports"
+)
+
+
+def exported_model_path(model_name, backend, int8=False, export_dir=YOLO_EXPORT_DIR):
+    """
+    return: str, the cached model of the backend, a .onnx file or an OpenVINO IR directory
+    """
+    name = model_name.replace("/", "_") + ("_int8" if int8 else "")
+    suffix = ".onnx" if backend == "onnx" else "_openvino_model"
+    return os.path.join(export_dir, name + suffix)
+
+
+def load_yolo_model(
+    model_name="jameslahm/yolov10x",
+    backend="torch",
+    int8=False,
+    export_dir=YOLO_EXPORT_DIR,
+    calibration_data=None,
+):
+    """
+    Load the YOLOv10 model to run with the backend, one of YOLO_BACKENDS.
+    The onnx and openvino models are exported once and cached in export_dir, and loaded from there afterwards.
+    The exported models take the default input size of 640 and predict the same `Results` as the eager model.
+    int8: quantize the OpenVINO model to int8, calibrated on calibration_data (a YOLO dataset yaml, the ultralytics default if None)
+    """
+    assert (
+        backend in YOLO_BACKENDS
+    ), f"Unknown backend {backend}, should be one of {YOLO_BACKENDS}"
+    assert not int8 or backend == "openvino", "Only the openvino backend supports int8"
+    if backend == "torch":
+        return YOLOv10.from_pretrained(model_name)
+
+    model_path = exported_model_path(
+        model_name, backend, int8=int8, export_dir=export_dir
+    )
+    if not os.path.exists(model_path):
+        print(f"Exporting {model_name} to {model_path}...")
+        dct_export_kwargs = (
+            {} if calibration_data is None else {"data": calibration_data}
+        )
+        exported_path = YOLOv10.from_pretrained(model_name).export(
+            format=backend,
+            int8=int8,
+            # ## The ONNX model takes batches of any size; the OpenVINO model is compiled for the input shape
+            dynamic=backend == "onnx",
+            **dct_export_kwargs,
+        )
+        # ## `export` writes next to the downloaded weights
+        os.makedirs(export_dir, exist_ok=True)
+        shutil.move(exported_path, model_path)
+    return YOLOv10(model_path, task="detect")
+
+
+def peak_rss_mb():
+    """
+    The peak resident memory of this process so far, in MB
+    """
+    # ## ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def read_images(ls_img_path):
+    """
+    return: list of the BGR images, None for the images that cannot be read
+    """
+    ls_img = []
+    for img_path in ls_img_path:
+        img = cv2.imread(img_path)
+        if img is None:
+            print(f"WARNING: Cannot read the image {img_path}! Skipping...")
+        ls_img.append(img)
+    return ls_img
+
+
+def predict_roi(model, ls_img, ls_roi_top, **predict_kwargs):
+    """
+    Detect the actors in the road region of each image, i.e., the rows from its roi top down
+    ls_img: list of BGR images, or None for the images that cannot be read, see `read_images`
+    return: list of (the YOLO result of the road region, the labels in the full image, see `actor_filter.shift_labels`);
+        (None, no labels) for the images that cannot be read
+    """
+    ls_idx = [idx for idx, img in enumerate(ls_img) if img is not None]
+    ls_ans = [(None, np.zeros((0, 5)))] * len(ls_img)
+    if len(ls_idx) == 0:
+        return ls_ans
+    results = model.predict(
+        source=[ls_img[idx][ls_roi_top[idx] :] for idx in ls_idx],
+        verbose=False,
+        **predict_kwargs,
+    )
+    for idx, result in zip(ls_idx, results):
+        ls_ans[idx] = (
+            result,
+            shift_labels(
+                result.boxes.xyxy.cpu().numpy(),
+                result.boxes.cls.cpu().numpy(),
+                ls_roi_top[idx],
+                *ls_img[idx].shape[:2],
+            ),
+        )
+    return ls_ans
+
+
+def find_lanes(lane_dir, img_name):
+    """
+    return: the lanes detected by `extract_lane.py` in the image, or None if there is no result
+    """
+    for suffix in LANE_FILE_SUFFIXES:
+        lane_fp = os.path.join(lane_dir, img_name + suffix)
+        if os.path.exists(lane_fp):
+            return load_lanes(lane_fp)
+    return None
+
+
+def predict_roi_dir(
+    model,
+    img_dir,
+    save_dir,
+    roi,
+    horizon=0.4,
+    lane_dir=None,
+    batch_size=16,
+    **predict_kwargs,
+):
+    """
+    Detect the actors in the road region of the images in img_dir, see `predict_roi`, and write the same files as
+    `model.predict` with save and save_txt: the labels to save_dir/labels, and the annotated images to save_dir
+    return: generator of (image file name, (img_h, img_w)) of each image; the images that cannot be read are skipped
+    """
+    label_dir = os.path.join(save_dir, "labels")
+    os.makedirs(label_dir, exist_ok=True)
+    ls_img_path = gen_img_list(img_dir)
+    for start in range(0, len(ls_img_path), batch_size):
+        ls_batch, ls_img = [], []
+        for img_path, img in zip(
+            ls_img_path[start : start + batch_size],
+            read_images(ls_img_path[start : start + batch_size]),
+        ):
+            if img is not None:
+                ls_batch.append(img_path)
+                ls_img.append(img)
+        if len(ls_img) == 0:
+            continue
+        ls_roi_top = [
+            road_roi_top(
+                img.shape[0],
+                roi,
+                lanes=(
+                    find_lanes(lane_dir, os.path.basename(img_path))
+                    if roi == "lanes"
+                    else None
+                ),
+                horizon=horizon,
+            )
+            for img_path, img in zip(ls_batch, ls_img)
+        ]
+        for img_path, img, roi_top, (result, labels) in zip(
+            ls_batch,
+            ls_img,
+            ls_roi_top,
+            predict_roi(model, ls_img, ls_roi_top, **predict_kwargs),
+        ):
+            img_name = os.path.basename(img_path)
+            save_yolo_labels(
+                labels, os.path.join(label_dir, os.path.splitext(img_name)[0] + ".txt")
+            )
+            # ## the annotated road region over the rest of the image
+            img[roi_top:] = result.plot()
+            cv2.imwrite(os.path.join(save_dir, img_name), img)
+            yield img_name, img.shape[:2]
+
+
+def predict_with_worker(client, img_dir, chunk_size=64, **predict_kwargs):
+    """
+    Detect the images in img_dir with the model worker, chunk_size images per request
+    return: generator of (image file name, (img_h, img_w)) of each image
+    """
+    ls_img_path = gen_img_list(img_dir)
+    for start in range(0, len(ls_img_path), chunk_size):
+        yield from client.predict_actors(
+            source=ls_img_path[start : start + chunk_size], **predict_kwargs
+        )
+
+
+def connect_actor_worker(model_name, backend, int8=False, address=DEFAULT_ADDRESS):
+    """
+    return: the client of the model worker at address if it runs the same model, or else None
+    """
+    client = connect_worker(address)
+    if client is None:
+        return None
+    if client.info.get("actor") != actor_model_info(model_name, backend) or int8:
+        print(
+            f"WARNING: The model worker at {address} does not run {model_name} with {backend}"
+            f"{' int8' if int8 else ''}! Loading the model in this process..."
+        )
+        client.close()
+        return None
+    return client
+
+
+def yolo_detect(
+    img_dir=IMAGE_DIR,
+    stream=True,
+    batch_size=None,
+    report_every=1000,
+    backend="torch",
+    int8=False,
+    worker_address=DEFAULT_ADDRESS,
+    actor_types=None,
+    roi=None,
+    horizon=0.4,
+    lane_dir=LANE_DETECTION_RESULT_LOAD_DIR,
+):
+    """
+    stream: consume the results one at a time as YOLO yields them, writing the labels and the annotated images
+        batch by batch; otherwise, the results of all the images, with their images and tensors, are kept until the end
+    batch_size: int, the number of images inferred at a time, the YOLO default if None
+    report_every: int, print the throughput and the peak memory every this many images
+    backend, int8: see `load_yolo_model`
+    worker_address: the address of the model worker to use if it runs the same model, None to always load the model in this process
+    actor_types: list of the actor types to detect, see `actor_filter.ACTOR_TYPES`; None for all the COCO classes
+    roi: detect only the road region of each image, "lanes" from the lanes in lane_dir or "horizon" from the row horizon * img_h,
+        see `actor_filter.road_roi_top`; None for the full image. It runs in this process, without the model worker.
+    """
+    model_name = "jameslahm/yolov10x"
+    client = (
+        None
+        if worker_address is None or roi is not None
+        else connect_actor_worker(
+            model_name, backend, int8=int8, address=worker_address
+        )
+    )
+
+    # ## YOLO writes the results directly next to OBJ_DETECTION_RESULT_SAVE_DIR, which is then replaced by a rename instead of a copy
+    staging_dir = make_staging_dir(OBJ_DETECTION_RESULT_SAVE_DIR)
+
+    dct_predict_kwargs = dict(
+        save=True,
+        save_txt=True,
+        project=os.path.dirname(staging_dir),
+        name=os.path.basename(staging_dir),
+        exist_ok=True,
+    )
+    if batch_size is not None:
+        dct_predict_kwargs["batch"] = batch_size
+    if actor_types is not None:
+        dct_predict_kwargs["classes"] = allowed_class_ids(
+            load_coco_names(), actor_types
+        )
+    if client is None:
+        model = load_yolo_model(model_name, backend=backend, int8=int8)
+
+    # ## Timed from here on: without streaming, `model.predict` detects all the images before returning
+    t_start = time.time()
+    if roi is not None:
+        img_sizes = predict_roi_dir(
+            model,
+            img_dir,
+            staging_dir,
+            roi,
+            horizon=horizon,
+            lane_dir=lane_dir,
+            batch_size=batch_size or 16,
+            **(
+                {}
+                if actor_types is None
+                else {"classes": dct_predict_kwargs["classes"]}
+            ),
+        )
+    elif client is not None:
+        # ## The worker writes the same files to the staging directory, and streams its results
+        print(f"Detecting the actors with the model worker at {worker_address}")
+        img_sizes = predict_with_worker(client, img_dir, **dct_predict_kwargs)
+    else:
+        # img_list = gen_img_list(img_dir)
+        results = model.predict(
+            source=img_dir, stream=stream, verbose=False, **dct_predict_kwargs
+        )
+        img_sizes = (
+            (os.path.basename(result.path), result.orig_shape) for result in results
+        )
+
+    # ## Only the size of each image is kept, a few bytes per image; each result is released after this loop step when streaming
+    dct_img_size = {}
+    for img_name, img_size in tqdm(img_sizes, desc="Detecting actors"):
+        dct_img_size[img_name] = img_size
+        if len(dct_img_size) % report_every == 0:
+            tqdm.write(
+                f"{len(dct_img_size)} images, {len(dct_img_size) / (time.time() - t_start):.2f} images/s, "
+                f"peak RSS {peak_rss_mb():.0f} MB"
+            )
+    wall_time = time.time() - t_start
+    print(
+        f"Detected the actors of {len(dct_img_size)} images in {wall_time:.2f}s "
+        f"({len(dct_img_size) / max(wall_time, 1e-9):.2f} images/s, {'streaming' if stream else 'not streaming'}), "
+        f"peak RSS {peak_rss_mb():.0f} MB"
+    )
+
+    # ## record the image sizes next to the labels, so `gen_visual_ir.py` does not read the images again
+    label_dir = os.path.join(staging_dir, "labels")
+    os.makedirs(label_dir, exist_ok=True)
+    save_image_sizes(dct_img_size, os.path.join(label_dir, IMAGE_SIZES_FILE_NAME))
+
+    if client is not None:
+        client.close()
+    publish_dir(staging_dir, OBJ_DETECTION_RESULT_SAVE_DIR)
+
+
+def result_to_labels(result):
+    """
+    The boxes of a YOLO result in memory, the same values as `result.save_txt` writes
+    return: np.ndarray of shape (num_actors, 5), [class, x_center, y_center, width, height] per row, normalized, see `yolo_label`
+    """
+    boxes = result.boxes
+    return np.column_stack([boxes.cls.cpu().numpy(), boxes.xywhn.cpu().numpy()]).astype(
+        np.float64
+    )
+
+
+class YoloActorDetector(object):
+    """
+    Detect the actors of one image at a time, e.g., in the streaming pipeline (`trafficcomposer/pipeline.py`), or of a batch of images with `detect_batch`.
+    If save_dir is given, the labels of each image are saved to `save_dir/<scene id>.txt`, in the same format as `yolo_detect`.
+    Otherwise, the labels are only returned in memory and no file is written.
+    backend, int8: see `load_yolo_model`
+    actor_types, roi, horizon: see `yolo_detect`; with roi="lanes", the lanes of the images are passed to `detect_batch`
+    """
+
+    def __init__(
+        self,
+        save_dir=None,
+        model_name="jameslahm/yolov10x",
+        backend="torch",
+        int8=False,
+        actor_types=None,
+        roi=None,
+        horizon=0.4,
+    ):
+        self.model = load_yolo_model(model_name, backend=backend, int8=int8)
+        self.dct_predict_kwargs = (
+            {}
+            if actor_types is None
+            else {"classes": allowed_class_ids(self.model.names, actor_types)}
+        )
+        assert roi is None or roi in ROI_MODES, f"Unknown ROI {roi}"
+        self.roi = roi
+        self.horizon = horizon
+        self.save_dir = save_dir
+        if save_dir is not None:
+            os.makedirs(save_dir, exist_ok=True)
+
+    def save_labels(self, scene_id, labels):
+        """
+        return: str, the path to the label file
+        """
+        label_fp = os.path.join(self.save_dir, f"{scene_id}.txt")
+        save_yolo_labels(labels, label_fp)
+        return label_fp
 
+    def detect_batch(self, ls_scene_id, ls_img_path, ls_lanes=None):
+        """
+        ls_lanes: the lanes of each image in its pixels, for roi="lanes"; the full images are detected if None
+        return: list of (labels, (img_h, img_w)) of each image, see `result_to_labels`;
+            with roi, (no labels, None) for the images that cannot be read
+        """
+        if self.roi is None:
+            results = self.model.predict(
+                source=list(ls_img_path), verbose=False, **self.dct_predict_kwargs
+            )
+            ls_ans = [
+                (result_to_labels(result), result.orig_shape) for result in results
+            ]
+        else:
+            ls_img = read_images(ls_img_path)
+            ls_roi_top = [
+                (
+                    None
+                    if img is None
+                    else road_roi_top(
+                        img.shape[0],
+                        self.roi,
+                        lanes=None if ls_lanes is None else ls_lanes[idx],
+                        horizon=self.horizon,
+                    )
+                )
+                for idx, img in enumerate(ls_img)
+            ]
+            # ## no actor and no size for the images that cannot be read
+            ls_ans = [
+                (labels, None if img is None else img.shape[:2])
+                for img, (_, labels) in zip(
+                    ls_img,
+                    predict_roi(
+                        self.model, ls_img, ls_roi_top, **self.dct_predict_kwargs
+                    ),
+                )
+            ]
+        if self.save_dir is not None:
+            for scene_id, (labels, _) in zip(ls_scene_id, ls_ans):
+                self.save_labels(scene_id, labels)
+        return ls_ans
 
-def yolo_detect(img_dir=IMAGE_DIR):
-    model = YOLOv10.from_pretrained("jameslahm/yolov10x")
+    def __call__(self, scene_id, img_path):
+        """
+        return: str, the path to the label file if save_dir is given; or else the labels, see `result_to_labels`
+        """
+        labels, _ = self.detect_batch([scene_id], [img_path])[0]
+        if self.save_dir is None:
+            return labels
+        return os.path.join(self.save_dir, f"{scene_id}.txt")
 
-    # img_list = gen_img_list(img_dir)
-    results = model.predict(source=img_dir, save=True, save_txt=True)
 
-    copy_dir(results[0].save_dir, OBJ_DETECTION_RESULT_SAVE_DIR)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Detect the actors with YOLOv10")
+    parser.add_argument(
+        "--no_stream",
+        action="store_true",
+        help="keep the results of all the images in memory until the end, instead of streaming them",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="the number of images inferred at a time, the YOLO default if not set",
+    )
+    parser.add_argument(
+        "--report_every",
+        type=int,
+        default=1000,
+        help="print the throughput and the peak memory every this many images",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        choices=YOLO_BACKENDS,
+        help="run the eager model, or the model exported to ONNX or OpenVINO and cached in yolo_exports/",
+    )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="quantize the OpenVINO model to int8",
+    )
+    parser.add_argument(
+        "--no_worker",
+        action="store_true",
+        help="always load the model in this process, even if a model worker is running",
+    )
+    parser.add_argument(
+        "--worker_address",
+        type=str,
+        default=DEFAULT_ADDRESS,
+        help="the address of the model worker, see model_worker.py",
+    )
+    parser.add_argument(
+        "--actor_types",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=ACTOR_TYPES,
+        help="only detect the actors of these types, e.g., --actor_types car truck bus pedestrian cyclist; all the COCO classes if not set",
+    )
+    parser.add_argument(
+        "--roi",
+        type=str,
+        default=None,
+        choices=ROI_MODES,
+        help="only detect the road region of each image, from the top of the detected lanes or from the --horizon row",
+    )
+    parser.add_argument(
+        "--horizon",
+        type=float,
+        default=0.4,
+        help="the top row of the road region as a fraction of the image height, for --roi horizon",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    yolo_detect(img_dir=IMAGE_DIR)
+    args = parse_args()
+    yolo_detect(
+        img_dir=IMAGE_DIR,
+        stream=not args.no_stream,
+        batch_size=args.batch_size,
+        report_every=args.report_every,
+        backend=args.backend,
+        int8=args.int8,
+        worker_address=None if args.no_worker else args.worker_address,
+        actor_types=args.actor_types,
+        roi=args.roi,
+        horizon=args.horizon,
+    )
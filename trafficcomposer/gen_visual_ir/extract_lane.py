@@ -6,6 +6,14 @@ How to use this script:
     2.2. The `IMAGE_DIR` in `config.py` to the directory containing the images you want to extract lanes.
 3. Run with the following command:
     python extract_lane.py clrnet/configs/clrnet/clr_dla34_culane.py --load_from culane_dla34.pth --gpus 0
+   On a machine without GPUs, run on CPU with the threads of torch and the batch size set explicitly, e.g.,
+    python extract_lane.py clrnet/configs/clrnet/clr_dla34_culane.py --load_from culane_dla34.pth --device cpu --num_threads 16 --batch_size 8
+   The throughput in images/s is printed at the end.
+4. Optionally, export the network to ONNX or TorchScript with `export_lane.py`, and run the exported graph on CPU, e.g.,
+    python extract_lane.py clrnet/configs/clrnet/clr_dla34_culane.py --exported_model culane_dla34.onnx
+   The lanes are still decoded by `heads.get_lanes` of the network built from the config.
+5. For frequent small runs, start a model worker once (`model_worker.py`), which keeps the network loaded.
+   If it runs the same config and checkpoint, this script sends the images to it instead of building the network, see `--no_worker`.
 """
 
 import os
@@ -18,6 +26,8 @@ import numpy as np
 import random
 from clrnet.utils.config import Config
 from clrnet.engine.runner import Runner
+from clrnet.models.registry import build_net
+from clrnet.utils.recorder import build_recorder
 from clrnet.datasets import build_dataloader
 from clrnet.utils.visualization import imshow_lanes
 from clrnet.datasets.process import Process
@@ -26,8 +36,16 @@ from clrnet.datasets.culane import CULane
 from tqdm import tqdm
 
 import copy
+import time
+import queue
 import logging
+import threading
+import traceback
 
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
 
 import sys
 
@@ -39,7 +57,25 @@ from trafficcomposer.gen_visual_ir.config_visual import OBJ_DETECTION_RESULT_SAV
 # from config import IMAGE_LIST_FILE
 
 
-from utils import gen_img_list, copy_dir
+from utils import gen_img_list, make_staging_dir, publish_dir
+from image_size import imread_at_least
+from lane_io import save_lanes, format_lanes_txt, LANE_FORMATS
+from model_worker import connect_worker, lane_model_info, DEFAULT_ADDRESS
+
+# ## The end marker put to the queue of `LaneResultWriter` for each worker
+_END = None
+
+# ## {backend: file suffix} of the exported networks, see `export_lane.py`
+EXPORTED_MODEL_SUFFIXES = {"onnxruntime": ".onnx", "torchscript": ".pt"}
+
+
+def _num_items(value):
+    """
+    The number of items of a collated value, recursing into the nested dicts, e.g., "img_ori_shape" of the meta
+    """
+    if isinstance(value, dict):
+        return max([_num_items(sub_value) for sub_value in value.values()], default=0)
+    return len(value)
 
 
 def convert_dict_to_list(dictionary):
@@ -62,9 +98,8 @@ def convert_dict_to_list(dictionary):
         ]
     """
     keys = list(dictionary.keys())
-    num_items = 0
-    for key in keys:
-        num_items = max(len(dictionary[key]), num_items)
+    # ## not the number of keys of a nested dict, which would be read past the end of a batch of 1
+    num_items = _num_items(dictionary)
 
     result = []
     for i in range(num_items):
@@ -108,10 +143,13 @@ class MyInferDataset(CULane):
     The only used attribute from the parent class is the processes from BaseDataset, which is the parent class of CULane
     """
 
-    def __init__(self, image_list_file=None, image_dir=None, cfg=None):
+    def __init__(self, image_list_file=None, image_dir=None, cfg=None, image_paths=None, result_dir=None):
         """
         Args:
             image_list_file: str, the path to the txt file containing the paths to the images you want to extract lanes
+            image_dir: str, the directory containing the images
+            image_paths: list of str, the paths to the images, e.g., a single image in `ClrnetLaneDetector`
+            result_dir: str, the directory to save the lanes of each image, `<cfg.work_dir>/visualization` by default
         """
         # The following attributes are not used in this class, legacy arguments from the parent class CULane __init__
         data_root = None
@@ -124,6 +162,7 @@ class MyInferDataset(CULane):
         self.logger = logging.getLogger(__name__)
         self.data_root = data_root
         self.training = "train" in split
+        self.result_dir = result_dir if result_dir is not None else os.path.join(cfg.work_dir, "visualization")
 
         processes = cfg.val_process
         self.processes = Process(processes, cfg)
@@ -133,20 +172,19 @@ class MyInferDataset(CULane):
 
         # self.load_annotations()
 
+        assert (
+            sum(x is not None for x in (image_list_file, image_dir, image_paths)) <= 1
+        ), "Only one of image_list_file, image_dir and image_paths should be provided."
         if image_list_file is not None:
-            assert (
-                image_dir is None
-            ), "Only one of image_list_file and image_dir should be provided."
             self.logger.info(f"Build dataset using image_list_file: {image_list_file}")
             self.load_annotations()
         elif image_dir is not None:
-            assert (
-                image_list_file is None
-            ), "Only one of image_list_file and image_dir should be provided."
             self.logger.info(f"Build dataset using image_dir: {image_dir}")
             self.load_annotations_from_dir(image_dir)
+        elif image_paths is not None:
+            self.data_infos = [self.load_annotation([img_path]) for img_path in image_paths]
         else:
-            raise ValueError("Either image_list_file or image_dir should be provided.")
+            raise ValueError("One of image_list_file, image_dir and image_paths should be provided.")
 
     def load_annotations_from_dir(self, image_dir):
         self.logger.info("Loading dataset...")
@@ -218,70 +256,92 @@ class MyInferDataset(CULane):
 
         return infos
 
-    def view(self, predictions, img_metas):
+    def image_lanes(self, lanes, img_meta):
         """
-        img_metas:
-            original: List of dictionaries, each containing the metadata of an image
-            img_metas = [{"full_img_path": str, "img_name": str, "img_ori_shape": dict}, ...]
+        Convert the predicted lanes of one image to the pixels of the original image
+        img_meta: the metadata of the image, see `view`
+        return: list of np.ndarray of shape (num_points, 2)
         """
-        # img_metas = [item for img_meta in img_metas.data for item in img_meta]
+        ori_img_h = int(img_meta["img_ori_shape"]["img_h"])
+        ori_img_w = int(img_meta["img_ori_shape"]["img_w"])
+
+        # ## the lane in lanes is based on the image size being cfg.ori_img_w, cfg.ori_img_h
+        lanes = [lane.to_array(self.cfg) for lane in lanes]
+        # ## To accommodate different image sizes, we need to transform the lanes according to the original image size
+        return [
+            transform_lane(
+                lane,
+                lane_img_h=self.cfg.ori_img_h,
+                lane_img_w=self.cfg.ori_img_w,
+                target_img_h=ori_img_h,
+                target_img_w=ori_img_w,
+            )
+            for lane in lanes
+        ]
+
+    def to_image_lanes(self, predictions, img_metas):
+        """
+        Convert the predicted lanes to the pixels of the original images, without writing any file
+        img_metas: the collated metadata of the batch, see `view`
+        return: list of (img_meta, lanes), lanes being a list of np.ndarray of shape (num_points, 2)
+        """
+        return [
+            (img_meta, self.image_lanes(lanes, img_meta))
+            for lanes, img_meta in zip(predictions, convert_dict_to_list(img_metas))
+        ]
+
+    def save_image_result(self, img_meta, lanes):
+        """
+        Save the lanes of one image, and the image with the lanes drawn on it if cfg.view is set
+        """
+        img_save_path = os.path.join(self.result_dir, img_meta["img_name"].replace("/", "_"))
 
-        img_metas = convert_dict_to_list(img_metas)
+        # print("========== In ImageDataset.view ==========")
+        # print(f"img_save_path: {img_save_path}")
+        # print(f"lanes: {lanes}")
 
-        for lanes, img_meta in zip(predictions, img_metas):
-            img_name = img_meta["img_name"]
+        if self.cfg.view:
+            # ## The only read of the original image after `__getitem__`
             img = cv2.imread(img_meta["full_img_path"])
-            ori_img_h, ori_img_w = img.shape[:2]
-            img_save_path = os.path.join(
-                self.cfg.work_dir, "visualization", img_name.replace("/", "_")
-            )
+            imshow_lanes(img, lanes, out_file=img_save_path)
 
-            # print("========== In ImageDataset.view ==========")
-            # print(f"img_save_path: {img_save_path}")
-            # print(f"lanes: {lanes}")
-
-            # ## the lane in lanes is based on the image size being cfg.ori_img_w, cfg.ori_img_h
-            lanes = [lane.to_array(self.cfg) for lane in lanes]
-            # ## To accommodate different image sizes, we need to transform the lanes according to the original image size
-            lanes = [
-                transform_lane(
-                    lane,
-                    lane_img_h=self.cfg.ori_img_h,
-                    lane_img_w=self.cfg.ori_img_w,
-                    target_img_h=ori_img_h,
-                    target_img_w=ori_img_w,
-                )
-                for lane in lanes
-            ]
+        # ## .lines.npy by default, or the legacy .lines.txt, see `lane_io`
+        save_lanes(lanes, img_save_path, fmt=self.cfg.lane_format)
 
-            # print(f"========== After to_array ==========")
-            # print(f"lanes: {lanes}")
+    def view(self, predictions, img_metas):
+        """
+        img_metas:
+            original: List of dictionaries, each containing the metadata of an image
+            img_metas = [{"full_img_path": str, "img_name": str, "img_ori_shape": {"img_h": int, "img_w": int}}, ...]
+        The lanes are always saved; the original image is read again and drawn only if cfg.view is set.
+        `LaneResultWriter` does the same in background threads.
+        return: list of the lanes of each image, see `to_image_lanes`
+        """
+        # img_metas = [item for img_meta in img_metas.data for item in img_meta]
 
-            imshow_lanes(img, lanes, out_file=img_save_path)
+        ls_image_lanes = self.to_image_lanes(predictions, img_metas)
+        os.makedirs(self.result_dir, exist_ok=True)
+        for img_meta, lanes in ls_image_lanes:
+            self.save_image_result(img_meta, lanes)
 
-            output_str = self.convert_lane_np_to_txt(lanes)
-            with open(img_save_path + ".lines.txt", "w") as f:
-                f.write(output_str)
+        return [lanes for _, lanes in ls_image_lanes]
 
     def convert_lane_np_to_txt(self, lanes):
         """
-        convert the lanes to a txt file
+        convert the lanes to the legacy txt format
         """
-        out = []
-        for lane in lanes:
-            lane_xs = lane[:, 0]
-            lane_ys = lane[:, 1]
-            lane_str = " ".join(
-                ["{:.5f} {:.5f}".format(x, y) for x, y in zip(lane_xs, lane_ys)]
-            )
-            if lane_str != "":
-                out.append(lane_str)
-
-        return "\n".join(out)
+        return format_lanes_txt(lanes)
 
     def __getitem__(self, idx):
         data_info = self.data_infos[idx]
-        img = cv2.imread(data_info["img_path"])
+        # ## Decode the image once, at a reduced resolution if it is still larger than the input of the model
+        if self.cfg.reduced_decode:
+            img, (ori_img_h, ori_img_w) = imread_at_least(
+                data_info["img_path"], self.cfg.ori_img_h, self.cfg.ori_img_w
+            )
+        else:
+            img = cv2.imread(data_info["img_path"])
+            ori_img_h, ori_img_w = img.shape[:2]
 
         # ## You have to resize the image to the size of the input of the model
         # ## Otherwise, the model will not be able to detect the lanes
@@ -303,6 +363,8 @@ class MyInferDataset(CULane):
         meta = {
             "full_img_path": data_info["img_path"],
             "img_name": data_info["img_name"],
+            # ## `view` maps the lanes back to the original image with it, without reading the image again
+            "img_ori_shape": {"img_h": ori_img_h, "img_w": ori_img_w},
         }
         # meta = DC(meta, cpu_only=True)
         sample.update({"meta": meta})
@@ -310,30 +372,184 @@ class MyInferDataset(CULane):
         return sample
 
 
+class LaneResultWriter(object):
+    """
+    Convert and save the lanes of each image, and draw them with cfg.view, in background threads,
+    so the network infers the next batch meanwhile, see `MyInferDataset.view` for the synchronous version.
+    Use it as a context manager, or call `close` to wait for the pending images.
+    """
+
+    def __init__(self, dataset, num_workers=2, queue_size=64):
+        self.dataset = dataset
+        os.makedirs(dataset.result_dir, exist_ok=True)
+
+        # ## The inference blocks when the queue is full instead of piling up the results in memory
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.ls_threads = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(num_workers)
+        ]
+        for thread in self.ls_threads:
+            thread.start()
+
+    def submit(self, predictions, img_metas):
+        """
+        Queue the results of a batch, see `MyInferDataset.view` for the arguments
+        """
+        for lanes, img_meta in zip(predictions, convert_dict_to_list(img_metas)):
+            self.queue.put((lanes, img_meta))
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is _END:
+                break
+            lanes, img_meta = task
+            try:
+                self.dataset.save_image_result(
+                    img_meta, self.dataset.image_lanes(lanes, img_meta)
+                )
+            except Exception:
+                print(
+                    f"WARNING: Cannot save the lanes of {img_meta['full_img_path']}! Skipping..."
+                )
+                traceback.print_exc()
+
+    def close(self):
+        for _ in self.ls_threads:
+            self.queue.put(_END)
+        for thread in self.ls_threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class OnnxClrnet(object):
+    """
+    The network exported by `export_lane.py` to ONNX, run by ONNX Runtime on CPU.
+    Called on the images of a batch, it returns the same predictions as the network in eval mode, for `heads.get_lanes`.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        if onnxruntime is None:
+            raise ImportError("The ONNX backend of CLRNet requires `pip install onnxruntime`")
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.intra_op_num_threads = num_threads if num_threads else torch.get_num_threads()
+        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            model_path, sess_options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, img):
+        (output,) = self.session.run(None, {self.input_name: img.numpy()})
+        return torch.from_numpy(output)
+
+
+class TorchScriptClrnet(object):
+    """
+    The network exported by `export_lane.py` to TorchScript, see `OnnxClrnet`
+    """
+
+    def __init__(self, model_path):
+        self.module = torch.jit.load(model_path, map_location="cpu")
+        self.module.eval()
+
+    def __call__(self, img):
+        return self.module(img)
+
+
+def load_exported_clrnet(model_path, num_threads=None):
+    """
+    Load the exported network for CPU inference, the backend being decided by the suffix of model_path
+    """
+    if model_path.endswith(EXPORTED_MODEL_SUFFIXES["onnxruntime"]):
+        return OnnxClrnet(model_path, num_threads=num_threads)
+    assert model_path.endswith(
+        EXPORTED_MODEL_SUFFIXES["torchscript"]
+    ), f"Unknown exported model {model_path}, should end with one of {list(EXPORTED_MODEL_SUFFIXES.values())}"
+    return TorchScriptClrnet(model_path)
+
+
 class MyClrnetRunner(Runner):
     """
     To infer the lane detection results on a new image
+    On CPU (`cfg.device == "cpu"`), the network is built without the CUDA-only `MMDataParallel` wrapper of `Runner`.
+    With `cfg.exported_model`, the exported network runs in place of the eager one, whose heads only decode the lanes.
     """
 
     def __init__(self, cfg):
-        super().__init__(cfg)
+        self.exported = None
+        if cfg.exported_model is not None:
+            assert cfg.device == "cpu", "The exported CLRNet only runs on CPU, set `--device cpu`"
+            self.exported = load_exported_clrnet(cfg.exported_model, num_threads=cfg.num_threads)
+
+        if cfg.device != "cpu":
+            super().__init__(cfg)
+            return
+
+        # ## The same as `Runner.__init__`, without moving the network to the GPUs and without the optimizer for training
+        torch.manual_seed(cfg.seed)
+        np.random.seed(cfg.seed)
+        random.seed(cfg.seed)
+        self.cfg = cfg
+        self.recorder = build_recorder(self.cfg)
+        self.net = build_net(self.cfg)
+        if cfg.load_from:
+            checkpoint = torch.load(cfg.load_from, map_location="cpu")
+            # ## The checkpoints are saved from the DataParallel network, whose parameters are prefixed with "module."
+            state_dict = {
+                key[len("module.") :] if key.startswith("module.") else key: value
+                for key, value in checkpoint["net"].items()
+            }
+            missing_keys, unexpected_keys = self.net.load_state_dict(state_dict, strict=False)
+            # ## A parameter missing from the checkpoint would silently stay randomly initialized
+            assert len(missing_keys) == 0, (
+                f"The checkpoint {cfg.load_from} does not match the network, missing {len(missing_keys)} keys: "
+                f"{missing_keys[:10]}"
+            )
+            if len(unexpected_keys) > 0:
+                print(
+                    f"WARNING: {len(unexpected_keys)} keys of the checkpoint {cfg.load_from} are not used by the network: "
+                    f"{unexpected_keys[:10]}"
+                )
+        self.val_loader = None
+        self.test_loader = None
+
+    @property
+    def model(self):
+        """
+        The network without the DataParallel wrapper, if any
+        """
+        return getattr(self.net, "module", self.net)
+
+    def to_device(self, batch):
+        if self.cfg.device == "cpu":
+            # ## The batches are loaded on CPU already
+            return batch
+        return self.to_cuda(batch)
 
     def infer(self, image_list_file=None, image_dir=None, result_dir=None):
         """
         To infer the lane detection results on customized images
+        The results are written once, to a staging directory next to result_dir that replaces result_dir by a rename at the end,
+        with the same layout as the work dir, i.e., the lanes in `<result_dir>/visualization`.
+        Without result_dir, the results stay in `<cfg.work_dir>/visualization`.
         """
-        batch_size = 24
-
+        staging_dir = None if result_dir is None else make_staging_dir(result_dir)
         dataset = MyInferDataset(
             image_list_file=image_list_file,
             image_dir=image_dir,
             cfg=self.cfg,
+            result_dir=None if staging_dir is None else os.path.join(staging_dir, "visualization"),
         )
 
         dataloader = torch.utils.data.DataLoader(
             dataset,
-            batch_size=batch_size,
-            # batch_size=self.cfg.batch_size,
+            batch_size=self.cfg.infer_batch_size,
             shuffle=False,
             num_workers=self.cfg.workers,
             pin_memory=False,
@@ -344,16 +560,212 @@ class MyClrnetRunner(Runner):
         self.dataloader = dataloader
 
         self.net.eval()
-        for _, data in enumerate(tqdm(self.dataloader, desc=f"Inferencing")):
-            data = self.to_cuda(data)
+        infer_time = 0.0
+        t_start = time.time()
+        # ## The lanes of a batch are saved in the background while the network infers the next batch
+        with LaneResultWriter(
+            self.dataloader.dataset,
+            num_workers=self.cfg.writer_workers,
+            queue_size=2 * self.cfg.infer_batch_size,
+        ) as writer:
+            for _, data in enumerate(tqdm(self.dataloader, desc=f"Inferencing")):
+                t_batch = time.time()
+                output = self.infer_batch(data)
+                infer_time += time.time() - t_batch
+                writer.submit(output, data["meta"])
+        wall_time = time.time() - t_start
+
+        num_images = len(dataset)
+        print(
+            f"Detected the lanes of {num_images} images on {self.cfg.device} with batch size {self.cfg.infer_batch_size}: "
+            f"{num_images / max(wall_time, 1e-9):.2f} images/s end to end, "
+            f"{num_images / max(infer_time, 1e-9):.2f} images/s in the network"
+        )
+
+        if staging_dir is not None:
+            publish_dir(staging_dir, result_dir)
 
-            with torch.no_grad():
+    def infer_batch(self, data):
+        """
+        Detect the lanes of a collated batch
+        return: list of the lanes of each image
+        """
+        data = self.to_device(data)
+        with torch.inference_mode():
+            if self.exported is not None:
+                output = self.exported(data["img"])
+            else:
                 output = self.net(data)
-                output = self.net.module.heads.get_lanes(output)
-            # if self.cfg.view:
-            self.dataloader.dataset.view(output, data["meta"])
+            output = self.model.heads.get_lanes(output)
+        return output
+
+
+class ClrnetLaneDetector(object):
+    """
+    Detect the lanes of one image at a time, e.g., in the streaming pipeline (`trafficcomposer/pipeline.py`), or of a batch of images with `detect_batch`.
+    With save_results, the lanes of each image are saved to `<work_dir>/visualization/<image name>.lines.npy` (or `.lines.txt`, see `cfg.lane_format`), the same layout as `MyClrnetRunner.infer`.
+    Otherwise, the lanes are only returned in memory and no file is written.
+    """
+
+    def __init__(self, cfg, save_results=True):
+        self.runner = MyClrnetRunner(cfg)
+        self.runner.net.eval()
+        self.save_results = save_results
+
+    def detect_batch(self, ls_scene_id, ls_img_path):
+        """
+        The lane detection results are named after the images, ls_scene_id is only for the same interface as `YoloActorDetector.detect_batch`
+        return: list of the lanes of each image, each lane being an np.ndarray of shape (num_points, 2) in the pixels of the image
+        """
+        dataset = MyInferDataset(image_paths=ls_img_path, cfg=self.runner.cfg)
+        data = torch.utils.data.default_collate([dataset[idx] for idx in range(len(dataset))])
+        output = self.runner.infer_batch(data)
+        if self.save_results:
+            return dataset.view(output, data["meta"])
+        return [lanes for _, lanes in dataset.to_image_lanes(output, data["meta"])]
+
+    def __call__(self, scene_id, img_path):
+        """
+        return: str, the path to the lane detection result with save_results; or else the lanes, see `detect_batch`
+        """
+        lanes = self.detect_batch([scene_id], [img_path])[0]
+        if not self.save_results:
+            return lanes
+
+        img_name = os.path.basename(img_path)
+        return os.path.join(
+            self.runner.cfg.work_dir,
+            "visualization",
+            img_name.replace("/", "_") + LANE_FORMATS[self.runner.cfg.lane_format],
+        )
+
+
+def connect_lane_worker(cfg, address=DEFAULT_ADDRESS):
+    """
+    return: the client of the model worker at address if it runs the same network as cfg, or else None
+    """
+    client = connect_worker(address)
+    if client is None:
+        return None
+    if client.info.get("lane") != lane_model_info(cfg):
+        print(f"WARNING: The model worker at {address} runs a different CLRNet! Loading the network in this process...")
+        client.close()
+        return None
+    return client
+
+
+def infer_with_worker(client, cfg, image_dir, result_dir):
+    """
+    The same results as `MyClrnetRunner.infer`, with the network of the model worker, see `model_worker.py`
+    """
+    ls_img_path = gen_img_list(image_dir)
+    staging_dir = make_staging_dir(result_dir)
+    vis_dir = os.path.join(staging_dir, "visualization")
+    os.makedirs(vis_dir)
+
+    t_start = time.time()
+    for start in tqdm(range(0, len(ls_img_path), cfg.infer_batch_size), desc="Inferencing with the model worker"):
+        ls_batch = ls_img_path[start : start + cfg.infer_batch_size]
+        # ## The lanes come back in the pixels of the images, see `ClrnetLaneDetector.detect_batch`
+        for img_path, lanes in zip(ls_batch, client.detect_lanes(ls_batch)):
+            img_save_path = os.path.join(vis_dir, os.path.basename(img_path))
+            if cfg.view:
+                imshow_lanes(cv2.imread(img_path), lanes, out_file=img_save_path)
+            save_lanes(lanes, img_save_path, fmt=cfg.lane_format)
+    wall_time = time.time() - t_start
+    print(
+        f"Detected the lanes of {len(ls_img_path)} images with the model worker: "
+        f"{len(ls_img_path) / max(wall_time, 1e-9):.2f} images/s end to end"
+    )
+
+    client.close()
+    publish_dir(staging_dir, result_dir)
+
+
+def load_cfg(
+    config_path,
+    load_from=None,
+    gpus=(0,),
+    view=False,
+    seed=0,
+    work_dirs=None,
+    lane_format="npy",
+    device="auto",
+    batch_size=24,
+    num_threads=None,
+    num_interop_threads=None,
+    reduced_decode=True,
+    writer_workers=2,
+    exported_model=None,
+):
+    """
+    Load the CLRNet configuration for inference
+    lane_format: str, the format of the saved lanes, one of `lane_io.LANE_FORMATS`
+    device: str, "cuda", "cpu", or "auto" for cuda if available and no exported_model is given
+    batch_size: int, the number of images inferred at a time by `MyClrnetRunner.infer`
+    num_threads, num_interop_threads: int, the intra-op and inter-op threads of torch on CPU; None keeps the torch defaults
+    writer_workers: int, the number of threads saving the lanes and the visualization in `MyClrnetRunner.infer`
+    reduced_decode: bool, decode the large JPEG images at a reduced resolution that is still at least the input size of the model, see `image_size.imread_at_least`
+    exported_model: str, the path to the network exported by `export_lane.py` (.onnx or .pt) to run on CPU instead of the eager network
+    """
+    os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(str(gpu) for gpu in gpus)
+
+    cfg = Config.fromfile(config_path)
+    cfg.gpus = len(gpus)
+
+    cfg.load_from = load_from
+    cfg.resume_from = None
+    cfg.finetune_from = None
+    cfg.view = view
+    cfg.seed = seed
+    cfg.lane_format = lane_format
+    if device == "auto":
+        # ## The exported network only runs on CPU
+        device = "cuda" if torch.cuda.is_available() and exported_model is None else "cpu"
+    cfg.device = device
+    cfg.infer_batch_size = batch_size
+    cfg.reduced_decode = reduced_decode
+    cfg.writer_workers = writer_workers
+    cfg.num_threads = num_threads
+    cfg.exported_model = exported_model
+
+    cfg.work_dirs = work_dirs if work_dirs else cfg.work_dirs
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # ## It can only be set once, before any inter-op parallel work
+            print(
+                f"WARNING: Cannot set the inter-op threads of torch to {num_interop_threads}! Skipping..."
+            )
 
-        copy_dir(self.cfg.work_dir, result_dir)
+    cudnn.benchmark = True
+    return cfg
+
+
+def check_convert_dict_to_list():
+    """
+    Collate the metas of batches of 1 and 3 images and split them back with `convert_dict_to_list`
+    """
+    for batch_size in (1, 3):
+        ls_meta = [
+            {
+                "full_img_path": f"/images/{idx:04d}.jpg",
+                "img_name": f"{idx:04d}.jpg",
+                "img_ori_shape": {"img_h": 590 + idx, "img_w": 1640 + idx},
+            }
+            for idx in range(batch_size)
+        ]
+        ls_item = convert_dict_to_list(torch.utils.data.default_collate(ls_meta))
+        assert len(ls_item) == batch_size, (batch_size, ls_item)
+        for item, meta in zip(ls_item, ls_meta):
+            assert item["img_name"] == meta["img_name"]
+            assert int(item["img_ori_shape"]["img_h"]) == meta["img_ori_shape"]["img_h"]
+            assert int(item["img_ori_shape"]["img_w"]) == meta["img_ori_shape"]["img_w"]
+    print("convert_dict_to_list splits the batches of 1 and 3 images.")
 
 
 def parse_args():
@@ -369,7 +781,11 @@ def parse_args():
     parser.add_argument(
         "--finetune_from", default=None, help="the checkpoint file to resume from"
     )
-    parser.add_argument("--view", action="store_true", help="whether to view")
+    parser.add_argument(
+        "--view",
+        action="store_true",
+        help="also save the image with the detected lanes drawn on it, next to the lanes of each image",
+    )
     parser.add_argument(
         "--validate",
         action="store_true",
@@ -382,6 +798,71 @@ def parse_args():
     )
     parser.add_argument("--gpus", nargs="+", type=int, default="0")
     parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="auto",
+        choices=["auto", "cuda", "cpu"],
+        help="run CLRNet on the GPUs or on CPU; auto uses the GPUs if available",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=24,
+        help="the number of images inferred at a time",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="the intra-op threads of torch on CPU",
+    )
+    parser.add_argument(
+        "--num_interop_threads",
+        type=int,
+        default=None,
+        help="the inter-op threads of torch on CPU",
+    )
+    parser.add_argument(
+        "--writer_workers",
+        type=int,
+        default=2,
+        help="the number of threads saving the lanes and the visualization while the network infers",
+    )
+    parser.add_argument(
+        "--exported_model",
+        type=str,
+        default=None,
+        help="the network exported by export_lane.py (.onnx or .pt), run on CPU instead of the eager network",
+    )
+    parser.add_argument(
+        "--full_decode",
+        action="store_true",
+        help="decode the images at full resolution before resizing them to the input of the model",
+    )
+    parser.add_argument(
+        "--no_worker",
+        action="store_true",
+        help="always build the network in this process, even if a model worker is running",
+    )
+    parser.add_argument(
+        "--worker_address",
+        type=str,
+        default=DEFAULT_ADDRESS,
+        help="the address of the model worker, see model_worker.py",
+    )
+    parser.add_argument(
+        "--lane_format",
+        type=str,
+        default="npy",
+        choices=list(LANE_FORMATS),
+        help="save the lanes of each image as a .lines.npy array, or as the legacy .lines.txt",
+    )
+    parser.add_argument(
+        "--self_check",
+        action="store_true",
+        help="check the batching of the image metas, without the model, and exit",
+    )
     args = parser.parse_args()
 
     return args
@@ -389,20 +870,33 @@ def parse_args():
 
 def main():
     args = parse_args()
-    os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(str(gpu) for gpu in args.gpus)
-
-    cfg = Config.fromfile(args.config)
-    cfg.gpus = len(args.gpus)
-
-    cfg.load_from = args.load_from
+    if args.self_check:
+        check_convert_dict_to_list()
+        return
+    cfg = load_cfg(
+        args.config,
+        load_from=args.load_from,
+        gpus=args.gpus,
+        view=args.view,
+        seed=args.seed,
+        work_dirs=args.work_dirs,
+        lane_format=args.lane_format,
+        device=args.device,
+        batch_size=args.batch_size,
+        num_threads=args.num_threads,
+        num_interop_threads=args.num_interop_threads,
+        reduced_decode=not args.full_decode,
+        writer_workers=args.writer_workers,
+        exported_model=args.exported_model,
+    )
     cfg.resume_from = args.resume_from
     cfg.finetune_from = args.finetune_from
-    cfg.view = args.view
-    cfg.seed = args.seed
 
-    cfg.work_dirs = args.work_dirs if args.work_dirs else cfg.work_dirs
-
-    cudnn.benchmark = True
+    client = None if args.no_worker else connect_lane_worker(cfg, address=args.worker_address)
+    if client is not None:
+        print(f"Detecting the lanes with the model worker at {args.worker_address}")
+        infer_with_worker(client, cfg, IMAGE_DIR, LANE_DETECTION_RESULT_SAVE_DIR)
+        return
 
     runner = MyClrnetRunner(cfg)
 
@@ -1,9 +1,16 @@
 import os
 import cv2
+import numpy as np
 from tqdm import tqdm
 import yaml
 import json
 import copy
+import time
+import shutil
+import argparse
+import itertools
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from pprint import pprint
 
@@ -17,7 +24,22 @@ from trafficcomposer.gen_visual_ir.config_visual import (
     OBJ_DETECTION_RESULT_LOAD_DIR,
     VISUAL_IR_SAVE_DIR,
 )
-from utils import is_image_file
+from trafficcomposer.ir_store import (
+    open_ir_writer,
+    next_shard_index,
+    list_saved_scene_ids,
+)
+from trafficcomposer.ir_manifest import BuildManifest, hash_inputs, code_version
+from utils import SceneIndex
+from lane_assigner import LaneAssigner
+from lane_io import load_lanes, LANE_FILE_SUFFIXES
+from yolo_label import load_yolo_labels, xywhn_to_xyxy, class_name_array
+from image_size import ImageSizeReader, IMAGE_SIZES_FILE_NAME
+from debug_visualizer import DebugVisualizer
+from actor_filter import allowed_class_ids, filter_labels, ACTOR_TYPES, ROI_MODES
+
+# ## resolved next to this file, so the generator can be built from any working directory, e.g., in `pipeline.py`
+COCO_YAML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "coco.yaml")
 
 
 class VisualIRGenerator(object):
@@ -31,34 +53,73 @@ class VisualIRGenerator(object):
         lane_detection_dir=LANE_DETECTION_RESULT_LOAD_DIR,
         obj_detection_dir=OBJ_DETECTION_RESULT_LOAD_DIR,
         save_dir=VISUAL_IR_SAVE_DIR,
+        ir_format="yaml",
+        ir_layout="files",
+        incremental=False,
+        debug_dir=None,
+        debug_sample_rate=1.0,
+        actor_types=None,
     ):
-        assert os.path.isdir(source_img_dir), f"{source_img_dir} is not a directory."
-        assert os.path.isdir(
-            lane_detection_dir
-        ), f"{lane_detection_dir} is not a directory."
-        assert os.path.isdir(
-            obj_detection_dir
-        ), f"{obj_detection_dir} is not a directory."
+        """
+        To generate the visual IR of single scenes in memory with `gen_visual_ir`, all the directories can be None.
+        ir_format: str, the format of the saved visual IRs, one of `ir_io.IR_FORMATS`.
+        ir_layout: str, save one visual IR file per scene ("files") or pack them into shards ("shard").
+        incremental: bool, keep the existing save_dir and only recompute the scenes whose lane or label file changed, see `ir_manifest`.
+        debug_dir: str, render the lane lines and the actors of each scene to debug_dir/<scene id>.jpg in the background, see `debug_visualizer`.
+        debug_sample_rate: float, the fraction of the scenes rendered to debug_dir.
+        actor_types: list of str, only keep the actors of these types, see `actor_filter.ACTOR_TYPES`; None to keep all the COCO classes.
+        """
+        for dir_path in (source_img_dir, lane_detection_dir, obj_detection_dir):
+            assert dir_path is None or os.path.isdir(
+                dir_path
+            ), f"{dir_path} is not a directory."
 
         self.source_img_dir = source_img_dir
         self.lane_detection_dir = lane_detection_dir
         self.obj_detection_dir = obj_detection_dir
 
-        with open("coco.yaml", "r") as f:
+        with open(COCO_YAML_PATH, "r") as f:
             self.dct_coco = yaml.load(f, Loader=yaml.FullLoader)["names"]
+        # ## {class id: class name} as an array, to look up the classes of all the actors of an image at once
+        self.arr_coco_names = class_name_array(self.dct_coco)
+        self.actor_types = actor_types
+        self.class_ids = (
+            None
+            if actor_types is None
+            else allowed_class_ids(self.dct_coco, actor_types)
+        )
+
+        # ## The image sizes recorded by `extract_actor.py` if any, or else read from the image headers
+        self.image_size_reader = ImageSizeReader(
+            None
+            if obj_detection_dir is None
+            else os.path.join(obj_detection_dir, IMAGE_SIZES_FILE_NAME)
+        )
 
         self.save_dir = save_dir
-        self.build_save_dir(save_dir)
+        self.ir_format = ir_format
+        self.ir_layout = ir_layout
+        self.incremental = incremental
+        if save_dir is not None:
+            if incremental:
+                os.makedirs(save_dir, exist_ok=True)
+            else:
+                self.build_save_dir(save_dir)
 
         self.debug = True
+        self.debug_dir = debug_dir
+        self.debug_sample_rate = debug_sample_rate
+        self.visualizer = (
+            None
+            if debug_dir is None
+            else DebugVisualizer(debug_dir, sample_rate=debug_sample_rate)
+        )
 
     def build_save_dir(self, save_dir):
         if os.path.exists(save_dir):
-            # If the save_dir exists, delete it and create a new one.
-            input(
-                f"WARNING: {save_dir} already exists. Press Enter to delete it and create a new one."
-            )
-            os.system(f"rm -rf {save_dir}")
+            # If the save_dir exists, delete it and create a new one, without prompting, so the stage can run unattended.
+            print(f"WARNING: {save_dir} already exists. Deleting it...")
+            shutil.rmtree(save_dir)
 
         # If the save_dir does not exist, simply create it.
         os.makedirs(save_dir)
@@ -274,98 +335,55 @@ class VisualIRGenerator(object):
             return False, (x_line_anchor, y_line_anchor)
 
     def gen_visual_ir(
-        self, source_img_path, lane_detection_file_name, obj_detection_file_name
+        self, source_img_path, lane_detection_fp, obj_detection_fp, img_size=None
     ):
         """
-        yolo_item: str following the format "[class] [x_center_normalized] [y_center_normalized] [width_normalized] [height_normalized]"
+        Generate the visual IR of one scene.
+        lane_detection_fp: str, the path to the lane detection result; or list of np.ndarray of shape (num_points, 2), the lanes in pixels, e.g., returned by `ClrnetLaneDetector`
+        obj_detection_fp: str, the path to the YOLO label file; or np.ndarray of shape (num_actors, 5), the labels, e.g., returned by `YoloActorDetector`
+        img_size: (img_h, img_w) if known, e.g., from the YOLO results; or else read from the image header
+        return: dict, {lane_idx: [(actor_class_name_in_coco_dataset, actor_xyxy), ...]}, which can be passed to `TrafficComposer.align_two_modalities` directly
+        xyxy: list of int, [x1, y1, x2, y2], the box of the actor in pixels
+        The actors of each lane are sorted by the bottom y of their boxes in descending order, i.e., from the nearest to the farthest, see `lane_actor_index`.
         0/0 -----> x axis
         |
         |
         v
         y axis
         """
-        img = cv2.imread(source_img_path)
-        img_h, img_w = img.shape[:2]
-
-        # ## load the lane detection results
-        with open(
-            os.path.join(self.lane_detection_dir, lane_detection_file_name), "r"
-        ) as f:
-            ls_lines_raw = f.readlines()
-
-        # ## extract all the lines
-        ls_lines = []
-        for line in ls_lines_raw:
-            line = line.strip("\n")
-            ls_line = line.split(" ")
+        img_h, img_w = (
+            self.image_size_reader(source_img_path) if img_size is None else img_size
+        )
 
-            ls_line = [int(float(x)) for x in ls_line]
-            ls_line_coor = list(zip(ls_line[0::2], ls_line[1::2]))
-            ls_lines.append(ls_line_coor)
+        # ## load all the lines from the lane detection results, in integer pixels
+        if isinstance(lane_detection_fp, str):
+            lane_detection_fp = load_lanes(lane_detection_fp)
+        ls_lines = [
+            np.asarray(lane).astype(np.int64)
+            for lane in lane_detection_fp
+            if len(lane) > 0
+        ]
 
         # ## rank the lines from left to right
         ls_lines.sort(key=lambda x: x[0][0])
 
-        # ## load the actor detection results
-        with open(
-            os.path.join(self.obj_detection_dir, obj_detection_file_name), "r"
-        ) as f:
-            ls_actors_raw = f.readlines()
-        ls_actors_raw = [x.strip("\n") for x in ls_actors_raw]
-
-        # ## assign lane for each actor
-        dct_lane2actor = {}  # {lane_idx: [actor_yolo_item]}
-        for actor_yolo_item in ls_actors_raw:
-            # ## actor_yolo_item: str following the format "[class] [x_center_normalized] [y_center_normalized] [width_normalized] [height_normalized]"
-            single_actor_info_ls = actor_yolo_item.split(" ")
-
-            xywhn = (
-                float(single_actor_info_ls[1]),
-                float(single_actor_info_ls[2]),
-                float(single_actor_info_ls[3]),
-                float(single_actor_info_ls[4]),
-            )
-            xyxyn = (
-                xywhn[0] - xywhn[2] / 2,
-                xywhn[1] - xywhn[3] / 2,
-                xywhn[0] + xywhn[2] / 2,
-                xywhn[1] + xywhn[3] / 2,
-            )
-            xyxy = (
-                int(xyxyn[0] * img_w),
-                int(xyxyn[1] * img_h),
-                int(xyxyn[2] * img_w),
-                int(xyxyn[3] * img_h),
-            )
-
-            coord_left_bottom = (xyxy[0], xyxy[3])
-            coord_right_bottom = (xyxy[2], xyxy[3])
-
-            if self.debug:
-                tmp_img = copy.deepcopy(img)
-                tmp_img = self.visualize_obj_bbox(tmp_img, xyxy)
-                cv2.imwrite("tmp.png", tmp_img)
-                print(f"Processing Object: {actor_yolo_item}")
-
-            # ## assign the lane index for the vehicle
-            lane_idx = self.assign_actor2lane(
-                coord_left_bottom, coord_right_bottom, ls_lines
-            )
-
-            if lane_idx is not None:
-                # ## assign vehicle to the lane
-                if lane_idx not in dct_lane2actor:
-                    dct_lane2actor[lane_idx] = [actor_yolo_item]
-                else:
-                    dct_lane2actor[lane_idx].append(actor_yolo_item)
-            else:
-                print("Cannot find the lane for the vehicle")
-                # ## for visualization
-                if self.debug:
-                    cv2.circle(img, coord_left_bottom, 50, (0, 255, 0), -1)
-                    cv2.circle(img, coord_right_bottom, 50, (0, 255, 0), -1)
-                    cv2.imwrite("tmp.png", img)
-                    input("Press Enter to continue...")
+        # ## load the actor detection results, [class, x_center, y_center, width, height] per row, see `yolo_label`
+        if isinstance(obj_detection_fp, str):
+            arr_labels = load_yolo_labels(obj_detection_fp)
+        else:
+            arr_labels = np.asarray(obj_detection_fp, dtype=np.float64).reshape(-1, 5)
+        if self.class_ids is not None:
+            arr_labels = filter_labels(arr_labels, self.class_ids)
+        if self.debug:
+            for row in arr_labels:
+                print(f"Processing Object: {row}")
+
+        # ## compute the boxes and the bottom corners of all the actors at once
+        arr_xyxy = xywhn_to_xyxy(arr_labels[:, 1:5], img_w, img_h)
+        ls_xyxy = arr_xyxy.tolist()
+        ls_class_name = self.arr_coco_names[arr_labels[:, 0].astype(np.int64)].tolist()
+        arr_left_bottom = arr_xyxy[:, [0, 3]]
+        arr_right_bottom = arr_xyxy[:, [2, 3]]
 
         # ## Assign lane to ego vehicle
         x_middle = img_w // 2
@@ -373,9 +391,30 @@ class VisualIRGenerator(object):
         ego_vehicle_width = img_w // 10
         ego_left_bottom = (x_middle - ego_vehicle_width // 2, y_bottom)
         ego_right_bottom = (x_middle + ego_vehicle_width // 2, y_bottom)
-        ego_line_idx = self.assign_actor2lane(
-            ego_left_bottom, ego_right_bottom, ls_lines
+
+        # ## assign the lane index for all the actors and the ego vehicle in one batch
+        lane_assigner = LaneAssigner(ls_lines)
+        ls_lane_idx = lane_assigner.assign(
+            np.vstack([arr_left_bottom, [ego_left_bottom]]),
+            np.vstack([arr_right_bottom, [ego_right_bottom]]),
         )
+        ego_line_idx = ls_lane_idx.pop()
+
+        # ## assign lane for each actor
+        dct_lane2actor_clsnm = (
+            {}
+        )  # {lane_idx: [(actor_class_name_in_coco_dataset, actor_xyxy), ...]}
+        for actor_class_name, actor_xyxy, lane_idx in zip(
+            ls_class_name, ls_xyxy, ls_lane_idx
+        ):
+            if lane_idx is not None:
+                # ## assign vehicle to the lane
+                dct_lane2actor_clsnm.setdefault(lane_idx, []).append(
+                    (actor_class_name, actor_xyxy)
+                )
+            else:
+                # ## marked in red by the debug visualizer
+                print("Cannot find the lane for the vehicle")
 
         # # # ## Select the lane with the maximum horizontal line
         # # left_line = ls_lines[0]
@@ -384,81 +423,353 @@ class VisualIRGenerator(object):
         # # right_line_y_max = max([y for x, y in right_lines])
         # # line_y_max = max(left_line_y_max, right_line_y_max)
 
-        # ## Post-processing
-        # ## assign vehicle type to each vehicle
-        # print(dct_lane_vehicle)
-        dct_lane2actor_clsnm = (
-            {}
-        )  # {lane_idx: [(actor_class_name_in_coco_dataset, actor_yolo_item), ...]}
-        for lane in list(dct_lane2actor.keys()):
-            dct_lane2actor_clsnm[lane] = []
-            for actor_yolo_item in dct_lane2actor[lane]:
-                actor_class_name = self.dct_coco[int(actor_yolo_item.split(" ")[0])]
-                dct_lane2actor_clsnm[lane].append((actor_class_name, actor_yolo_item))
-
+        # ## The ego vehicle goes first, so it stays ahead of the actors at the same depth after sorting
+        ego_xyxy = [ego_left_bottom[0], y_bottom, ego_right_bottom[0], y_bottom]
+        ego_actor = ("ego", ego_xyxy)
         if ego_line_idx in dct_lane2actor_clsnm:
-            dct_lane2actor_clsnm[ego_line_idx].append(("ego", "ego 0 0 0 0"))
+            dct_lane2actor_clsnm[ego_line_idx].insert(0, ego_actor)
         else:
-            dct_lane2actor_clsnm[ego_line_idx] = [("ego", "ego 0 0 0 0")]
+            dct_lane2actor_clsnm[ego_line_idx] = [ego_actor]
 
-        #     cv2.imwrite("tmp.png", img)
+        # ## sort the actors of each lane from the nearest to the farthest by the bottom y of their boxes
+        for lane in dct_lane2actor_clsnm:
+            dct_lane2actor_clsnm[lane].sort(key=lambda actor: -actor[1][3])
+
+        if self.visualizer is not None:
+            self.visualizer.submit(
+                source_img_path, ls_lines, ls_xyxy, ls_lane_idx, ego_xyxy
+            )
 
         print(dct_lane2actor_clsnm)
         return dct_lane2actor_clsnm
 
-    def main(self):
+    def main(self, workers=1, chunk_size=None):
         """
         The main function to generate_visual_ir.
         Itereate over all the images in the source_img_dir, locte the corresponding lane detection results and object detection results, and assign the lane index for each vehicle.
+        workers: int, the number of worker processes. 1 runs the generation in the current process.
+        chunk_size: int, the number of scenes submitted to a worker process at a time. By default, every worker receives about 4 chunks.
         """
 
-        ls_source_img_names = os.listdir(self.source_img_dir)
-        ls_source_img_names = [x for x in ls_source_img_names if is_image_file(x)]
-        ls_source_img_names.sort()
+        # ## pair the image, the lane detection results and the object detection results by scene id
+        scene_index = SceneIndex(
+            {
+                "image": (self.source_img_dir, None),
+                "lane": (self.lane_detection_dir, LANE_FILE_SUFFIXES),
+                "label": (self.obj_detection_dir, ".txt"),
+            }
+        )
+        scene_index.report_incomplete()
+
+        # ## tasks: (scene_id, source_img_path, lane_detection_fp, obj_detection_fp, input_hash)
+        ls_tasks = [(*scene, None) for scene in scene_index]
+        if self.incremental:
+            manifest = BuildManifest(self.save_dir, self.version())
+            set_saved_scene_ids = list_saved_scene_ids(self.save_dir)
+            ls_tasks = [
+                (*task[:4], input_hash)
+                for task in ls_tasks
+                # ## the image size is an input too, from the sidecar of `extract_actor.py` or the image header
+                for input_hash in [
+                    hash_inputs(task[2], task[3], list(self.image_size_reader(task[1])))
+                ]
+                if not (
+                    task[0] in set_saved_scene_ids
+                    and manifest.is_up_to_date(task[0], input_hash)
+                )
+            ]
+        num_skipped = len(scene_index) - len(ls_tasks)
+
+        # ## In the shard layout, the new shards shadow the visual IRs of the recomputed scenes in the existing shards
+        shard_idx_base = next_shard_index(self.save_dir)
+
+        t_start = time.time()
+        if workers <= 1:
+            with open_ir_writer(
+                self.save_dir,
+                fmt=self.ir_format,
+                layout=self.ir_layout,
+                shard_name=f"part-{shard_idx_base:05d}",
+            ) as writer:
+                for (
+                    scene_id,
+                    source_img_path,
+                    lane_detection_fp,
+                    obj_detection_fp,
+                    input_hash,
+                ) in tqdm(ls_tasks, total=len(ls_tasks)):
+                    visual_ir = self.gen_visual_ir(
+                        source_img_path, lane_detection_fp, obj_detection_fp
+                    )
+                    writer.write(scene_id, visual_ir)
+
+                    if self.incremental:
+                        manifest.update(scene_id, input_hash)
+        else:
+            self.main_parallel(
+                ls_tasks,
+                workers,
+                chunk_size,
+                shard_idx_base,
+                manifest if self.incremental else None,
+            )
+        wall_time = time.time() - t_start
+        print(
+            f"Generated {len(ls_tasks)} visual IRs with {max(workers, 1)} workers in {wall_time:.2f}s "
+            f"({len(ls_tasks) / max(wall_time, 1e-9):.1f} scenes/s)"
+        )
 
-        # ## load the lane detection results name list
-        ls_lane_detection_files = os.listdir(self.lane_detection_dir)
-        ls_lane_detection_files = [
-            x for x in ls_lane_detection_files if x.endswith(".lines.txt")
-        ]
-        ls_lane_detection_files.sort()
+        if self.visualizer is not None:
+            # ## wait for the pending debug images
+            self.visualizer.close()
 
-        # ## load the object detection results name list
-        ls_obj_detection_files = os.listdir(self.obj_detection_dir)
-        ls_obj_detection_files = [
-            x for x in ls_obj_detection_files if x.endswith(".txt")
-        ]
-        ls_obj_detection_files.sort()
-
-        for idx, source_img_name in enumerate(tqdm(ls_source_img_names)):
-            source_img_name_no_ext = ".".join(source_img_name.split(".")[:-1])
-            source_img_path = os.path.join(self.source_img_dir, source_img_name)
-
-            # ## locate the lane detection results
-            lane_detection_file_name = ls_lane_detection_files[idx]
-            assert lane_detection_file_name.startswith(
-                f"{source_img_name_no_ext}."
-            ), f"{lane_detection_file_name} does not match {source_img_name}"
-
-            # ## locate the actor detection results
-            obj_detection_file_name = ls_obj_detection_files[idx]
-            assert obj_detection_file_name.startswith(
-                f"{source_img_name_no_ext}."
-            ), f"{obj_detection_file_name} does not match {source_img_name}"
-
-            visual_ir = self.gen_visual_ir(
-                source_img_path, lane_detection_file_name, obj_detection_file_name
+        if self.incremental:
+            manifest.retain(scene_id for scene_id, *_ in scene_index)
+            manifest.save()
+            print(f"{num_skipped} scenes are up to date and skipped.")
+
+    def main_parallel(self, ls_tasks, workers, chunk_size, shard_idx_base, manifest):
+        """
+        Generate the visual IRs of the tasks with a process pool, see `main`
+        manifest: BuildManifest or None, updated with the input hashes of the finished chunks
+        """
+        num_scenes = len(ls_tasks)
+
+        # ## Every chunk is written to its own files or shard named by the chunk index,
+        # ## so the output does not depend on the completion order
+        if chunk_size is None:
+            chunk_size = max(1, num_scenes // (workers * 4))
+        iter_tasks = iter(ls_tasks)
+        iter_chunks = iter(lambda: list(itertools.islice(iter_tasks, chunk_size)), [])
+
+        dct_worker_stat = defaultdict(
+            lambda: [0, 0.0]
+        )  # {pid: [num_scenes, busy_time]}
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(self.worker_kwargs(), self.debug),
+        ) as executor:
+            dct_future2chunk = {
+                executor.submit(
+                    _gen_visual_ir_chunk,
+                    self.save_dir,
+                    self.ir_format,
+                    self.ir_layout,
+                    f"part-{shard_idx_base + chunk_idx:05d}",
+                    [task[:4] for task in chunk],
+                ): chunk
+                for chunk_idx, chunk in enumerate(iter_chunks)
+            }
+            with tqdm(total=num_scenes) as pbar:
+                for future in as_completed(dct_future2chunk):
+                    pid, num_generated, busy_time = future.result()
+                    dct_worker_stat[pid][0] += num_generated
+                    dct_worker_stat[pid][1] += busy_time
+                    pbar.update(num_generated)
+                    if manifest is not None:
+                        for scene_id, *_, input_hash in dct_future2chunk[future]:
+                            manifest.update(scene_id, input_hash)
+
+        for pid, (num_generated, busy_time) in sorted(dct_worker_stat.items()):
+            print(
+                f"  worker {pid}: {num_generated} scenes in {busy_time:.2f}s "
+                f"({num_generated / max(busy_time, 1e-9):.1f} scenes/s)"
+            )
+
+    def main_fused(self, lane_detector, obj_detector, batch_size=8):
+        """
+        Detect the lanes and the actors of the images in source_img_dir batch by batch, and pass the detection results
+        to the lane assignment in memory, without writing and reading back the intermediate detection result files.
+        lane_detector: e.g., `ClrnetLaneDetector(cfg, save_results=False)`, providing `detect_batch(ls_scene_id, ls_img_path)` -> the lanes of each image
+        obj_detector: e.g., `YoloActorDetector(save_dir=None)`, providing `detect_batch(ls_scene_id, ls_img_path)` -> (labels, (img_h, img_w)) of each image
+        The detectors still save their results for debugging if constructed with save_results=True / a save_dir.
+        """
+        # ## The incremental mode tracks the detection result files, which are not written here
+        assert (
+            not self.incremental
+        ), "The fused mode does not support the incremental mode."
+
+        ls_scene = list(SceneIndex({"image": (self.source_img_dir, None)}))
+        t_start = time.time()
+        with open_ir_writer(
+            self.save_dir,
+            fmt=self.ir_format,
+            layout=self.ir_layout,
+            shard_name=f"part-{next_shard_index(self.save_dir):05d}",
+        ) as writer:
+            for idx_start in tqdm(range(0, len(ls_scene), batch_size)):
+                ls_scene_id, ls_img_path = zip(
+                    *ls_scene[idx_start : idx_start + batch_size]
+                )
+                ls_lanes = lane_detector.detect_batch(ls_scene_id, ls_img_path)
+                if getattr(obj_detector, "roi", None) == "lanes":
+                    # ## the road region of each image from its lanes, see `actor_filter.road_roi_top`
+                    ls_labels = obj_detector.detect_batch(
+                        ls_scene_id, ls_img_path, ls_lanes=ls_lanes
+                    )
+                else:
+                    ls_labels = obj_detector.detect_batch(ls_scene_id, ls_img_path)
+                for scene_id, img_path, lanes, (arr_labels, img_size) in zip(
+                    ls_scene_id, ls_img_path, ls_lanes, ls_labels
+                ):
+                    visual_ir = self.gen_visual_ir(
+                        img_path, lanes, arr_labels, img_size=img_size
+                    )
+                    writer.write(scene_id, visual_ir)
+        wall_time = time.time() - t_start
+        print(
+            f"Detected and generated {len(ls_scene)} visual IRs in {wall_time:.2f}s "
+            f"({len(ls_scene) / max(wall_time, 1e-9):.1f} scenes/s)"
+        )
+
+        if self.visualizer is not None:
+            # ## wait for the pending debug images
+            self.visualizer.close()
+
+    def worker_kwargs(self):
+        """
+        The arguments to build the generator of a worker process, which only generates and writes the visual IRs
+        """
+        return {
+            "source_img_dir": self.source_img_dir,
+            "lane_detection_dir": self.lane_detection_dir,
+            "obj_detection_dir": self.obj_detection_dir,
+            "save_dir": None,
+            "debug_dir": self.debug_dir,
+            "debug_sample_rate": self.debug_sample_rate,
+            "actor_types": self.actor_types,
+        }
+
+    def version(self):
+        """
+        The version of the visual IRs for the incremental mode, changing with the code and the output options
+        """
+        return code_version(
+            [
+                os.path.abspath(__file__),
+                sys.modules[LaneAssigner.__module__].__file__,
+                sys.modules[load_lanes.__module__].__file__,
+                sys.modules[load_yolo_labels.__module__].__file__,
+                sys.modules[ImageSizeReader.__module__].__file__,
+                sys.modules[filter_labels.__module__].__file__,
+                COCO_YAML_PATH,
+            ],
+            {
+                "ir_format": self.ir_format,
+                "ir_layout": self.ir_layout,
+                "actor_types": self.actor_types,
+            },
+        )
+
+
+# ## The generator of the worker process, built once per worker by `_init_worker`,
+# ## so the COCO class table, the image size cache and the debug visualizer are not rebuilt per chunk
+_worker_generator = None
+
+
+def _init_worker(generator_kwargs, debug):
+    global _worker_generator
+    _worker_generator = VisualIRGenerator(**generator_kwargs)
+    _worker_generator.debug = debug
+
+
+def _gen_visual_ir_chunk(save_dir, ir_format, ir_layout, shard_name, ls_tasks):
+    """
+    Generate and write the visual IRs of a chunk of scenes in a worker process
+    return: (pid, the number of generated scenes, the time spent on the chunk)
+    """
+    t_start = time.time()
+    with open_ir_writer(
+        save_dir, fmt=ir_format, layout=ir_layout, shard_name=shard_name
+    ) as writer:
+        for scene_id, source_img_path, lane_detection_fp, obj_detection_fp in ls_tasks:
+            visual_ir = _worker_generator.gen_visual_ir(
+                source_img_path, lane_detection_fp, obj_detection_fp
             )
+            writer.write(scene_id, visual_ir)
+    if _worker_generator.visualizer is not None:
+        # ## The worker may exit once the chunk is returned
+        _worker_generator.visualizer.flush()
+    return os.getpid(), len(ls_tasks), time.time() - t_start
 
-            # ## Save results to YAML files
-            with open(
-                os.path.join(self.save_dir, f"{source_img_name_no_ext}.yaml"), "w"
-            ) as f:
-                yaml.dump(visual_ir, f)
 
-            # # ## Save results to JSON files
-            # with open(os.path.join(self.save_dir, f"{source_img_name}.json"), "w") as f:
-            #     json.dump(visual_ir, f)
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate the visual IRs from the lane and object detection results"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="the number of worker processes",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        help="the number of scenes submitted to a worker process at a time",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="run CLRNet and YOLOv10 on the images and pass their results to the lane assignment in memory, instead of reading the saved detection results",
+    )
+    parser.add_argument(
+        "--lane_config",
+        type=str,
+        default="clrnet/configs/clrnet/clr_dla34_culane.py",
+        help="the CLRNet config file, for --fused",
+    )
+    parser.add_argument(
+        "--lane_checkpoint",
+        type=str,
+        default="culane_dla34.pth",
+        help="the CLRNet checkpoint file, for --fused",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="the number of images detected at a time, for --fused",
+    )
+    parser.add_argument(
+        "--actor_backend",
+        type=str,
+        default="torch",
+        choices=["torch", "onnx", "openvino"],
+        help="run YOLOv10 eagerly, or exported to ONNX or OpenVINO on CPU, for --fused, see extract_actor.py",
+    )
+    parser.add_argument(
+        "--actor_types",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=ACTOR_TYPES,
+        help="only keep the actors of these types, e.g., --actor_types car truck bus pedestrian cyclist; all the COCO classes if not set",
+    )
+    parser.add_argument(
+        "--roi",
+        type=str,
+        default=None,
+        choices=ROI_MODES,
+        help="only detect the actors in the road region of each image, from the top of its lanes or from the --horizon row, for --fused",
+    )
+    parser.add_argument(
+        "--horizon",
+        type=float,
+        default=0.4,
+        help="the top row of the road region as a fraction of the image height, for --roi horizon",
+    )
+    parser.add_argument(
+        "--save_detections",
+        type=str,
+        default=None,
+        help="also save the detection results to this directory for debugging, for --fused",
+    )
+    args = parser.parse_args()
+
+    return args
 
 
 if __name__ == "__main__":
@@ -466,15 +777,58 @@ if __name__ == "__main__":
         OBJ_DETECTION_RESULT_SAVE_DIR,
     )
 
+    args = parse_args()
+
+    if args.fused:
+        from extract_lane import ClrnetLaneDetector, load_cfg
+        from extract_actor import YoloActorDetector
+
+        runner = VisualIRGenerator(
+            source_img_dir=IMAGE_DIR,
+            lane_detection_dir=None,
+            obj_detection_dir=None,
+            save_dir=VISUAL_IR_SAVE_DIR,
+            actor_types=args.actor_types,
+        )
+        runner.debug = False
+        lane_detector = ClrnetLaneDetector(
+            load_cfg(
+                args.lane_config,
+                load_from=args.lane_checkpoint,
+                work_dirs=(
+                    None
+                    if args.save_detections is None
+                    else os.path.join(args.save_detections, "lane")
+                ),
+            ),
+            save_results=args.save_detections is not None,
+        )
+        obj_detector = YoloActorDetector(
+            save_dir=(
+                None
+                if args.save_detections is None
+                else os.path.join(args.save_detections, "actor")
+            ),
+            backend=args.actor_backend,
+            actor_types=args.actor_types,
+            roi=args.roi,
+            horizon=args.horizon,
+        )
+        runner.main_fused(lane_detector, obj_detector, batch_size=args.batch_size)
+        sys.exit(0)
+
     runner = VisualIRGenerator(
         # source_img_dir=IMAGE_DIR,
         source_img_dir=OBJ_DETECTION_RESULT_SAVE_DIR,
         lane_detection_dir=LANE_DETECTION_RESULT_LOAD_DIR,
         obj_detection_dir=OBJ_DETECTION_RESULT_LOAD_DIR,
         save_dir=VISUAL_IR_SAVE_DIR,
+        incremental=False,  # Set to True to only recompute the scenes whose inputs changed.
+        debug_dir=None,  # Set to a directory to save the debug visualization of each scene.
+        actor_types=args.actor_types,
     )
     runner.debug = False
-    runner.main()
+    runner.main(workers=args.workers, chunk_size=args.chunk_size)
 
     # str_ret = runner.assign_vehicle_lane(is_debug=True)
     # print(f"assign_vehicle_lane: {str_ret}")
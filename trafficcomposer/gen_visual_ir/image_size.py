@@ -0,0 +1,277 @@
+"""
+Image sizes without decoding the images.
+
+`read_image_size` parses the header of a JPEG or PNG file, which is a few hundred bytes,
+instead of decoding the whole image with `cv2.imread` only to get its shape.
+The EXIF orientation of JPEG files is applied the same way as `cv2.imread` does.
+Other formats fall back to `cv2.imread`.
+
+`ImageSizeReader` caches the sizes, and first looks up the sizes recorded at detection time
+in the sidecar file `image_sizes.json` ({image file name: [height, width]}) if given.
+
+`imread_at_least` uses the size to decode a JPEG file at 1/2, 1/4 or 1/8 of its resolution
+when it is still at least the requested size, e.g., the input size of a model, which skips most
+of the decoding work of large images.
+
+Run `python image_size.py` to check the sizes against `cv2.imread` on generated images.
+"""
+
+import os
+import json
+import struct
+import threading
+
+import cv2
+
+IMAGE_SIZES_FILE_NAME = "image_sizes.json"
+
+# ## Start Of Frame markers, which hold the size of the image; 0xC4, 0xC8 and 0xCC are other segments
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# ## markers without a length field
+_JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | {0x01}
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Unexpected end of file")
+    return data
+
+
+def _exif_orientation(segment):
+    """
+    The orientation tag (0x0112) in the APP1 segment, or 1 (upright) if there is none
+    """
+    if not segment.startswith(b"Exif\x00\x00"):
+        return 1
+    tiff = segment[6:]
+    byte_order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if byte_order is None or len(tiff) < 8:
+        return 1
+    (ifd_offset,) = struct.unpack(byte_order + "I", tiff[4:8])
+    if ifd_offset + 2 > len(tiff):
+        return 1
+    (num_entries,) = struct.unpack(byte_order + "H", tiff[ifd_offset : ifd_offset + 2])
+    for entry_idx in range(num_entries):
+        entry_offset = ifd_offset + 2 + 12 * entry_idx
+        if entry_offset + 12 > len(tiff):
+            break
+        tag, _, _ = struct.unpack(
+            byte_order + "HHI", tiff[entry_offset : entry_offset + 8]
+        )
+        if tag == 0x0112:
+            (orientation,) = struct.unpack(
+                byte_order + "H", tiff[entry_offset + 8 : entry_offset + 10]
+            )
+            return orientation
+    return 1
+
+
+def _read_jpeg_size(f):
+    orientation = 1
+    while True:
+        byte = _read_exact(f, 1)
+        if byte != b"\xff":
+            raise ValueError("Invalid JPEG marker")
+        marker = _read_exact(f, 1)[0]
+        while marker == 0xFF:
+            # ## fill bytes
+            marker = _read_exact(f, 1)[0]
+        if marker in _JPEG_STANDALONE_MARKERS:
+            continue
+
+        (length,) = struct.unpack(">H", _read_exact(f, 2))
+        if marker in _JPEG_SOF_MARKERS:
+            _, img_h, img_w = struct.unpack(">BHH", _read_exact(f, 5))
+            # ## orientations 5 to 8 rotate the image by 90 degrees
+            if orientation >= 5:
+                img_h, img_w = img_w, img_h
+            return img_h, img_w
+        if marker == 0xE1:
+            orientation = _exif_orientation(_read_exact(f, length - 2))
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_size(img_path):
+    """
+    return: (img_h, img_w), the same as `cv2.imread(img_path).shape[:2]`
+    """
+    with open(img_path, "rb") as f:
+        header = f.read(24)
+        try:
+            if header.startswith(b"\xff\xd8"):
+                f.seek(2)
+                return _read_jpeg_size(f)
+            if header.startswith(_PNG_SIGNATURE) and header[12:16] == b"IHDR":
+                img_w, img_h = struct.unpack(">II", header[16:24])
+                return img_h, img_w
+        except (ValueError, struct.error):
+            pass
+
+    # ## other formats or broken headers
+    img = cv2.imread(img_path)
+    assert img is not None, f"Cannot read the image {img_path}"
+    return img.shape[:2]
+
+
+# ## (scale, flag) of the reduced decoding of `cv2.imread`, from the smallest scale
+_REDUCED_READ_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+_JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+
+def imread_at_least(img_path, min_h, min_w, img_size=None):
+    """
+    Decode the image at the smallest reduced scale that is still at least min_h x min_w.
+    Only JPEG files are decoded at a reduced scale, the other formats are decoded in full.
+    img_size: (img_h, img_w), read from the header if None
+    return: (img, (img_h, img_w)), the decoded image and the size of the original image
+    """
+    if img_size is None:
+        img_size = read_image_size(img_path)
+    img_h, img_w = img_size
+
+    flag = cv2.IMREAD_COLOR
+    if img_path.lower().endswith(_JPEG_EXTENSIONS):
+        for scale, reduced_flag in _REDUCED_READ_FLAGS:
+            # ## The reduced JPEG decoding rounds the size up
+            if img_h // scale >= min_h and img_w // scale >= min_w:
+                flag = reduced_flag
+                break
+
+    img = cv2.imread(img_path, flag)
+    assert img is not None, f"Cannot read the image {img_path}"
+    return img, img_size
+
+
+def load_image_sizes(sidecar_fp):
+    """
+    return: {image file name: (img_h, img_w)}
+    """
+    with open(sidecar_fp, "r") as f:
+        return {img_name: tuple(size) for img_name, size in json.load(f).items()}
+
+
+def save_image_sizes(dct_img_size, sidecar_fp):
+    """
+    dct_img_size: {image file name: (img_h, img_w)}
+    """
+    with open(sidecar_fp, "w") as f:
+        json.dump(
+            {img_name: list(size) for img_name, size in sorted(dct_img_size.items())}, f
+        )
+
+
+class ImageSizeReader(object):
+    """
+    The cached sizes of the images, from the sidecar file if given, or else from the image headers
+    """
+
+    def __init__(self, sidecar_fp=None):
+        self.dct_sidecar = {}
+        if sidecar_fp is not None and os.path.exists(sidecar_fp):
+            self.dct_sidecar = load_image_sizes(sidecar_fp)
+        self.dct_cache = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, img_path):
+        """
+        return: (img_h, img_w)
+        """
+        img_name = os.path.basename(img_path)
+        if img_name in self.dct_sidecar:
+            return self.dct_sidecar[img_name]
+        with self.lock:
+            if img_path in self.dct_cache:
+                return self.dct_cache[img_path]
+        img_size = read_image_size(img_path)
+        with self.lock:
+            self.dct_cache[img_path] = img_size
+        return img_size
+
+
+if __name__ == "__main__":
+    import time
+    import shutil
+    import tempfile
+
+    import numpy as np
+
+    def add_exif_orientation(jpeg_bytes, orientation):
+        # ## a minimal little-endian TIFF with a single IFD entry: the orientation
+        tiff = b"II*\x00" + struct.pack("<I", 8) + struct.pack("<H", 1)
+        tiff += struct.pack("<HHIHH", 0x0112, 3, 1, orientation, 0) + b"\x00" * 4
+        segment = b"Exif\x00\x00" + tiff
+        app1 = b"\xff\xe1" + struct.pack(">H", len(segment) + 2) + segment
+        return jpeg_bytes[:2] + app1 + jpeg_bytes[2:]
+
+    rng = np.random.default_rng(0)
+    tmp_dir = tempfile.mkdtemp()
+    ls_img_path = []
+    for idx in range(40):
+        img_h, img_w = rng.integers(1, 600, size=2)
+        img = rng.integers(0, 255, size=(img_h, img_w, 3), dtype=np.uint8)
+        ext = [".jpg", ".png", ".jpg"][idx % 3]
+        params = []
+        if ext == ".jpg" and idx % 2 == 0:
+            params = [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+        ok, buf = cv2.imencode(ext, img, params)
+        data = buf.tobytes()
+        if idx % 3 == 2:
+            data = add_exif_orientation(data, int(rng.integers(1, 9)))
+        img_path = os.path.join(tmp_dir, f"{idx:04d}{ext}")
+        with open(img_path, "wb") as f:
+            f.write(data)
+        ls_img_path.append(img_path)
+
+    for img_path in ls_img_path:
+        expected = cv2.imread(img_path).shape[:2]
+        assert read_image_size(img_path) == expected, (img_path, expected)
+    print(f"read_image_size matches cv2.imread on {len(ls_img_path)} images.")
+
+    # ## timing on a 4K JPEG, smooth like a photo rather than noise
+    img_4k_path = os.path.join(tmp_dir, "4k.jpg")
+    img_small = rng.integers(0, 255, size=(54, 96, 3), dtype=np.uint8)
+    cv2.imwrite(
+        img_4k_path,
+        cv2.resize(img_small, (3840, 2160), interpolation=cv2.INTER_CUBIC),
+    )
+    for name, fn in [
+        ("cv2.imread", lambda: cv2.imread(img_4k_path).shape[:2]),
+        ("read_image_size", lambda: read_image_size(img_4k_path)),
+    ]:
+        t_start = time.time()
+        for _ in range(20):
+            fn()
+        print(f"{name}: {(time.time() - t_start) / 20 * 1000:.3f} ms per 4K JPEG")
+
+    # ## reduced decoding for the input of CLRNet on CULane, 1640 x 590
+    for img_path in ls_img_path:
+        img, img_size = imread_at_least(img_path, 100, 150)
+        assert img_size == cv2.imread(img_path).shape[:2]
+        assert img.shape[0] >= min(100, img_size[0]) and img.shape[1] >= min(
+            150, img_size[1]
+        ), (img_path, img.shape)
+    for name, fn in [
+        (
+            "cv2.imread + cv2.resize",
+            lambda: cv2.resize(cv2.imread(img_4k_path), (1640, 590)),
+        ),
+        (
+            "imread_at_least + cv2.resize",
+            lambda: cv2.resize(imread_at_least(img_4k_path, 590, 1640)[0], (1640, 590)),
+        ),
+    ]:
+        t_start = time.time()
+        for _ in range(20):
+            fn()
+        print(
+            f"{name}: {(time.time() - t_start) / 20 * 1000:.3f} ms per 4K JPEG to 1640 x 590"
+        )
+
+    shutil.rmtree(tmp_dir)
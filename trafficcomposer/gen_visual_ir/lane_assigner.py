@@ -0,0 +1,225 @@
+"""
+NumPy-backed lane assignment.
+
+`LaneAssigner` holds the lane dividing lines of one image as padded arrays and assigns
+all the actors of the image to lanes in one batch. It reproduces the anchor-point search
+of `VisualIRGenerator.is_point_on_left` / `is_point_on_right` and the decision rules of
+`VisualIRGenerator.assign_actor2lane`, so the lane indices are identical to the scalar
+implementation, including the -1 (left of the leftmost line), `len(ls_lines) - 1`
+(right of the rightmost line) and `None` (undecidable) cases.
+
+Run `python lane_assigner.py` to check the equivalence against the scalar implementation
+on randomly generated scenes.
+"""
+
+import numpy as np
+
+
+class LaneAssigner(object):
+    """
+    Lane lines of a single image, stored as arrays
+
+        xs, ys: np.ndarray of shape (num_lines, max_num_points), padded with NaN
+        lengths: np.ndarray of shape (num_lines,), the number of points in each line
+
+    The lines are kept in the given order, i.e., the caller is expected to rank them from
+    left to right beforehand, as `VisualIRGenerator.gen_visual_ir` does.
+    """
+
+    def __init__(self, ls_lines):
+        """
+        ls_lines: list of lines, each being a list of tuples [(x1, y1), (x2, y2), ...]
+            y1 > y2 > y3 > ...
+        """
+        self.num_lines = len(ls_lines)
+        self.lengths = np.array([len(line) for line in ls_lines], dtype=np.int64)
+        assert np.all(
+            self.lengths > 0
+        ), "Every lane line should have at least one point"
+
+        max_num_points = int(self.lengths.max()) if self.num_lines > 0 else 0
+        self.xs = np.full((self.num_lines, max_num_points), np.nan)
+        self.ys = np.full((self.num_lines, max_num_points), np.nan)
+        for line_idx, line in enumerate(ls_lines):
+            arr_line = np.asarray(line, dtype=np.float64).reshape(-1, 2)
+            self.xs[line_idx, : len(arr_line)] = arr_line[:, 0]
+            self.ys[line_idx, : len(arr_line)] = arr_line[:, 1]
+
+        self._line_ids = np.arange(self.num_lines)[None, :]
+
+    def _search_anchor(self, y):
+        """
+        Search the anchor point of every query y in every line.
+
+        The anchor is the first point in the line strictly above y (smaller y value).
+        If there is none, the last point at exactly y is used; if there is still none,
+        the last point of the line is used.
+        y: np.ndarray of shape (num_actors,)
+        return:
+            anchor_idx: np.ndarray of shape (num_actors, num_lines)
+            has_above: bool np.ndarray of shape (num_actors, num_lines)
+            has_equal: bool np.ndarray of shape (num_actors, num_lines)
+        """
+        # ## NaN padding compares False, so the padded points are never selected
+        ys = self.ys[None, :, :]
+        y = y[:, None, None]
+        max_num_points = self.ys.shape[1]
+
+        mask_above = ys < y
+        has_above = mask_above.any(axis=-1)
+        first_above = mask_above.argmax(axis=-1)
+
+        mask_equal = ys == y
+        has_equal = mask_equal.any(axis=-1)
+        last_equal = max_num_points - 1 - mask_equal[..., ::-1].argmax(axis=-1)
+
+        last_point = np.broadcast_to(self.lengths[None, :] - 1, has_above.shape)
+
+        anchor_idx = np.where(
+            has_above, first_above, np.where(has_equal, last_equal, last_point)
+        )
+        return anchor_idx, has_above, has_equal
+
+    def is_point_on_left(self, coords):
+        """
+        Batched version of `VisualIRGenerator.is_point_on_left`
+        coords: array-like of shape (num_actors, 2), the (x, y) of the query points
+        return:
+            is_on_left: bool np.ndarray of shape (num_actors, num_lines)
+            anchor_y: np.ndarray of shape (num_actors, num_lines), NaN if the anchor y is None
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        x, y = coords[:, 0], coords[:, 1]
+
+        anchor_idx, has_above, has_equal = self._search_anchor(y)
+        anchor_x = self.xs[self._line_ids, anchor_idx]
+        anchor_y = self.ys[self._line_ids, anchor_idx]
+
+        is_on_left = x[:, None] <= anchor_x
+        # ## Matching the scalar version, a point with the same y does not register the anchor y
+        anchor_y = np.where(~has_above & has_equal, np.nan, anchor_y)
+        return is_on_left, anchor_y
+
+    def is_point_on_right(self, coords):
+        """
+        Batched version of `VisualIRGenerator.is_point_on_right`
+        coords: array-like of shape (num_actors, 2), the (x, y) of the query points
+        return:
+            is_on_right: bool np.ndarray of shape (num_actors, num_lines)
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        x, y = coords[:, 0], coords[:, 1]
+
+        anchor_idx, _, _ = self._search_anchor(y)
+        anchor_x = self.xs[self._line_ids, anchor_idx]
+
+        # ## The bottom point of the line is higher than the coord point
+        is_at_edge = self.ys[None, :, 0] < y[:, None]
+        return is_at_edge | (x[:, None] >= anchor_x)
+
+    def assign(self, coords_left_bottom, coords_right_bottom):
+        """
+        Batched version of `VisualIRGenerator.assign_actor2lane`
+        coords_left_bottom: array-like of shape (num_actors, 2)
+        coords_right_bottom: array-like of shape (num_actors, 2)
+        return: list of int or None, the lane index of each actor
+        """
+        coords_left_bottom = np.asarray(coords_left_bottom, dtype=np.float64).reshape(
+            -1, 2
+        )
+        coords_right_bottom = np.asarray(coords_right_bottom, dtype=np.float64).reshape(
+            -1, 2
+        )
+        num_actors = len(coords_left_bottom)
+        if self.num_lines == 0:
+            return [-1] * num_actors
+
+        actor_ids = np.arange(num_actors)
+
+        # ## iterate from the left to the right
+        is_on_left, left_anchor_y = self.is_point_on_left(coords_left_bottom)
+        has_line_on_right = is_on_left.any(axis=1)
+        line_idx_on_point_right = is_on_left.argmax(axis=1)
+        left_line_anchor_y = left_anchor_y[actor_ids, line_idx_on_point_right]
+
+        # ## iterate from the right to the left
+        is_on_right = self.is_point_on_right(coords_right_bottom)
+        has_line_on_left = is_on_right.any(axis=1)
+        line_idx_on_point_left = (
+            self.num_lines - 1 - is_on_right[:, ::-1].argmax(axis=1)
+        )
+
+        r = line_idx_on_point_right
+        l = line_idx_on_point_left
+        lane_idx = np.full(num_actors, -2, dtype=np.int64)
+        is_assigned = np.zeros(num_actors, dtype=bool)
+
+        def _set(mask, value):
+            mask = mask & ~is_assigned
+            lane_idx[mask] = value[mask] if isinstance(value, np.ndarray) else value
+            is_assigned[mask] = True
+
+        # ## The vehicle is on the right side of the rightmost lane
+        _set(~has_line_on_right, self.num_lines - 1)
+        # ## The vehicle is on the left side of the leftmost lane
+        _set(~has_line_on_left, -1)
+
+        # ## The vehicle is on the lane dividing line line_idx_on_point_right
+        on_line = (r == l) & ~np.isnan(left_line_anchor_y)
+        dist_up = left_line_anchor_y - coords_left_bottom[:, 1]
+        dist_down = coords_right_bottom[:, 1] - left_line_anchor_y
+        _set(on_line & (dist_up > dist_down), r - 1)
+        _set(on_line & (dist_up <= dist_down), r)
+
+        _set(l - r == 1, r)
+        _set(r - l == 1, l)
+        _set(l - r > 1, r + 1)
+
+        return [int(x) if ok else None for x, ok in zip(lane_idx, is_assigned)]
+
+
+if __name__ == "__main__":
+    import io
+    import random
+    import contextlib
+
+    from gen_visual_ir import VisualIRGenerator
+
+    def random_line(rng, img_h, img_w):
+        num_points = rng.randint(1, 18)
+        y_start = rng.randint(img_h // 2, img_h + 50)
+        ys = [y_start - 20 * i for i in range(num_points)]
+        x_start, slope = rng.randint(-100, img_w + 100), rng.uniform(-2, 2)
+        return [(int(x_start + slope * (y_start - y)), y) for y in ys]
+
+    rng = random.Random(0)
+    num_checked = 0
+    for _ in range(2000):
+        img_h, img_w = 590, 1640
+        ls_lines = [random_line(rng, img_h, img_w) for _ in range(rng.randint(0, 6))]
+        ls_lines.sort(key=lambda x: x[0][0])
+
+        coords_left_bottom, coords_right_bottom = [], []
+        for _ in range(rng.randint(1, 40)):
+            x1, x2 = sorted(rng.randint(-50, img_w + 50) for _ in range(2))
+            # ## pick y on the sampled rows half of the time to cover the equality cases
+            y = rng.choice([rng.randint(0, img_h + 60), 20 * rng.randint(0, 32)])
+            coords_left_bottom.append((x1, y))
+            coords_right_bottom.append((x2, y))
+
+        ls_expected = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for coord_left, coord_right in zip(coords_left_bottom, coords_right_bottom):
+                ls_expected.append(
+                    VisualIRGenerator.assign_actor2lane(
+                        VisualIRGenerator, coord_left, coord_right, ls_lines
+                    )
+                )
+
+        ls_actual = LaneAssigner(ls_lines).assign(
+            coords_left_bottom, coords_right_bottom
+        )
+        assert ls_actual == ls_expected, f"{ls_lines}\n{ls_actual}\n{ls_expected}"
+        num_checked += len(ls_expected)
+
+    print(f"LaneAssigner matches assign_actor2lane on {num_checked} actors.")
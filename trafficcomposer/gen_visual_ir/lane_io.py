@@ -0,0 +1,198 @@
+"""
+Lane detection results on disk.
+
+`extract_lane.py` saves the lanes of each image next to its visualization as
+    - `<image name>.lines.npy` (default): a float32 array of shape (num_points, 3), one row
+      [lane index, x, y] per point, the points of each lane consecutive and in the lane order
+    - `<image name>.lines.txt` (legacy): one lane per line, "x1 y1 x2 y2 ..." with 5 decimals
+`load_lanes` reads both formats, so the results saved by older versions are still accepted.
+
+The text format costs a string format per point when saving and a Python float per value when
+loading; the array is saved and loaded in one call.
+
+Run `python lane_io.py` to check the two formats against each other and time the loading.
+"""
+
+import numpy as np
+
+# ## {format: file suffix}
+LANE_FORMATS = {"npy": ".lines.npy", "txt": ".lines.txt"}
+# ## The suffixes accepted when looking up the lane detection results, e.g., by `SceneIndex`
+LANE_FILE_SUFFIXES = tuple(LANE_FORMATS.values())
+
+_NPY_MAGIC_V1 = b"\x93NUMPY\x01\x00"
+
+
+def format_lanes_txt(lanes):
+    """
+    lanes: list of np.ndarray of shape (num_points, 2)
+    return: str, the legacy text format, skipping the lanes without points
+    """
+    out = []
+    for lane in lanes:
+        lane_str = " ".join(["{:.5f} {:.5f}".format(x, y) for x, y in lane])
+        if lane_str != "":
+            out.append(lane_str)
+
+    return "\n".join(out)
+
+
+def parse_lanes_txt(text):
+    """
+    Parse the legacy text format with a single conversion of all the values
+    return: list of np.ndarray of shape (num_points, 2), float64
+    """
+    ls_len = [
+        (line.count(" ") + 1) // 2 for line in text.split("\n") if line.strip() != ""
+    ]
+    if len(ls_len) == 0:
+        return []
+    points = np.fromstring(text, dtype=np.float64, sep=" ").reshape(-1, 2)
+    return _split_lanes(points, ls_len)
+
+
+def _split_lanes(points, ls_len):
+    bounds = np.cumsum(ls_len).tolist()
+    return [points[start:end] for start, end in zip([0] + bounds[:-1], bounds)]
+
+
+def lanes_to_array(lanes):
+    """
+    lanes: list of np.ndarray of shape (num_points, 2)
+    return: np.ndarray of shape (num_points, 3), float32, see the module docstring
+    """
+    lanes = [lane for lane in lanes if len(lane) > 0]
+    if len(lanes) == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+    lane_ids = np.repeat(np.arange(len(lanes)), [len(lane) for lane in lanes])
+    return np.column_stack([lane_ids, np.concatenate(lanes)]).astype(np.float32)
+
+
+def array_to_lanes(arr):
+    """
+    The inverse of `lanes_to_array`
+    return: list of np.ndarray of shape (num_points, 2), float32
+    """
+    if len(arr) == 0:
+        return []
+    bounds = (np.flatnonzero(np.diff(arr[:, 0])) + 1).tolist()
+    return _split_lanes(arr[:, 1:], np.diff([0] + bounds + [len(arr)]))
+
+
+def save_lanes(lanes, fp_prefix, fmt="npy"):
+    """
+    Save the lanes of an image to fp_prefix + the suffix of fmt
+    return: str, the path to the saved file
+    """
+    assert (
+        fmt in LANE_FORMATS
+    ), f"Unknown lane format {fmt}, should be one of {list(LANE_FORMATS)}"
+    fp = fp_prefix + LANE_FORMATS[fmt]
+    if fmt == "npy":
+        np.save(fp, lanes_to_array(lanes))
+    else:
+        with open(fp, "w") as f:
+            f.write(format_lanes_txt(lanes))
+    return fp
+
+
+def _read_npy(fp):
+    """
+    Read the array saved by `save_lanes`, skipping the header parsing of `np.load`,
+    which costs more than the data of a scene; other arrays fall back to `np.load`
+    """
+    with open(fp, "rb") as f:
+        data = f.read()
+    # ## magic string, version 1.0, little-endian uint16 header length, header
+    header_len = int.from_bytes(data[8:10], "little")
+    header = data[10 : 10 + header_len]
+    if (
+        data[:8] == _NPY_MAGIC_V1
+        and b"'descr': '<f4'" in header
+        and b"'fortran_order': False" in header
+    ):
+        return np.frombuffer(data, dtype="<f4", offset=10 + header_len).reshape(-1, 3)
+    return np.load(fp)
+
+
+def load_lanes(fp):
+    """
+    Load the lanes saved in either format, decided by the suffix of fp
+    return: list of read-only np.ndarray of shape (num_points, 2), in pixels
+    """
+    if fp.endswith(".npy"):
+        return array_to_lanes(_read_npy(fp))
+    with open(fp, "r") as f:
+        return parse_lanes_txt(f.read())
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    import shutil
+    import tempfile
+
+    def load_lanes_legacy(fp):
+        # ## the parser of `VisualIRGenerator.gen_visual_ir` before the array format
+        with open(fp, "r") as f:
+            ls_lines_raw = f.readlines()
+        ls_lines = []
+        for line in ls_lines_raw:
+            ls_line = [int(float(x)) for x in line.strip("\n").split(" ")]
+            ls_lines.append(list(zip(ls_line[0::2], ls_line[1::2])))
+        return ls_lines
+
+    def to_pixels(lanes):
+        return [[tuple(pt) for pt in lane.astype(np.int64).tolist()] for lane in lanes]
+
+    rng = np.random.default_rng(0)
+    tmp_dir = tempfile.mkdtemp()
+    ls_scene, ls_lanes = [], []
+    for idx in range(200):
+        # ## CLRNet samples up to 72 points per lane on CULane
+        lanes = []
+        for _ in range(rng.integers(0, 7)):
+            num_points = rng.integers(0, 73)
+            ys = np.sort(rng.uniform(0, 1080, num_points))[::-1]
+            xs = rng.uniform(-300, 2200, num_points)
+            lanes.append(np.column_stack([xs, ys]))
+        ls_lanes.append(lanes)
+        fp_prefix = os.path.join(tmp_dir, f"{idx:04d}.jpg")
+        ls_scene.append(
+            (save_lanes(lanes, fp_prefix, "txt"), save_lanes(lanes, fp_prefix, "npy"))
+        )
+
+    # ## The pixel coordinates truncate the same way as `int(float(x))`; a point within the float32
+    # ## precision of an integer may round across it, which the random points are unlikely to hit
+    for txt_fp, npy_fp in ls_scene:
+        expected = load_lanes_legacy(txt_fp)
+        assert to_pixels(load_lanes(txt_fp)) == expected, txt_fp
+        assert to_pixels(load_lanes(npy_fp)) == expected, npy_fp
+    print(f"The text and array formats give the same lanes on {len(ls_scene)} scenes.")
+
+    for name, fn, idx_fp in [
+        ("legacy text parser", load_lanes_legacy, 0),
+        ("load_lanes(.lines.txt)", load_lanes, 0),
+        ("load_lanes(.lines.npy)", load_lanes, 1),
+    ]:
+        t_start = time.time()
+        for _ in range(5):
+            for scene in ls_scene:
+                fn(scene[idx_fp])
+        print(
+            f"{name}: {(time.time() - t_start) / 5 / len(ls_scene) * 1e6:.1f} us per scene"
+        )
+    for fmt in LANE_FORMATS:
+        t_start = time.time()
+        for _ in range(5):
+            for idx, lanes in enumerate(ls_lanes):
+                save_lanes(lanes, os.path.join(tmp_dir, f"{idx:04d}.jpg"), fmt)
+        print(
+            f"save_lanes({fmt}): {(time.time() - t_start) / 5 / len(ls_lanes) * 1e6:.1f} us per scene"
+        )
+    print(
+        f"file size: {sum(os.path.getsize(txt_fp) for txt_fp, _ in ls_scene)} bytes as text, "
+        f"{sum(os.path.getsize(npy_fp) for _, npy_fp in ls_scene)} bytes as arrays"
+    )
+
+    shutil.rmtree(tmp_dir)
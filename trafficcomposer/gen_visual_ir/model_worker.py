@@ -0,0 +1,316 @@
+"""
+A long-lived local worker holding CLRNet and YOLOv10 in memory, so that frequent small runs of
+`extract_lane.py` and `extract_actor.py` do not build the networks and load the weights every time.
+
+How to use this script:
+    python model_worker.py --lane_config clrnet/configs/clrnet/clr_dla34_culane.py --lane_checkpoint culane_dla34.pth
+Then `extract_lane.py` and `extract_actor.py` send their images to the worker, if it runs with the same
+models, or else load the models in their own process as before (`--no_worker` to always do so).
+
+The worker listens on a Unix socket (`DEFAULT_ADDRESS`, or `--address`) with `multiprocessing.connection`;
+the clients authenticate with the key in `<address>.key`, which only the user running the worker can read.
+Both files live in a directory only this user can access, `$XDG_RUNTIME_DIR/trafficcomposer` or else
+`<temp dir>/trafficcomposer-<uid>` with mode 0700. The responses are unpickled, so the clients only connect
+when the directory, the socket and the key are owned by the current user and none of them is a symlink.
+Each request is (op, kwargs) and each response is ("ok", result) or ("error", traceback):
+    - "info": the models loaded by the worker, see `ModelWorker.info`
+    - "detect_lanes": the lanes of ls_img_path in the pixels of the images, see `ClrnetLaneDetector.detect_batch`
+    - "predict_actors": `YOLOv10.predict` with the given arguments, which writes the labels and the annotated images
+      like `extract_actor.yolo_detect`; returns the (img_h, img_w) of each image
+Only the image paths and the results travel over the socket; the worker reads and writes the files itself.
+"""
+
+import os
+import stat
+import secrets
+import argparse
+import tempfile
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+
+
+def default_worker_dir():
+    """
+    The per-user directory of the socket and the key
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "trafficcomposer")
+    return os.path.join(tempfile.gettempdir(), f"trafficcomposer-{os.getuid()}")
+
+
+DEFAULT_ADDRESS = os.path.join(default_worker_dir(), "models.sock")
+
+
+def key_path(address):
+    return address + ".key"
+
+
+def check_private_path(path, file_type, mode=None):
+    """
+    return: None if path is of file_type (e.g., `stat.S_ISDIR`), not a symlink, owned by the current user,
+        and of the permission bits mode if given; or else the reason why not
+    """
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode) or not file_type(st.st_mode):
+        return f"{path} is a symlink or of an unexpected type"
+    if st.st_uid != os.getuid():
+        return f"{path} is not owned by the current user"
+    if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+        return f"{path} has mode {oct(stat.S_IMODE(st.st_mode))} instead of {oct(mode)}"
+    return None
+
+
+def make_private_dir(dir_path):
+    """
+    Create dir_path with mode 0700, or check that the existing one is private to the current user
+    """
+    try:
+        os.makedirs(dir_path, mode=0o700)
+    except FileExistsError:
+        pass
+    reason = check_private_path(dir_path, stat.S_ISDIR, mode=0o700)
+    assert reason is None, f"Cannot use {dir_path} for the model worker: {reason}"
+
+
+def check_worker_files(address):
+    """
+    return: None if the directory, the socket and the key of the worker at address are private to the current user,
+        or else the reason why not
+    """
+    for path, file_type, mode in [
+        (os.path.dirname(os.path.abspath(address)), stat.S_ISDIR, 0o700),
+        (address, stat.S_ISSOCK, None),
+        (key_path(address), stat.S_ISREG, 0o600),
+    ]:
+        reason = check_private_path(path, file_type, mode=mode)
+        if reason is not None:
+            return reason
+    return None
+
+
+class WorkerClient(object):
+    """
+    A connection to the worker, one request at a time
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS):
+        with open(key_path(address), "rb") as f:
+            authkey = f.read()
+        self.conn = Client(address, family="AF_UNIX", authkey=authkey)
+        self.info = self.request("info")
+
+    def request(self, op, **kwargs):
+        self.conn.send((op, kwargs))
+        status, result = self.conn.recv()
+        assert status == "ok", f"The model worker failed on {op}:\n{result}"
+        return result
+
+    def detect_lanes(self, ls_img_path):
+        return self.request("detect_lanes", ls_img_path=ls_img_path)
+
+    def predict_actors(self, **predict_kwargs):
+        return self.request("predict_actors", **predict_kwargs)
+
+    def close(self):
+        self.conn.close()
+
+
+def connect_worker(address=DEFAULT_ADDRESS):
+    """
+    return: WorkerClient, or None if no worker is running at address
+    """
+    if not os.path.exists(address) or not os.path.exists(key_path(address)):
+        return None
+    # ## the responses are unpickled, so a worker planted by another user must never be connected to
+    reason = check_worker_files(address)
+    if reason is not None:
+        print(f"WARNING: Not connecting to the model worker, {reason}! Skipping...")
+        return None
+    try:
+        return WorkerClient(address)
+    except (OSError, EOFError):
+        # ## a stale socket left by a worker that did not exit cleanly
+        print(f"WARNING: No model worker is listening on {address}! Skipping...")
+        return None
+
+
+class ModelWorker(object):
+    """
+    Load the models once and serve the requests of the clients, one thread per connection.
+    Each model serves one request at a time.
+    """
+
+    def __init__(self, lane_cfg=None, actor_model_name=None, actor_backend="torch"):
+        self.dct_info = {}
+        self.lane_detector, self.actor_model = None, None
+        self.lane_lock, self.actor_lock = threading.Lock(), threading.Lock()
+        if lane_cfg is not None:
+            from extract_lane import ClrnetLaneDetector
+
+            self.lane_detector = ClrnetLaneDetector(lane_cfg, save_results=False)
+            self.dct_info["lane"] = lane_model_info(lane_cfg)
+        if actor_model_name is not None:
+            from extract_actor import load_yolo_model
+
+            self.actor_model = load_yolo_model(actor_model_name, backend=actor_backend)
+            self.dct_info["actor"] = actor_model_info(actor_model_name, actor_backend)
+
+    def info(self):
+        """
+        return: {"lane": see `lane_model_info`, "actor": see `actor_model_info`}, for the loaded models only
+        """
+        return self.dct_info
+
+    def detect_lanes(self, ls_img_path):
+        assert self.lane_detector is not None, "The worker has no lane detector"
+        with self.lane_lock:
+            return self.lane_detector.detect_batch(ls_img_path, ls_img_path)
+
+    def predict_actors(self, **predict_kwargs):
+        assert self.actor_model is not None, "The worker has no actor detector"
+        with self.actor_lock:
+            return [
+                (os.path.basename(result.path), result.orig_shape)
+                for result in self.actor_model.predict(
+                    stream=True, verbose=False, **predict_kwargs
+                )
+            ]
+
+    def handle(self, conn):
+        dct_ops = {
+            "info": self.info,
+            "detect_lanes": self.detect_lanes,
+            "predict_actors": self.predict_actors,
+        }
+        with conn:
+            while True:
+                try:
+                    op, kwargs = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    conn.send(("ok", dct_ops[op](**kwargs)))
+                except Exception:
+                    conn.send(("error", traceback.format_exc()))
+
+    def serve(self, address=DEFAULT_ADDRESS):
+        """
+        address: in a directory private to the current user, created with mode 0700 if missing
+        """
+        make_private_dir(os.path.dirname(os.path.abspath(address)))
+        # ## left by a worker that did not exit cleanly
+        for fp in (address, key_path(address)):
+            if os.path.lexists(fp):
+                os.remove(fp)
+        authkey = secrets.token_bytes(32)
+        # ## readable by the current user only; never follow or reuse a file created by someone else
+        fd = os.open(
+            key_path(address),
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+            0o600,
+        )
+        # ## whatever the umask is
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(authkey)
+
+        listener = Listener(address, family="AF_UNIX", authkey=authkey)
+        print(f"The model worker is listening on {address} with {self.dct_info}")
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception:
+                    print("WARNING: Cannot accept a connection! Skipping...")
+                    traceback.print_exc()
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            for fp in (address, key_path(address)):
+                if os.path.lexists(fp):
+                    os.remove(fp)
+
+
+def lane_model_info(cfg):
+    """
+    What decides the lanes of the worker, compared by the clients with their own configuration
+    """
+    return {
+        "config": os.path.abspath(cfg.filename),
+        "load_from": None if cfg.load_from is None else os.path.abspath(cfg.load_from),
+        "exported_model": (
+            None if cfg.exported_model is None else os.path.abspath(cfg.exported_model)
+        ),
+        "reduced_decode": cfg.reduced_decode,
+    }
+
+
+def actor_model_info(model_name, backend):
+    return {"model_name": model_name, "backend": backend}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve CLRNet and YOLOv10 from one long-lived process"
+    )
+    parser.add_argument(
+        "--address",
+        type=str,
+        default=DEFAULT_ADDRESS,
+        help="the socket, in a directory only the current user can access",
+    )
+    parser.add_argument(
+        "--lane_config", type=str, default=None, help="the CLRNet config file"
+    )
+    parser.add_argument(
+        "--lane_checkpoint", type=str, default=None, help="the CLRNet checkpoint file"
+    )
+    parser.add_argument(
+        "--lane_device", type=str, default="auto", choices=["auto", "cuda", "cpu"]
+    )
+    parser.add_argument(
+        "--lane_exported_model",
+        type=str,
+        default=None,
+        help="the CLRNet exported by export_lane.py, see extract_lane.py --exported_model",
+    )
+    parser.add_argument(
+        "--actor_model",
+        type=str,
+        default="jameslahm/yolov10x",
+        help="the YOLOv10 model",
+    )
+    parser.add_argument(
+        "--actor_backend",
+        type=str,
+        default="torch",
+        choices=["torch", "onnx", "openvino"],
+        help="see extract_actor.py --backend",
+    )
+    parser.add_argument(
+        "--no_actor", action="store_true", help="do not load the actor detector"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    lane_cfg = None
+    if args.lane_config is not None:
+        from extract_lane import load_cfg
+
+        lane_cfg = load_cfg(
+            args.lane_config,
+            load_from=args.lane_checkpoint,
+            device=args.lane_device,
+            exported_model=args.lane_exported_model,
+        )
+    worker = ModelWorker(
+        lane_cfg=lane_cfg,
+        actor_model_name=None if args.no_actor else args.actor_model,
+        actor_backend=args.actor_backend,
+    )
+    worker.serve(args.address)
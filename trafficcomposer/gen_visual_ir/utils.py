@@ -1,4 +1,5 @@
 import os 
+import shutil
 
 
 def is_image_file(filename):
@@ -6,6 +7,175 @@ def is_image_file(filename):
     return any(filename.endswith(extension) for extension in [".png", ".jpg", ".jpeg"])
 
 
+def get_scene_id(filename, suffix=None):
+    """
+    Get the scene id from the file name, i.e., the image name without extension.
+        suffix=None: image files, e.g., `0001.jpg` -> `0001`
+        suffix=".lines.txt": lane detection results, e.g., `0001.jpg.lines.txt` -> `0001`
+        suffix=".txt" / ".yaml": label files and IRs, e.g., `0001.yaml` -> `0001`
+        suffix=(".yaml", ".json", ...): any of the suffixes, e.g., IRs in different formats
+    return: str, or None if the file does not match the suffix
+    """
+    if suffix is None:
+        if not is_image_file(filename):
+            return None
+        return os.path.splitext(filename)[0]
+
+    ls_suffix = [suffix] if isinstance(suffix, str) else suffix
+    for single_suffix in ls_suffix:
+        if filename.endswith(single_suffix):
+            break
+    else:
+        return None
+    scene_id = filename[: -len(single_suffix)]
+    if is_image_file(scene_id):
+        # ## files named after the image, e.g., `0001.jpg.lines.txt`
+        scene_id = os.path.splitext(scene_id)[0]
+    return scene_id
+
+
+def file_preference(file_name, suffix=None):
+    """
+    The preference of a file among the files of the same scene, the smaller the better:
+    the position of its suffix in suffix, e.g., `0001.yaml` before `0001.json` with suffix=(".yaml", ".json"), then its name
+    """
+    if suffix is None or isinstance(suffix, str):
+        return (0, file_name)
+    for idx, single_suffix in enumerate(suffix):
+        if file_name.endswith(single_suffix):
+            return (idx, file_name)
+    return (len(suffix), file_name)
+
+
+def scan_scene_files(dir_path, suffix=None):
+    """
+    Scan dir_path once with os.scandir.
+    yield: (scene_id, file_name) of each file matching the suffix, in directory order
+    """
+    assert os.path.isdir(dir_path), f"{dir_path} is not a directory."
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            scene_id = get_scene_id(entry.name, suffix)
+            if scene_id is not None and entry.is_file():
+                yield scene_id, entry.name
+
+
+class SceneIndex(object):
+    """
+    Pair the files of each scene across several directories by scene id instead of by list position.
+
+    dct_sources: {role: (dir_path, suffix)}, e.g.,
+        {
+            "image": (SOURCE_IMAGE_DIR, None),
+            "textual_ir": (TEXTUAL_IR_LOAD_DIR, ".yaml"),
+            "visual_ir": (VISUAL_IR_LOAD_DIR, ".yaml"),
+        }
+        A source can also be a mapping {scene_id: item} providing `keys()` and `__getitem__`, e.g., an `IRShardReader`.
+
+    Iterating the index yields the complete scenes sorted by scene id as
+        (scene_id, file_path_or_item_of_role_0, file_path_or_item_of_role_1, ...)
+    `iter_refs()` yields the file paths and the keys of the mapping sources instead, without loading any item.
+    The scenes missing any role are skipped and can be inspected with `incomplete()` or `report_incomplete()`.
+    If a role has several files for a scene, the one of the earliest suffix wins, then the smallest name, see `file_preference`.
+    """
+
+    def __init__(self, dct_sources):
+        self.roles = list(dct_sources.keys())
+        self.ls_sources = [dct_sources[role] for role in self.roles]
+
+        # ## {scene_id: [file_name_of_role_0, file_name_of_role_1, ...]}
+        self.dct_scene = {}
+        num_roles = len(self.roles)
+        for role_idx, source in enumerate(self.ls_sources):
+            role = self.roles[role_idx]
+            if isinstance(source, tuple):
+                dir_path, suffix = source
+                iter_files = scan_scene_files(dir_path, suffix)
+            else:
+                # ## mapping source, the scene id itself is the key of the item
+                suffix = None
+                iter_files = ((scene_id, scene_id) for scene_id in source.keys())
+            for scene_id, file_name in iter_files:
+                ls_files = self.dct_scene.get(scene_id)
+                if ls_files is None:
+                    ls_files = [None] * num_roles
+                    self.dct_scene[scene_id] = ls_files
+                if ls_files[role_idx] is not None:
+                    # ## independent of the directory order
+                    file_name_used = min(
+                        ls_files[role_idx],
+                        file_name,
+                        key=lambda x: file_preference(x, suffix),
+                    )
+                    print(
+                        f"WARNING: Duplicate {role} files for scene {scene_id}: {ls_files[role_idx]}, {file_name}. "
+                        f"Using {file_name_used}, by the order of the suffixes {suffix}, then by name."
+                    )
+                    ls_files[role_idx] = file_name_used
+                    continue
+                ls_files[role_idx] = file_name
+
+    def __len__(self):
+        return sum(1 for ls_files in self.dct_scene.values() if None not in ls_files)
+
+    def complete_scene_ids(self):
+        """
+        return: the sorted scene ids of the complete scenes, without loading any item
+        """
+        return sorted(
+            scene_id for scene_id, ls_files in self.dct_scene.items() if None not in ls_files
+        )
+
+    def iter_refs(self):
+        """
+        yield: (scene_id, ref_of_role_0, ref_of_role_1, ...) of the complete scenes sorted by scene id,
+            the ref being the file path for a directory source, or the key (the scene id) for a mapping source
+        """
+        for scene_id in self.complete_scene_ids():
+            yield (scene_id,) + tuple(
+                (
+                    os.path.join(source[0], file_name)
+                    if isinstance(source, tuple)
+                    else file_name
+                )
+                for source, file_name in zip(self.ls_sources, self.dct_scene[scene_id])
+            )
+
+    def __iter__(self):
+        for scene_refs in self.iter_refs():
+            yield (scene_refs[0],) + tuple(
+                ref if isinstance(source, tuple) else source[ref]
+                for source, ref in zip(self.ls_sources, scene_refs[1:])
+            )
+
+    def incomplete(self):
+        """
+        return: {scene_id: [missing_role, ...]} of the scenes missing any role
+        """
+        return {
+            scene_id: [
+                role for role, file_name in zip(self.roles, ls_files) if file_name is None
+            ]
+            for scene_id, ls_files in sorted(self.dct_scene.items())
+            if None in ls_files
+        }
+
+    def report_incomplete(self, max_items=20):
+        """
+        Print the scenes missing any role, and return them as `incomplete()` does
+        """
+        dct_incomplete = self.incomplete()
+        if len(dct_incomplete) > 0:
+            print(
+                f"WARNING: {len(dct_incomplete)} incomplete scenes are skipped, {len(self)} complete scenes remain."
+            )
+            for scene_id in list(dct_incomplete.keys())[:max_items]:
+                print(f"  {scene_id}: missing {', '.join(dct_incomplete[scene_id])}")
+            if len(dct_incomplete) > max_items:
+                print(f"  ... and {len(dct_incomplete) - max_items} more")
+        return dct_incomplete
+
+
 def gen_img_list(img_dir_path, fp_save=None, debug=False):
     """
     Generate a list of image files in the directory img_dir_path
@@ -42,12 +212,31 @@ def gen_img_list(img_dir_path, fp_save=None, debug=False):
     return ls_ans
 
 
-def copy_dir(source_dir, target_dir):
-    """Copy the all the contents from source_dir to target_dir."""
+def make_staging_dir(target_dir):
+    """
+    Create an empty directory next to target_dir, i.e., on the same file system, for a stage to write its results
+    before `publish_dir` moves it to target_dir. The leftover of an interrupted run is removed.
+    return: str, the path to the staging directory
+    """
+    staging_dir = os.path.normpath(target_dir) + ".staging"
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(staging_dir)
+    return staging_dir
+
+
+def publish_dir(source_dir, target_dir):
+    """
+    Move source_dir to target_dir by renaming, without copying any file, replacing the previous target_dir if any.
+    source_dir should be on the same file system as target_dir, e.g., from `make_staging_dir`.
+    """
+    target_dir = os.path.normpath(target_dir)
+    old_dir = None
     if os.path.exists(target_dir):
-        input(
-            f"WARNING: {target_dir} already exists. Press Enter to remove it."
-        )
-        os.system(f"rm -r {target_dir}")
-    os.system(f"cp -r {source_dir} {target_dir}")
-    print(f"Results are saved to {target_dir}, copied from {source_dir}.")
+        print(f"WARNING: {target_dir} already exists. Replacing it...")
+        old_dir = f"{target_dir}.old-{os.getpid()}"
+        os.rename(target_dir, old_dir)
+    os.rename(source_dir, target_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir)
+    print(f"Results are saved to {target_dir}.")
@@ -0,0 +1,128 @@
+"""
+YOLO label files of the actor detection results.
+
+`extract_actor.py` saves the actors of each image as YOLO labels, one actor per line:
+    "[class] [x_center_normalized] [y_center_normalized] [width_normalized] [height_normalized]"
+optionally followed by the confidence.
+`load_yolo_labels` parses a label file line by line into an (N, 5) array, the form the detectors
+also return in memory, `xywhn_to_xyxy` converts all the boxes of an image to pixels at once, and
+`class_name_array` turns the class table into an array indexed by the class ids.
+
+Run `python yolo_label.py` to check the boxes and the classes against the per-actor conversion.
+"""
+
+import numpy as np
+
+
+def load_yolo_labels(fp):
+    """
+    return: np.ndarray of shape (num_actors, 5), [class, x_center, y_center, width, height] per row
+    """
+    with open(fp, "r") as f:
+        ls_actors_raw = [x.strip("\n") for x in f.readlines()]
+    ls_rows = []
+    for actor_yolo_item in ls_actors_raw:
+        if actor_yolo_item.strip() == "":
+            continue
+        single_actor_info_ls = actor_yolo_item.split(" ")
+        ls_rows.append([float(x) for x in single_actor_info_ls[:5]])
+    return np.array(ls_rows, dtype=np.float64).reshape(-1, 5)
+
+
+def save_yolo_labels(arr_labels, fp):
+    """
+    Save the labels in the format of `ultralytics.engine.results.Results.save_txt`, an empty file if there is no actor
+    arr_labels: np.ndarray of shape (num_actors, 5), see `load_yolo_labels`
+    """
+    with open(fp, "w") as f:
+        for row in arr_labels:
+            f.write(("%g " * 5).rstrip() % (int(row[0]), *row[1:5]) + "\n")
+
+
+def xywhn_to_xyxy(arr_xywhn, img_w, img_h):
+    """
+    arr_xywhn: np.ndarray of shape (num_actors, 4), the normalized boxes in [x_center, y_center, width, height]
+    return: np.ndarray of shape (num_actors, 4), [x1, y1, x2, y2] in pixels, truncated toward zero as `int` does
+    """
+    x_center, y_center, width, height = arr_xywhn.T
+    arr_xyxyn = np.stack(
+        [
+            x_center - width / 2,
+            y_center - height / 2,
+            x_center + width / 2,
+            y_center + height / 2,
+        ],
+        axis=1,
+    )
+    return (arr_xyxyn * np.array([img_w, img_h, img_w, img_h])).astype(np.int64)
+
+
+def class_name_array(dct_names):
+    """
+    dct_names: {class_id: class_name}, e.g., the `names` of coco.yaml
+    return: np.ndarray of dtype object, the class name at the index of each class id
+    """
+    arr_names = np.empty(max(dct_names.keys()) + 1, dtype=object)
+    for class_id, class_name in dct_names.items():
+        arr_names[class_id] = class_name
+    return arr_names
+
+
+if __name__ == "__main__":
+    import os
+    import shutil
+    import tempfile
+
+    def parse_legacy(fp, img_w, img_h, dct_names):
+        # ## the per-actor conversion of `VisualIRGenerator.gen_visual_ir` before the arrays
+        with open(fp, "r") as f:
+            ls_actors_raw = [x.strip("\n") for x in f.readlines()]
+        ls_ans = []
+        for actor_yolo_item in ls_actors_raw:
+            single_actor_info_ls = actor_yolo_item.split(" ")
+            xywhn = [float(x) for x in single_actor_info_ls[1:5]]
+            xyxyn = (
+                xywhn[0] - xywhn[2] / 2,
+                xywhn[1] - xywhn[3] / 2,
+                xywhn[0] + xywhn[2] / 2,
+                xywhn[1] + xywhn[3] / 2,
+            )
+            xyxy = [
+                int(xyxyn[0] * img_w),
+                int(xyxyn[1] * img_h),
+                int(xyxyn[2] * img_w),
+                int(xyxyn[3] * img_h),
+            ]
+            ls_ans.append((dct_names[int(single_actor_info_ls[0])], xyxy))
+        return ls_ans
+
+    def parse_arrays(fp, img_w, img_h, arr_names):
+        arr_labels = load_yolo_labels(fp)
+        ls_xyxy = xywhn_to_xyxy(arr_labels[:, 1:5], img_w, img_h).tolist()
+        ls_names = arr_names[arr_labels[:, 0].astype(np.int64)].tolist()
+        return list(zip(ls_names, ls_xyxy))
+
+    rng = np.random.default_rng(0)
+    dct_names = {class_id: f"class_{class_id}" for class_id in range(80)}
+    arr_names = class_name_array(dct_names)
+    tmp_dir = tempfile.mkdtemp()
+    ls_fp = []
+    for idx in range(300):
+        num_actors = int(rng.integers(0, 40))
+        arr = rng.uniform(0, 1, size=(num_actors, 5))
+        arr[:, 0] = rng.integers(0, 80, size=num_actors)
+        fp = os.path.join(tmp_dir, f"{idx:04d}.txt")
+        with open(fp, "w") as f:
+            for row in arr:
+                # ## the format of `ultralytics.engine.results.Results.save_txt`
+                f.write(("%g " * 5).rstrip() % tuple(row) + "\n")
+        ls_fp.append(fp)
+
+    for fp in ls_fp:
+        expected = parse_legacy(fp, 1280, 720, dct_names)
+        assert parse_arrays(fp, 1280, 720, arr_names) == expected, fp
+    print(
+        f"The array conversion matches the per-actor conversion on {len(ls_fp)} label files."
+    )
+
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,259 @@
+"""
+Serialization of the textual, visual and merged IRs.
+
+Every stage reads and writes IR files through `load_ir` and `dump_ir`.
+Three formats are supported:
+    yaml: the default, human-readable format. The libyaml C loader/dumper is used when available.
+    json: the standard library json module.
+    msgpack: compact binary format, requires `pip install msgpack`.
+
+The format is detected from the file extension on load (falling back to sniffing the content),
+so the existing YAML datasets keep working when a stage switches to another format.
+
+Run `python ir_io.py` to check the round trip of the merged IR and the visual IR, and to benchmark
+the load+dump time per 10k scenes for each backend.
+"""
+
+import os
+import json
+
+import yaml
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+IR_FORMATS = ("yaml", "json", "msgpack")
+
+# ## The first extension of each format is used when saving
+DCT_FORMAT2EXTENSIONS = {
+    "yaml": (".yaml", ".yml"),
+    "json": (".json",),
+    "msgpack": (".msgpack", ".mpk"),
+}
+IR_EXTENSIONS = tuple(
+    extension
+    for extensions in DCT_FORMAT2EXTENSIONS.values()
+    for extension in extensions
+)
+
+
+# ## The safe loader extended with tuples, which the visual IR uses for (class_name, xyxy) pairs
+_YamlSafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+_YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+
+
+class IRYamlLoader(_YamlSafeLoader):
+    pass
+
+
+def _construct_tuple(loader, node):
+    return tuple(loader.construct_sequence(node))
+
+
+IRYamlLoader.add_constructor("tag:yaml.org,2002:python/tuple", _construct_tuple)
+
+
+def _int_keys_hook(pairs):
+    """
+    JSON object keys are always strings, convert the lane indices of the visual IR back to int
+    """
+    dct = {}
+    for key, value in pairs:
+        if key.lstrip("-").isdigit():
+            key = int(key)
+        dct[key] = value
+    return dct
+
+
+def _check_format(fmt):
+    assert fmt in IR_FORMATS, f"Unknown IR format {fmt}, should be one of {IR_FORMATS}"
+    if fmt == "msgpack" and msgpack is None:
+        raise ImportError("The msgpack IR format requires `pip install msgpack`")
+
+
+def ir_file_name(scene_id, fmt="yaml"):
+    """
+    The IR file name of the scene, e.g., `0001.yaml`
+    """
+    _check_format(fmt)
+    return f"{scene_id}{DCT_FORMAT2EXTENSIONS[fmt][0]}"
+
+
+def detect_format(fp):
+    """
+    Detect the IR format from the file extension; if unknown, from the first byte of the file.
+    """
+    fp_lower = fp.lower()
+    for fmt, extensions in DCT_FORMAT2EXTENSIONS.items():
+        if fp_lower.endswith(extensions):
+            return fmt
+
+    with open(fp, "rb") as f:
+        first_byte = f.read(1)
+    if first_byte in (b"{", b"["):
+        return "json"
+    if first_byte and (0x80 <= first_byte[0] <= 0x8F or first_byte[0] in (0xDE, 0xDF)):
+        # ## msgpack fixmap / map16 / map32
+        return "msgpack"
+    return "yaml"
+
+
+def dumps_ir(ir, fmt="yaml"):
+    """
+    Serialize the IR to str (yaml, json) or bytes (msgpack)
+    """
+    _check_format(fmt)
+    if fmt == "yaml":
+        return yaml.dump(ir, Dumper=_YamlDumper, default_flow_style=False)
+    elif fmt == "json":
+        return json.dumps(ir, sort_keys=True)
+    elif fmt == "msgpack":
+        return msgpack.packb(ir, use_bin_type=True)
+
+
+def loads_ir(data, fmt="yaml"):
+    """
+    Deserialize the IR from str or bytes
+    """
+    _check_format(fmt)
+    if fmt == "yaml":
+        return yaml.load(data, Loader=IRYamlLoader)
+    elif fmt == "json":
+        return json.loads(data, object_pairs_hook=_int_keys_hook)
+    elif fmt == "msgpack":
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def dump_ir(ir, fp, fmt=None):
+    """
+    Save the IR to fp. By default, the format is decided by the file extension.
+    """
+    if fmt is None:
+        fmt = detect_format(fp)
+    data = dumps_ir(ir, fmt)
+    with open(fp, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+
+
+def load_ir(fp, fmt=None):
+    """
+    Load the IR from fp. By default, the format is detected automatically.
+    """
+    assert os.path.exists(fp), f"{fp} does not exist"
+    if fmt is None:
+        fmt = detect_format(fp)
+    with open(fp, "rb" if fmt == "msgpack" else "r") as f:
+        return loads_ir(f.read(), fmt)
+
+
+if __name__ == "__main__":
+    import time
+    import shutil
+    import tempfile
+
+    num_scenes = 10000
+
+    # ## A merged IR with a few actors per lane is representative for all the stages
+    sample_ir = {
+        "environment": {"time": "daytime", "weather": "clear"},
+        "lane_number": 4,
+        "road_network": {
+            "lane_number": 4,
+            "road_type": "intersection",
+            "traffic_light": "green",
+            "traffic_sign": "None",
+        },
+        "participant": {
+            "ego_vehicle": {
+                "current_behavior": "go forward",
+                "lane_idx": 1,
+                "position_relation": "None",
+                "position_target": "None",
+                "speed": "30 mph",
+            },
+            **{
+                f"other_vehicle_{i}": {
+                    "lane_idx": i % 4,
+                    "position_target": ["ahead", "ego_vehicle"],
+                    "type": "car",
+                }
+                for i in range(1, 9)
+            },
+        },
+    }
+    # ## The visual IR as `VisualIRGenerator.gen_visual_ir` emits it, {lane_idx: [(class_name, xyxy), ...]}
+    sample_visual_ir = {
+        lane_idx: [
+            (
+                "car",
+                [
+                    100 * lane_idx + 10 * i,
+                    400 + 20 * i,
+                    100 * lane_idx + 60,
+                    450 + 20 * i,
+                ],
+            )
+            for i in range(3)
+        ]
+        for lane_idx in range(4)
+    }
+    sample_visual_ir[2].insert(0, ("ego", [576, 720, 704, 720]))
+
+    save_dir = tempfile.mkdtemp()
+    print(f"Load+dump time per {num_scenes} scenes (merged IR + visual IR):")
+    for fmt in IR_FORMATS:
+        if fmt == "msgpack" and msgpack is None:
+            print(f"  {fmt:8s} skipped, msgpack is not installed")
+            continue
+
+        t_start = time.time()
+        for idx in range(num_scenes):
+            dump_ir(sample_ir, os.path.join(save_dir, ir_file_name(f"{idx}_m", fmt)))
+            dump_ir(
+                sample_visual_ir, os.path.join(save_dir, ir_file_name(f"{idx}_v", fmt))
+            )
+        t_dump = time.time() - t_start
+
+        t_start = time.time()
+        for idx in range(num_scenes):
+            merged_ir = load_ir(os.path.join(save_dir, ir_file_name(f"{idx}_m", fmt)))
+            visual_ir = load_ir(os.path.join(save_dir, ir_file_name(f"{idx}_v", fmt)))
+        t_load = time.time() - t_start
+
+        assert merged_ir == json.loads(json.dumps(sample_ir))
+        if fmt == "yaml":
+            # ## the tuples are kept by the `!!python/tuple` constructor of `IRYamlLoader`
+            assert visual_ir == sample_visual_ir
+        else:
+            # ## the tuples come back as lists, the lane indices as int, e.g., by `_int_keys_hook` for json
+            assert all(isinstance(k, int) for k in visual_ir)
+            assert {
+                k: [tuple(x) for x in v] for k, v in visual_ir.items()
+            } == sample_visual_ir
+        print(
+            f"  {fmt:8s} dump {t_dump:6.2f}s  load {t_load:6.2f}s  total {t_dump + t_load:6.2f}s"
+        )
+
+    # ## The pure-Python PyYAML path used before, for reference
+    t_start = time.time()
+    for idx in range(num_scenes):
+        with open(os.path.join(save_dir, f"{idx}_m.yaml"), "w") as f:
+            yaml.dump(sample_ir, f)
+        with open(os.path.join(save_dir, f"{idx}_v.yaml"), "w") as f:
+            yaml.dump(sample_visual_ir, f)
+    t_dump = time.time() - t_start
+    t_start = time.time()
+    for idx in range(num_scenes):
+        with open(os.path.join(save_dir, f"{idx}_m.yaml"), "r") as f:
+            yaml.safe_load(f)
+        with open(os.path.join(save_dir, f"{idx}_v.yaml"), "r") as f:
+            yaml.load(f, Loader=yaml.FullLoader)
+    t_load = time.time() - t_start
+    print(
+        f"  {'pyyaml':8s} dump {t_dump:6.2f}s  load {t_load:6.2f}s  total {t_dump + t_load:6.2f}s"
+    )
+
+    shutil.rmtree(save_dir)
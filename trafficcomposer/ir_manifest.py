@@ -0,0 +1,100 @@
+"""
+Content-hash manifest for incremental rebuilds.
+
+A stage running in incremental mode keeps `build.manifest` (JSON) in its save directory:
+    {
+        "version": hash of the stage code and configuration,
+        "scenes": {scene_id: hash of the inputs of the scene, ...}
+    }
+On a rerun, a scene is recomputed only if the hash of its inputs changed or its output is missing.
+If the code or the configuration changed, the version does not match and every scene is recomputed.
+"""
+
+import os
+import json
+import hashlib
+
+MANIFEST_FILE_NAME = "build.manifest"
+
+
+def _new_hash():
+    return hashlib.blake2b(digest_size=16)
+
+
+def hash_inputs(*inputs):
+    """
+    Hash the inputs of a scene.
+    inputs: file paths (str), hashed by content; serialized IRs (bytes), e.g., `IRShardReader.raw`;
+        or in-memory IRs, hashed by their JSON serialization
+    """
+    h = _new_hash()
+    for item in inputs:
+        if isinstance(item, str):
+            with open(item, "rb") as f:
+                h.update(f.read())
+        elif isinstance(item, bytes):
+            h.update(item)
+        else:
+            h.update(json.dumps(item, sort_keys=True, default=str).encode("utf-8"))
+        # ## separate the inputs, so moving bytes between two files changes the hash
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def code_version(ls_source_files, config=None):
+    """
+    The version of a stage: the hash of its source files and its configuration
+    ls_source_files: list of str, the source files whose changes invalidate the outputs
+    config: dict, the options affecting the outputs
+    """
+    h = _new_hash()
+    for fp in ls_source_files:
+        with open(fp, "rb") as f:
+            h.update(f.read())
+    h.update(json.dumps(config or {}, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+class BuildManifest(object):
+    """
+    The input hashes of the scenes built into save_dir by the stage of the given version
+    """
+
+    def __init__(self, save_dir, version):
+        self.fp = os.path.join(save_dir, MANIFEST_FILE_NAME)
+        self.version = version
+        self.dct_scene = {}
+
+        if os.path.exists(self.fp):
+            with open(self.fp, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == version:
+                self.dct_scene = manifest["scenes"]
+            else:
+                print(
+                    f"WARNING: The code or configuration changed since {self.fp} was written. All scenes will be rebuilt."
+                )
+
+    def is_up_to_date(self, scene_id, input_hash):
+        return self.dct_scene.get(scene_id) == input_hash
+
+    def update(self, scene_id, input_hash):
+        self.dct_scene[scene_id] = input_hash
+
+    def retain(self, scene_ids):
+        """
+        Drop the scenes not in scene_ids, e.g., whose inputs were removed
+        """
+        scene_ids = set(scene_ids)
+        self.dct_scene = {
+            scene_id: input_hash
+            for scene_id, input_hash in self.dct_scene.items()
+            if scene_id in scene_ids
+        }
+
+    def save(self):
+        # ## write to a temporary file first, so an interrupted run never leaves a broken manifest
+        fp_tmp = self.fp + ".tmp"
+        with open(fp_tmp, "w") as f:
+            json.dump({"version": self.version, "scenes": self.dct_scene}, f)
+        os.replace(fp_tmp, self.fp)
@@ -0,0 +1,381 @@
+"""
+Storage layouts of the IR outputs.
+
+    files: one IR file per scene, e.g., `save_dir/0001.yaml`. The default layout.
+    shard: the IRs of many scenes packed into a few shard files, e.g., `save_dir/part-00000.shard`.
+
+A shard file starts with a 16-byte header (magic + IR format) followed by length-prefixed records
+    [uint32 len(scene_id)][scene_id][uint32 len(payload)][payload]
+where the payload is the IR serialized by `ir_io.dumps_ir`.
+Next to each shard, `part-00000.index.npy` stores (scene_id, offset, length) sorted by scene id.
+The index is memory-mapped by `IRShardReader`, so looking up a scene is a binary search plus one read,
+without loading the whole index or shard into memory.
+If a run is interrupted before the index is written, the reader rebuilds it from the shard records.
+
+Shards can be exported to the per-file layout with
+    python ir_store.py export SHARD_DIR SAVE_DIR --ir_format yaml
+"""
+
+import os
+import mmap
+import struct
+import argparse
+
+import numpy as np
+
+try:
+    # ## from trafficcomposer.py, whose module name shadows the `trafficcomposer` package
+    from ir_io import (
+        dumps_ir,
+        loads_ir,
+        dump_ir,
+        ir_file_name,
+        IR_FORMATS,
+        IR_EXTENSIONS,
+    )
+except ImportError:
+    from trafficcomposer.ir_io import (
+        dumps_ir,
+        loads_ir,
+        dump_ir,
+        ir_file_name,
+        IR_FORMATS,
+        IR_EXTENSIONS,
+    )
+
+
+IR_LAYOUTS = ("files", "shard")
+
+SHARD_DATA_EXTENSION = ".shard"
+SHARD_INDEX_EXTENSION = ".index.npy"
+SHARD_MAGIC = b"TCIRSHRD"
+SHARD_HEADER_SIZE = 16
+MAX_SCENE_ID_LEN = 64
+
+SHARD_INDEX_DTYPE = np.dtype(
+    [
+        ("scene_id", f"S{MAX_SCENE_ID_LEN}"),
+        ("offset", "<u8"),
+        ("length", "<u4"),
+    ]
+)
+
+_UINT32 = struct.Struct("<I")
+
+
+def is_shard_dir(dir_path):
+    """
+    Whether dir_path contains IR shards
+    """
+    if not os.path.isdir(dir_path):
+        return False
+    with os.scandir(dir_path) as it:
+        return any(entry.name.endswith(SHARD_DATA_EXTENSION) for entry in it)
+
+
+def list_shards(dir_path):
+    """
+    return: the shard names in dir_path, sorted, e.g., ["part-00000", "part-00001"]
+    """
+    with os.scandir(dir_path) as it:
+        return sorted(
+            entry.name[: -len(SHARD_DATA_EXTENSION)]
+            for entry in it
+            if entry.name.endswith(SHARD_DATA_EXTENSION)
+        )
+
+
+def next_shard_index(dir_path, prefix="part"):
+    """
+    The index following the largest shard index in dir_path, e.g., 2 if `part-00001` exists
+    """
+    ls_used = list_shards(dir_path) if os.path.isdir(dir_path) else []
+    ls_idx = [
+        int(shard_name[len(prefix) + 1 :])
+        for shard_name in ls_used
+        if shard_name.startswith(f"{prefix}-")
+        and shard_name[len(prefix) + 1 :].isdigit()
+    ]
+    return max(ls_idx) + 1 if len(ls_idx) > 0 else 0
+
+
+def next_shard_name(dir_path, prefix="part"):
+    """
+    The shard name sorted after all the existing shards in dir_path, e.g., `part-00002`
+    """
+    return f"{prefix}-{next_shard_index(dir_path, prefix):05d}"
+
+
+def list_saved_scene_ids(save_dir):
+    """
+    return: set, the scene ids of the IRs saved in save_dir, in either layout
+    """
+    if not os.path.isdir(save_dir):
+        return set()
+    if is_shard_dir(save_dir):
+        return set(IRShardReader(save_dir).keys())
+    with os.scandir(save_dir) as it:
+        return set(
+            os.path.splitext(entry.name)[0]
+            for entry in it
+            if entry.name.endswith(IR_EXTENSIONS)
+        )
+
+
+def remove_shards(dir_path):
+    """
+    Remove all the shards and their indices in dir_path
+    """
+    ls_shards = list_shards(dir_path)
+    if len(ls_shards) > 0:
+        print(f"WARNING: Removing {len(ls_shards)} existing shards in {dir_path}")
+    for shard_name in ls_shards:
+        for extension in (SHARD_DATA_EXTENSION, SHARD_INDEX_EXTENSION):
+            fp = os.path.join(dir_path, shard_name + extension)
+            if os.path.exists(fp):
+                os.remove(fp)
+
+
+def ir_source(dir_path):
+    """
+    The source of the IRs in dir_path for `SceneIndex`:
+    an `IRShardReader` if dir_path contains shards, otherwise the per-file layout (dir_path, IR_EXTENSIONS).
+    """
+    if is_shard_dir(dir_path):
+        return IRShardReader(dir_path)
+    return (dir_path, IR_EXTENSIONS)
+
+
+class IRFileWriter(object):
+    """
+    Save one IR file per scene, `save_dir/{scene_id}.{ext}`
+    """
+
+    def __init__(self, save_dir, fmt="yaml"):
+        os.makedirs(save_dir, exist_ok=True)
+        self.save_dir = save_dir
+        self.fmt = fmt
+
+    def write(self, scene_id, ir):
+        dump_ir(
+            ir, os.path.join(self.save_dir, ir_file_name(scene_id, self.fmt)), self.fmt
+        )
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class IRShardWriter(object):
+    """
+    Append the IRs of many scenes to one shard file, and write its index on close
+    """
+
+    def __init__(self, save_dir, shard_name="part-00000", fmt="msgpack"):
+        assert fmt in IR_FORMATS, f"Unknown IR format {fmt}"
+        os.makedirs(save_dir, exist_ok=True)
+        self.fmt = fmt
+        self.data_fp = os.path.join(save_dir, shard_name + SHARD_DATA_EXTENSION)
+        self.index_fp = os.path.join(save_dir, shard_name + SHARD_INDEX_EXTENSION)
+        if os.path.exists(self.index_fp):
+            os.remove(self.index_fp)
+
+        self.f = open(self.data_fp, "wb")
+        self.f.write(
+            SHARD_MAGIC + fmt.encode().ljust(SHARD_HEADER_SIZE - len(SHARD_MAGIC))
+        )
+        self.ls_index = []  # [(scene_id, offset, length), ...]
+
+    def write(self, scene_id, ir):
+        key = scene_id.encode("utf-8")
+        assert len(key) <= MAX_SCENE_ID_LEN, f"Scene id {scene_id} is too long"
+        payload = dumps_ir(ir, self.fmt)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        offset = self.f.tell() + 2 * _UINT32.size + len(key)
+        self.f.write(
+            _UINT32.pack(len(key)) + key + _UINT32.pack(len(payload)) + payload
+        )
+        self.ls_index.append((key, offset, len(payload)))
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.f.close()
+        _save_index(self.index_fp, self.ls_index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_ir_writer(save_dir, fmt="yaml", layout="files", shard_name="part-00000"):
+    """
+    The IR writer of the layout, both providing `write(scene_id, ir)` and `close()`
+    """
+    assert (
+        layout in IR_LAYOUTS
+    ), f"Unknown IR layout {layout}, should be one of {IR_LAYOUTS}"
+    if layout == "shard":
+        return IRShardWriter(save_dir, shard_name=shard_name, fmt=fmt)
+    return IRFileWriter(save_dir, fmt=fmt)
+
+
+def _save_index(index_fp, ls_index):
+    arr_index = np.array(ls_index, dtype=SHARD_INDEX_DTYPE)
+    arr_index.sort(order="scene_id", kind="stable")
+    # ## Keep the last record of a scene written twice to the same shard
+    if len(arr_index) > 1:
+        is_last = np.append(
+            arr_index["scene_id"][1:] != arr_index["scene_id"][:-1], True
+        )
+        arr_index = arr_index[is_last]
+    np.save(index_fp, arr_index)
+
+
+def _read_header(data_mmap, data_fp):
+    assert data_mmap[: len(SHARD_MAGIC)] == SHARD_MAGIC, f"{data_fp} is not an IR shard"
+    return data_mmap[len(SHARD_MAGIC) : SHARD_HEADER_SIZE].decode().strip()
+
+
+def _rebuild_index(data_mmap, index_fp):
+    """
+    Scan the records of a shard whose index is missing, e.g., after an interrupted run
+    """
+    ls_index = []
+    offset = SHARD_HEADER_SIZE
+    while offset + _UINT32.size <= len(data_mmap):
+        (key_len,) = _UINT32.unpack_from(data_mmap, offset)
+        key = data_mmap[offset + _UINT32.size : offset + _UINT32.size + key_len]
+        offset += _UINT32.size + key_len
+        if offset + _UINT32.size > len(data_mmap):
+            break
+        (payload_len,) = _UINT32.unpack_from(data_mmap, offset)
+        offset += _UINT32.size
+        if offset + payload_len > len(data_mmap):
+            # ## truncated record
+            break
+        ls_index.append((key, offset, payload_len))
+        offset += payload_len
+    _save_index(index_fp, ls_index)
+
+
+class IRShardReader(object):
+    """
+    Random access to the IRs in the shards of a directory by scene id.
+    If a scene is stored in several shards, the shard with the largest name wins.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.ls_shards = []  # [(arr_index, data_mmap, fmt), ...]
+        for shard_name in list_shards(shard_dir):
+            data_fp = os.path.join(shard_dir, shard_name + SHARD_DATA_EXTENSION)
+            index_fp = os.path.join(shard_dir, shard_name + SHARD_INDEX_EXTENSION)
+            with open(data_fp, "rb") as f:
+                if os.path.getsize(data_fp) == 0:
+                    continue
+                data_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            fmt = _read_header(data_mmap, data_fp)
+            if not os.path.exists(index_fp):
+                print(f"WARNING: {index_fp} is missing, rebuilding it from {data_fp}")
+                _rebuild_index(data_mmap, index_fp)
+            arr_index = np.load(index_fp, mmap_mode="r")
+            self.ls_shards.append((arr_index, data_mmap, fmt))
+
+    def _locate(self, scene_id):
+        key = scene_id.encode("utf-8")
+        for arr_index, data_mmap, fmt in reversed(self.ls_shards):
+            arr_scene_id = arr_index["scene_id"]
+            pos = np.searchsorted(arr_scene_id, key)
+            if pos < len(arr_scene_id) and arr_scene_id[pos] == key:
+                return arr_index[pos], data_mmap, fmt
+        return None
+
+    def __contains__(self, scene_id):
+        return self._locate(scene_id) is not None
+
+    def raw(self, scene_id):
+        """
+        return: (the serialized IR as bytes, its format), without decoding it
+        """
+        located = self._locate(scene_id)
+        if located is None:
+            raise KeyError(scene_id)
+        record, data_mmap, fmt = located
+        offset, length = int(record["offset"]), int(record["length"])
+        return data_mmap[offset : offset + length], fmt
+
+    def __getitem__(self, scene_id):
+        payload, fmt = self.raw(scene_id)
+        return loads_ir(payload if fmt == "msgpack" else payload.decode("utf-8"), fmt)
+
+    def get(self, scene_id, default=None):
+        if scene_id not in self:
+            return default
+        return self[scene_id]
+
+    def keys(self):
+        """
+        return: the sorted scene ids in all the shards
+        """
+        if len(self.ls_shards) == 0:
+            return []
+        arr_scene_id = np.unique(
+            np.concatenate(
+                [arr_index["scene_id"] for arr_index, _, _ in self.ls_shards]
+            )
+        )
+        return [x.decode("utf-8") for x in arr_scene_id]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        for scene_id in self.keys():
+            yield scene_id, self[scene_id]
+
+
+def export_shards(shard_dir, save_dir, fmt="yaml"):
+    """
+    Export the IRs in the shards of shard_dir to the per-file layout in save_dir
+    """
+    reader = IRShardReader(shard_dir)
+    with IRFileWriter(save_dir, fmt=fmt) as writer:
+        for scene_id, ir in reader.items():
+            writer.write(scene_id, ir)
+    print(f"Exported {len(reader)} IRs from {shard_dir} to {save_dir}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the IR shards")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_export = subparsers.add_parser(
+        "export", help="export the shards to one IR file per scene"
+    )
+    parser_export.add_argument("shard_dir", help="the directory containing the shards")
+    parser_export.add_argument("save_dir", help="the directory to save the IR files")
+    parser_export.add_argument(
+        "--ir_format", type=str, default="yaml", choices=IR_FORMATS
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "export":
+        export_shards(args.shard_dir, args.save_dir, fmt=args.ir_format)
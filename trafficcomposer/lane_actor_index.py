@@ -0,0 +1,177 @@
+"""
+Depth-sorted index of the actors in each lane of a visual IR.
+
+The bottom y of the bounding box of an actor is used as the proxy of its distance to the
+ego vehicle: the larger the bottom y, the nearer the actor. `VisualIRGenerator.gen_visual_ir`
+saves the actors of each lane sorted by their bottom y in descending order (nearest first)
+as (class name, box) pairs; `LaneActorIndex` answers the nearest ahead/behind queries of
+`TrafficComposer.align_two_modalities` with a binary search on it.
+
+Run `python lane_actor_index.py` to check the queries against a brute-force search.
+"""
+
+import bisect
+
+
+def actor_bottom_y(actor):
+    """
+    The bottom y of the box of an actor in the visual IR
+    actor: (class_name, [x1, y1, x2, y2]); the visual IRs saved by earlier versions also carry the raw yolo_item string,
+        (class_name, yolo_item, [x1, y1, x2, y2]), or (class_name, yolo_item) before the boxes were added,
+        whose bottom y is recovered from the normalized yolo_item instead
+    """
+    if not isinstance(actor[1], str):
+        return actor[1][3]
+    if len(actor) > 2:
+        return actor[2][3]
+    if actor[0] == "ego":
+        # ## the ego vehicle is at the bottom of the image
+        return 1.0
+    _, _, y_center, _, height = actor[1].split(" ")
+    return float(y_center) + float(height) / 2
+
+
+class LaneActorIndex(object):
+    """
+    The actors of each lane sorted by their bottom y, with the matched actors marked.
+
+        matched: {lane_idx: [bool, ...]}, in the order of the actors in the visual IR
+        ego_lane_idx, ego_y: the lane and the bottom y of the ego vehicle
+
+    Every query returns the nearest unmatched actor and marks it as matched, so the
+    following queries in the same lane and direction return the next nearest one.
+    """
+
+    def __init__(self, dct_visual):
+        self.dct_visual = dct_visual
+        self.matched = {}
+        self.ego_lane_idx, self.ego_y = None, None
+        for lane in sorted(dct_visual.keys()):
+            self.matched[lane] = [False] * len(dct_visual[lane])
+            for idx, actor in enumerate(dct_visual[lane]):
+                if actor[0] == "ego":
+                    self.ego_lane_idx, self.ego_y = lane, actor_bottom_y(actor)
+                    self.matched[lane][idx] = True
+                    break
+        assert self.ego_lane_idx is not None, "The ego vehicle is not in the visual IR"
+
+        # ## {lane_idx: (bottom ys in ascending order, the positions of the actors in the visual IR)}, built on the first query of the lane
+        self.dct_sorted = {}
+        # ## {lane_idx: [the position in the sorted lane of the next actor ahead, ... behind]}
+        self.dct_cursor = {}
+
+    def _sort_lane(self, lane):
+        ls_actors = self.dct_visual[lane]
+        ls_y = [actor_bottom_y(actor) for actor in ls_actors]
+        # ## sorted by (bottom y, -position), so the actors at the same depth are matched in the order of the visual IR
+        ls_pos = list(range(len(ls_actors)))
+        if all(y_near >= y_far for y_near, y_far in zip(ls_y, ls_y[1:])):
+            # ## saved nearest first by `gen_visual_ir`
+            ls_pos.reverse()
+        else:
+            ls_pos.sort(key=lambda pos: (ls_y[pos], -pos))
+        ls_y = [ls_y[pos] for pos in ls_pos]
+        self.dct_sorted[lane] = (ls_y, ls_pos)
+
+        # ## The actors at the same depth as the ego vehicle count as ahead
+        idx_first_behind = bisect.bisect_right(ls_y, self.ego_y)
+        self.dct_cursor[lane] = [idx_first_behind - 1, idx_first_behind]
+
+    def _peek(self, lane, direction):
+        """
+        return: the position in the sorted lane of the nearest unmatched actor in the direction, or None
+        """
+        ls_y, ls_pos = self.dct_sorted[lane]
+        cursor = self.dct_cursor[lane]
+        matched = self.matched[lane]
+        if direction == "ahead":
+            # ## ahead of the ego vehicle: farther, i.e., smaller bottom y
+            while cursor[0] >= 0 and matched[ls_pos[cursor[0]]]:
+                cursor[0] -= 1
+            return cursor[0] if cursor[0] >= 0 else None
+        else:
+            while cursor[1] < len(ls_pos) and matched[ls_pos[cursor[1]]]:
+                cursor[1] += 1
+            return cursor[1] if cursor[1] < len(ls_pos) else None
+
+    def match_nearest(self, lane, direction=None):
+        """
+        Match the nearest unmatched actor in lane
+        direction: "ahead" or "behind" the ego vehicle; None for the nearest in either direction
+        return: the position of the actor in dct_visual[lane], or None if there is no unmatched actor
+        """
+        if lane not in self.dct_visual:
+            return None
+        if lane not in self.dct_sorted:
+            self._sort_lane(lane)
+        ls_y, ls_pos = self.dct_sorted[lane]
+
+        if direction in ("ahead", "behind"):
+            idx = self._peek(lane, direction)
+        else:
+            idx_ahead = self._peek(lane, "ahead")
+            idx_behind = self._peek(lane, "behind")
+            if idx_ahead is None or (
+                idx_behind is not None
+                and ls_y[idx_behind] - self.ego_y < self.ego_y - ls_y[idx_ahead]
+            ):
+                idx = idx_behind
+            else:
+                idx = idx_ahead
+
+        if idx is None:
+            return None
+        self.matched[lane][ls_pos[idx]] = True
+        return ls_pos[idx]
+
+
+if __name__ == "__main__":
+    import random
+
+    def brute_force(dct_visual, matched, ego_y, lane, direction):
+        # ## nearest first; at the same distance, ahead first, then the order of the cursor
+        ls_candidates = [
+            (
+                abs(actor_bottom_y(actor) - ego_y),
+                actor_bottom_y(actor) > ego_y,
+                -pos if actor_bottom_y(actor) > ego_y else pos,
+                pos,
+            )
+            for pos, actor in enumerate(dct_visual.get(lane, []))
+            if not matched[lane][pos]
+            and (
+                direction is None
+                or (direction == "ahead") == (actor_bottom_y(actor) <= ego_y)
+            )
+        ]
+        return min(ls_candidates)[-1] if len(ls_candidates) > 0 else None
+
+    rng = random.Random(0)
+    num_checked = 0
+    for _ in range(2000):
+        img_h = 720
+        ego_lane = rng.randint(0, 3)
+        dct_visual = {lane: [] for lane in range(rng.randint(ego_lane + 1, 6))}
+        for _ in range(rng.randint(0, 60)):
+            y2 = rng.randint(300, img_h + 40)
+            actor = ("car", [0, y2 - 30, 50, y2])
+            dct_visual[rng.choice(list(dct_visual.keys()))].append(actor)
+        dct_visual[ego_lane].append(("ego", [600, img_h, 680, img_h]))
+        if rng.random() < 0.5:
+            # ## sorted nearest first, as saved by `gen_visual_ir`
+            for lane in dct_visual:
+                dct_visual[lane].sort(key=lambda actor: -actor[1][3])
+
+        actor_index = LaneActorIndex(dct_visual)
+        ls_matched = {lane: list(flags) for lane, flags in actor_index.matched.items()}
+        for _ in range(rng.randint(1, 40)):
+            lane = rng.randint(-1, len(dct_visual))
+            direction = rng.choice(["ahead", "behind", None])
+            expected = brute_force(dct_visual, ls_matched, img_h, lane, direction)
+            actual = actor_index.match_nearest(lane, direction)
+            assert actual == expected, (dct_visual, lane, direction, actual, expected)
+            if expected is not None:
+                ls_matched[lane][expected] = True
+            num_checked += 1
+
+    print(f"LaneActorIndex matches the brute-force search on {num_checked} queries.")
@@ -0,0 +1,487 @@
+"""
+Command (from the project root): python -m trafficcomposer.pipeline
+---------------------------------
+This script streams every scene through the whole workflow at once, instead of running
+`gpt_text_parser.py`, `extract_lane.py`, `extract_actor.py`, `gen_visual_ir.py` and `trafficcomposer.py`
+one after another over the whole dataset.
+
+    source ──> [textual IR] ─────────────────────────────────────────────────┐
+          └──> [lane detection] ──> [actor detection] ──> [visual IR] ──> [merge] ──> merged IR
+                                                                         ─┘
+
+The stages run in their own threads and are connected by bounded queues, so a slow stage
+blocks the stages before it (back-pressure). A scene is merged and written as soon as both
+of its halves exist, and at most `max_in_flight` scenes are between the source and the merge.
+The textual IRs and the visual IRs are kept in memory, only the merged IRs are saved.
+
+The lanes and the actors are detected with CLRNet and YOLOv10 by default. To reuse the
+detection results of `extract_lane.py` and `extract_actor.py`, pass --lane_detection_dir and --obj_detection_dir.
+"""
+
+import os
+import sys
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import threading
+import traceback
+from collections import defaultdict
+
+from tqdm import tqdm
+
+DIR_TRAFFICCOMPOSER = os.path.dirname(os.path.abspath(__file__))
+
+# ## `trafficcomposer.py` imports its neighbours as top-level modules, e.g., `config` and `ir_io`
+sys.path.append(DIR_TRAFFICCOMPOSER)
+from trafficcomposer.trafficcomposer import TrafficComposer
+from gen_visual_ir.utils import SceneIndex, scan_scene_files
+from ir_io import IR_FORMATS
+from ir_store import remove_shards, IR_LAYOUTS
+
+# ## `gen_visual_ir.py` imports its neighbours as top-level modules, e.g., `utils` and `lane_assigner`
+sys.path.append(os.path.join(DIR_TRAFFICCOMPOSER, "gen_visual_ir"))
+from trafficcomposer.gen_visual_ir.gen_visual_ir import VisualIRGenerator
+from lane_io import LANE_FILE_SUFFIXES
+from actor_filter import ACTOR_TYPES
+from trafficcomposer.gen_textual_ir.gen_textual_ir import gen_single_textual_ir
+
+# ## The end marker passed through the queues after the last scene, as (_END, error),
+# ## where error is the exception that stopped a stage or the feeder early, or None
+_END = object()
+
+
+class Stage(object):
+    """
+    A stage of the pipeline: num_workers threads take (scene_id, item) from in_queue,
+    and put (scene_id, fn(scene_id, item)) to the in_queue of the next stage.
+    A failed scene, i.e., fn raises or returns None, is passed on as (scene_id, None),
+    so the merge stage still learns that the scene is finished.
+    If a worker itself dies, the end marker is still passed on, carrying the exception.
+    """
+
+    def __init__(self, name, fn, num_workers=1, queue_size=16):
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.in_queue = queue.Queue(maxsize=queue_size)
+
+        self.lock = threading.Lock()
+        self.num_running = 0
+        self.busy_time = 0.0
+        self.num_done = 0
+
+    def start(self, out_queue):
+        self.out_queue = out_queue
+        self.num_running = self.num_workers
+        self.error = None
+        self.ls_threads = [
+            threading.Thread(target=self.work, name=f"{self.name}-{idx}", daemon=True)
+            for idx in range(self.num_workers)
+        ]
+        for thread in self.ls_threads:
+            thread.start()
+
+    def work(self):
+        error = None
+        try:
+            while True:
+                task = self.in_queue.get()
+                scene_id, item = task
+                if scene_id is _END:
+                    # ## leave the end marker for the other workers of this stage
+                    self.in_queue.put(task)
+                    error = item
+                    break
+
+                if item is not None:
+                    t_start = time.time()
+                    try:
+                        item = self.fn(scene_id, item)
+                    except Exception:
+                        print(
+                            f"WARNING: stage {self.name} failed on scene {scene_id}! Skipping..."
+                        )
+                        traceback.print_exc()
+                        item = None
+                    with self.lock:
+                        self.busy_time += time.time() - t_start
+                        self.num_done += 1
+                self.out_queue.put((scene_id, item))
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            # ## the last worker passes the end marker to the next stage,
+            # ## and a failed worker passes it at once, so the merge loop stops without waiting
+            with self.lock:
+                self.num_running -= 1
+                is_last = self.num_running == 0
+                if self.error is None:
+                    self.error = error
+            if is_last or error is not None:
+                self.out_queue.put((_END, self.error))
+
+
+class StreamingPipeline(object):
+    """
+    Stream the scenes through the textual branch and the visual branch concurrently, and merge each scene
+    with `TrafficComposer.align_two_modalities` as soon as both of its IRs are ready.
+    """
+
+    def __init__(
+        self,
+        composer,
+        llm_runner,
+        lane_detector,
+        obj_detector,
+        text_workers=4,
+        queue_size=16,
+        max_in_flight=64,
+        scratch_dir=None,
+        actor_types=None,
+    ):
+        """
+        composer: TrafficComposer, merges the IRs and saves the merged IRs following its save_dir, ir_format and ir_layout
+        llm_runner: callable, maps the prompt to the raw output of the LLM, see `gpt_text_parser.OpenAIClientRunner`
+        lane_detector: callable, (scene_id, img_path) -> the path to the lane detection result (.lines.npy or .lines.txt), or the lanes in memory
+        obj_detector: callable, (scene_id, img_path) -> the path to the actor detection result (YOLO .txt), or the labels in memory
+        text_workers: int, the number of concurrent LLM calls
+        queue_size: int, the capacity of the queue in front of each stage
+        max_in_flight: int, the maximum number of scenes between the source and the merge
+        scratch_dir: str, the detection results saved under scratch_dir are removed once the visual IR is generated
+        actor_types: list of str, only keep the actors of these types in the visual IRs, see `actor_filter.ACTOR_TYPES`
+        """
+        self.composer = composer
+        self.llm_runner = llm_runner
+        self.lane_detector = lane_detector
+        self.obj_detector = obj_detector
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight
+        self.scratch_dir = scratch_dir
+
+        # ## In memory only, nothing is saved by the visual IR generator
+        self.visual_ir_generator = VisualIRGenerator(
+            None, None, None, None, actor_types=actor_types
+        )
+        self.visual_ir_generator.debug = False
+
+        self.ls_text_stages = [
+            Stage("textual_ir", self.gen_textual_ir, text_workers, queue_size),
+        ]
+        self.ls_visual_stages = [
+            Stage("lane_detection", self.detect_lanes, 1, queue_size),
+            Stage("actor_detection", self.detect_actors, 1, queue_size),
+            Stage("visual_ir", self.gen_visual_ir, 1, queue_size),
+        ]
+
+    def gen_textual_ir(self, scene_id, item):
+        with open(item["description"], "r") as f:
+            traffic_scenario_description = f.read()
+        if traffic_scenario_description == "":
+            print(f"WARNING: file {item['description']} is empty! Skipping...")
+            return None
+
+        textual_ir = gen_single_textual_ir(
+            traffic_scenario_description, self.llm_runner
+        )
+        if textual_ir is None:
+            print(
+                f"WARNING: Cannot extract the IR for {item['description']}! Skipping..."
+            )
+            return None
+        return {"textual_ir": textual_ir}
+
+    def detect_lanes(self, scene_id, item):
+        return dict(item, lane=self.lane_detector(scene_id, item["image"]))
+
+    def detect_actors(self, scene_id, item):
+        return dict(item, label=self.obj_detector(scene_id, item["image"]))
+
+    def gen_visual_ir(self, scene_id, item):
+        visual_ir = self.visual_ir_generator.gen_visual_ir(
+            item["image"], item["lane"], item["label"]
+        )
+        if self.scratch_dir is not None:
+            for fp in (item["lane"], item["label"]):
+                if isinstance(fp, str) and os.path.abspath(fp).startswith(
+                    self.scratch_dir + os.sep
+                ):
+                    os.remove(fp)
+        return {"visual_ir": visual_ir}
+
+    def feed(self, scene_index, in_flight, abort):
+        """
+        Put the scenes to the first stage of both branches, blocking while max_in_flight scenes are unfinished.
+        Stops early once abort is set by the merge loop.
+        """
+        text_queue = self.ls_text_stages[0].in_queue
+        visual_queue = self.ls_visual_stages[0].in_queue
+        error = None
+        try:
+            for scene_id, description_fp, img_path in scene_index:
+                in_flight.acquire()
+                if abort.is_set():
+                    break
+                text_queue.put((scene_id, {"description": description_fp}))
+                visual_queue.put((scene_id, {"image": img_path}))
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            text_queue.put((_END, error))
+            visual_queue.put((_END, error))
+
+    def main(self, description_dir, source_img_dir):
+        """
+        Generate the merged IR of every scene having both a description (.txt) and a reference image.
+        """
+        os.makedirs(self.composer.save_dir, exist_ok=True)
+        if self.composer.ir_layout == "shard":
+            # ## The shards of a previous run would shadow the new results
+            remove_shards(self.composer.save_dir)
+
+        scene_index = SceneIndex(
+            {
+                "description": (description_dir, ".txt"),
+                "image": (source_img_dir, None),
+            }
+        )
+        scene_index.report_incomplete()
+
+        # ## connect the stages of each branch, and both branches to the merge queue
+        merge_queue = queue.Queue(maxsize=self.queue_size)
+        for ls_stages in (self.ls_text_stages, self.ls_visual_stages):
+            for stage, next_stage in zip(ls_stages, ls_stages[1:]):
+                stage.start(next_stage.in_queue)
+            ls_stages[-1].start(merge_queue)
+
+        in_flight = threading.Semaphore(self.max_in_flight)
+        abort = threading.Event()
+        t_start = time.time()
+        feeder = threading.Thread(
+            target=self.feed, args=(scene_index, in_flight, abort), daemon=True
+        )
+        feeder.start()
+
+        # ## merge in the main thread, the only user of the writer
+        dct_pending = defaultdict(list)  # {scene_id: [the output of each branch]}
+        num_ended, num_merged, num_failed = 0, 0, 0
+        time_first_merged = None
+        try:
+            with self.composer.open_writer() as writer, tqdm(
+                total=len(scene_index)
+            ) as pbar:
+                while num_ended < 2:
+                    scene_id, item = merge_queue.get()
+                    if scene_id is _END:
+                        if item is not None:
+                            # ## a stage or the feeder died, the scenes behind it would never arrive
+                            raise item
+                        num_ended += 1
+                        continue
+
+                    dct_pending[scene_id].append(item)
+                    if len(dct_pending[scene_id]) < 2:
+                        continue
+
+                    ls_items = dct_pending.pop(scene_id)
+                    if None in ls_items:
+                        num_failed += 1
+                    else:
+                        dct_scene = dict(ls_items[0], **ls_items[1])
+                        try:
+                            self.composer.merge_and_write(
+                                writer,
+                                scene_id,
+                                dct_scene["textual_ir"],
+                                dct_scene["visual_ir"],
+                            )
+                            num_merged += 1
+                        except Exception:
+                            print(
+                                f"WARNING: merge failed on scene {scene_id}! Skipping..."
+                            )
+                            traceback.print_exc()
+                            num_failed += 1
+                        if time_first_merged is None:
+                            time_first_merged = time.time() - t_start
+                    in_flight.release()
+                    pbar.update(1)
+        finally:
+            # ## stop the feeder, which may be waiting for a free slot
+            abort.set()
+            in_flight.release()
+        feeder.join()
+        wall_time = time.time() - t_start
+
+        print(
+            f"Merged {num_merged} scenes ({num_failed} failed) in {wall_time:.2f}s "
+            f"({num_merged / max(wall_time, 1e-9):.2f} scenes/s)"
+        )
+        if time_first_merged is not None:
+            print(f"  the first merged IR was written after {time_first_merged:.2f}s")
+        for stage in self.ls_text_stages + self.ls_visual_stages:
+            print(
+                f"  stage {stage.name}: {stage.num_done} scenes, {stage.busy_time:.2f}s busy "
+                f"with {stage.num_workers} worker(s)"
+            )
+
+
+class DetectionLookup(object):
+    """
+    Detector returning the existing detection results of the scene, e.g., saved by `extract_lane.py` or `extract_actor.py`
+    """
+
+    def __init__(self, dir_path, suffix):
+        self.dir_path = dir_path
+        self.dct_file = dict(scan_scene_files(dir_path, suffix))
+
+    def __call__(self, scene_id, img_path):
+        assert (
+            scene_id in self.dct_file
+        ), f"No detection result of scene {scene_id} in {self.dir_path}."
+        return os.path.join(self.dir_path, self.dct_file[scene_id])
+
+
+def parse_args():
+    from trafficcomposer.config import SOURCE_IMAGE_DIR, MERGED_IR_SAVE_DIR
+    from trafficcomposer.gen_textual_ir.config_textual import DESCRIPTION_DIR
+
+    parser = argparse.ArgumentParser(
+        description="Stream the scenes through the textual branch, the visual branch and the merge"
+    )
+    parser.add_argument("--description_dir", type=str, default=DESCRIPTION_DIR)
+    parser.add_argument("--source_img_dir", type=str, default=SOURCE_IMAGE_DIR)
+    parser.add_argument("--save_dir", type=str, default=MERGED_IR_SAVE_DIR)
+    parser.add_argument("--model", type=str, default="gpt-4o", help="the LLM model")
+    parser.add_argument(
+        "--lane_config",
+        type=str,
+        default=os.path.join(
+            DIR_TRAFFICCOMPOSER,
+            "gen_visual_ir/clrnet/configs/clrnet/clr_dla34_culane.py",
+        ),
+        help="the CLRNet config file",
+    )
+    parser.add_argument(
+        "--lane_checkpoint",
+        type=str,
+        default=os.path.join(DIR_TRAFFICCOMPOSER, "gen_visual_ir/culane_dla34.pth"),
+        help="the CLRNet checkpoint file",
+    )
+    parser.add_argument(
+        "--lane_detection_dir",
+        type=str,
+        default=None,
+        help="reuse the lane detection results (.lines.npy or .lines.txt) in this directory instead of running CLRNet",
+    )
+    parser.add_argument(
+        "--obj_detection_dir",
+        type=str,
+        default=None,
+        help="reuse the actor detection results (.txt) in this directory instead of running YOLOv10",
+    )
+    parser.add_argument(
+        "--actor_backend",
+        type=str,
+        default="torch",
+        choices=["torch", "onnx", "openvino"],
+        help="run YOLOv10 eagerly, or exported to ONNX or OpenVINO on CPU, see gen_visual_ir/extract_actor.py",
+    )
+    parser.add_argument(
+        "--actor_types",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=ACTOR_TYPES,
+        help="only keep the actors of these types, e.g., --actor_types car truck bus pedestrian cyclist; all the COCO classes if not set",
+    )
+    parser.add_argument(
+        "--keep_detections",
+        action="store_true",
+        help="save the detection results of the models to the scratch directory and keep them, instead of passing them in memory only",
+    )
+    parser.add_argument(
+        "--text_workers", type=int, default=4, help="the number of concurrent LLM calls"
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=16,
+        help="the capacity of the queue in front of each stage",
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=64,
+        help="the maximum number of scenes being processed at the same time",
+    )
+    parser.add_argument("--ir_format", type=str, default="yaml", choices=IR_FORMATS)
+    parser.add_argument("--ir_layout", type=str, default="files", choices=IR_LAYOUTS)
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    from trafficcomposer.gen_textual_ir.gpt_text_parser import OpenAIClientRunner
+
+    # ## The detection results of the models are passed to `gen_visual_ir` in memory,
+    # ## and only written to a scratch directory with --keep_detections
+    scratch_dir = os.path.abspath(tempfile.mkdtemp(prefix="trafficcomposer_pipeline_"))
+
+    if args.lane_detection_dir is not None:
+        lane_detector = DetectionLookup(args.lane_detection_dir, LANE_FILE_SUFFIXES)
+    else:
+        from extract_lane import ClrnetLaneDetector, load_cfg
+
+        lane_detector = ClrnetLaneDetector(
+            load_cfg(
+                args.lane_config,
+                load_from=args.lane_checkpoint,
+                work_dirs=os.path.join(scratch_dir, "lane"),
+            ),
+            save_results=args.keep_detections,
+        )
+
+    if args.obj_detection_dir is not None:
+        obj_detector = DetectionLookup(args.obj_detection_dir, ".txt")
+    else:
+        from extract_actor import YoloActorDetector
+
+        obj_detector = YoloActorDetector(
+            save_dir=(
+                os.path.join(scratch_dir, "actor") if args.keep_detections else None
+            ),
+            backend=args.actor_backend,
+            actor_types=args.actor_types,
+        )
+
+    pipeline = StreamingPipeline(
+        composer=TrafficComposer(
+            source_image_dir=args.source_img_dir,
+            textual_ir_dir=None,
+            visual_ir_dir=None,
+            save_dir=args.save_dir,
+            ir_format=args.ir_format,
+            ir_layout=args.ir_layout,
+        ),
+        llm_runner=OpenAIClientRunner(model=args.model),
+        lane_detector=lane_detector,
+        obj_detector=obj_detector,
+        text_workers=args.text_workers,
+        queue_size=args.queue_size,
+        max_in_flight=args.max_in_flight,
+        scratch_dir=None if args.keep_detections else scratch_dir,
+        actor_types=args.actor_types,
+    )
+    pipeline.main(args.description_dir, args.source_img_dir)
+
+    if args.keep_detections:
+        print(f"The detection results are kept in {scratch_dir}")
+    else:
+        shutil.rmtree(scratch_dir)
@@ -1,8 +1,14 @@
 import os
+import sys
 from tqdm import tqdm
 import json
 import yaml
 import copy
+import time
+import argparse
+import itertools
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from pprint import pprint
 
@@ -13,7 +19,64 @@ from config import (
     VISUAL_IR_LOAD_DIR,
     MERGED_IR_SAVE_DIR,
 )
-from gen_visual_ir.utils import is_image_file
+from gen_visual_ir.utils import SceneIndex
+from ir_io import load_ir, loads_ir, IR_FORMATS
+from ir_store import (
+    open_ir_writer,
+    ir_source,
+    IRShardReader,
+    remove_shards,
+    next_shard_index,
+    list_saved_scene_ids,
+    IR_LAYOUTS,
+)
+from ir_manifest import BuildManifest, hash_inputs, code_version
+from lane_actor_index import LaneActorIndex
+
+# ## The shard readers of the current process, {shard_dir: IRShardReader}, opened on first use,
+# ## so every worker process maps the shards itself and only the references of the IRs are pickled
+_dct_shard_reader = {}
+
+
+def _shard_reader(shard_dir):
+    reader = _dct_shard_reader.get(shard_dir)
+    if reader is None:
+        reader = _dct_shard_reader[shard_dir] = IRShardReader(shard_dir)
+    return reader
+
+
+def ir_ref(source, ref):
+    """
+    The reference of an IR yielded by `SceneIndex.iter_refs`, which can be sent to a worker process
+    source: the source of the IR in the `SceneIndex`, see `ir_source`
+    return: str, the path to the IR file; or (shard_dir, scene_id), the IR in the shards of shard_dir
+    """
+    if isinstance(source, tuple):
+        return ref
+    return (source.shard_dir, ref)
+
+
+def resolve_ir_ref(ref):
+    """
+    return: the IR loaded from the shards if ref is (shard_dir, scene_id), otherwise ref itself,
+    i.e., the path to the IR file or the IR in memory, which `align_two_modalities` takes either way
+    """
+    if not isinstance(ref, tuple):
+        return ref
+    shard_dir, scene_id = ref
+    return _shard_reader(shard_dir)[scene_id]
+
+
+def hash_ir_refs(*ls_ref):
+    """
+    The input hash of the IRs, from the file contents or the serialized IRs in the shards, without decoding them
+    """
+    return hash_inputs(
+        *[
+            ref if isinstance(ref, str) else _shard_reader(ref[0]).raw(ref[1])[0]
+            for ref in ls_ref
+        ]
+    )
 
 
 class TrafficComposer:
@@ -23,17 +86,34 @@ class TrafficComposer:
         textual_ir_dir=TEXTUAL_IR_LOAD_DIR,
         visual_ir_dir=VISUAL_IR_LOAD_DIR,
         save_dir=MERGED_IR_SAVE_DIR,
+        ir_format="yaml",
+        ir_layout="files",
+        incremental=False,
     ):
+        """
+        ir_format: str, the format of the saved merged IRs, one of `ir_io.IR_FORMATS`.
+            The input IRs can be in any of the formats.
+        ir_layout: str, "files" saves one merged IR file per scene; "shard" packs them into shards, see `ir_store`.
+            The input IRs can be in either layout.
+        incremental: bool, keep the existing merged IRs and only merge the scenes whose textual or visual IR changed, see `ir_manifest`.
+        """
         self.debug = False
 
         self.source_img_dir = source_image_dir
         self.textual_ir_dir = textual_ir_dir
         self.visual_ir_dir = visual_ir_dir
         self.save_dir = save_dir
+        self.ir_format = ir_format
+        self.ir_layout = ir_layout
+        self.incremental = incremental
 
     def align_two_modalities(self, textual_ir_fp, visual_ir_fp):
         """
         Merge the textual ir and the visual ir
+        Args:
+            textual_ir_fp: str, the path to the textual IR file; or dict, the textual IR itself, e.g., returned by `post_process`
+            visual_ir_fp: str, the path to the visual IR file; or dict, the visual IR itself, e.g., returned by `VisualIRGenerator.gen_visual_ir`
+        The in-memory IRs are not modified.
         """
         dct_direction = {
             "left": "left",
@@ -44,25 +124,20 @@ class TrafficComposer:
         }
 
         # ## load the Textual IR
-        assert isinstance(textual_ir_fp, str)
-        if type(textual_ir_fp) == str:
-            os.path.exists(textual_ir_fp), f"{textual_ir_fp} does not exist"
-            with open(textual_ir_fp, "r") as f:
-                txt = f.read()
-                dct_text = yaml.safe_load(txt)
+        if isinstance(textual_ir_fp, str):
+            dct_text = load_ir(textual_ir_fp)
             if type(dct_text) == str:
-                dct_text = yaml.load(dct_text, Loader=yaml.FullLoader)
+                dct_text = loads_ir(dct_text)
         else:
-            dct_text = copy.copy(textual_ir_fp)
+            # ## The participants are updated in place during the alignment
+            dct_text = copy.deepcopy(textual_ir_fp)
 
         # ## load the Visual IR
-        assert isinstance(visual_ir_fp, str)
-        if type(visual_ir_fp) == str:
-            os.path.exists(visual_ir_fp), f"{visual_ir_fp} does not exist"
-            with open(visual_ir_fp, "r") as f:
-                dct_visual = yaml.load(f, Loader=yaml.FullLoader)
+        if isinstance(visual_ir_fp, str):
+            dct_visual = load_ir(visual_ir_fp)
         else:
-            dct_visual = copy.copy(visual_ir_fp)
+            # ## The visual IR is read only
+            dct_visual = visual_ir_fp
 
         assert (
             dct_text is not None and dct_visual is not None
@@ -78,12 +153,9 @@ class TrafficComposer:
             print(f"type(dct_text): {type(dct_text)}")
             print(f"type(dct_visual): {type(dct_visual)}")
 
-        # ## register all the detected vehicles in dct_visual
-        dct_vehicle = {}
-        for lane in dct_visual.keys():
-            dct_vehicle[lane] = []
-            for vehicle in dct_visual[lane]:
-                dct_vehicle[lane].append(False)
+        # ## register all the detected vehicles in dct_visual, sorted by their depth in each lane
+        # ## actor_index.matched is in the order of the lanes, so the result does not depend on how the visual IR was stored
+        actor_index = LaneActorIndex(dct_visual)
 
         # ## Start from copying the dct_text
         dct_aligned = copy.copy(dct_text)
@@ -95,17 +167,9 @@ class TrafficComposer:
         # ## Register the lane number
         dct_aligned["lane_number"] = len(list(dct_visual.keys()))
 
-        # ## Search for the ego vehicle
-        # ## To find the lane index of the ego vehicle
-        for idx_lane in sorted(list(dct_visual.keys())):
-            # print(f"idx_lane: {idx_lane}")
-            for idx_vehicle, vehicle in enumerate(dct_visual[idx_lane]):
-                if "ego" == vehicle[0]:
-                    dct_aligned["participant"]["ego_vehicle"]["lane_idx"] = idx_lane
-                    ego_lane_idx = idx_lane
-
-                    dct_vehicle[idx_lane][idx_vehicle] = True
-                    break
+        # ## The lane index of the ego vehicle
+        ego_lane_idx = actor_index.ego_lane_idx
+        dct_aligned["participant"]["ego_vehicle"]["lane_idx"] = ego_lane_idx
 
         for pariticipant in dct_text["participant"]:
 
@@ -139,24 +203,20 @@ class TrafficComposer:
                     lane_idx = ego_lane_idx
                 dct_aligned["participant"][pariticipant]["lane_idx"] = lane_idx
 
-                # ## Find the nearest vehicle in lane_idx
-                if lane_idx != ego_lane_idx:
-                    dct_vehicle[lane_idx][-1] = True
-                else:
-                    try:
-                        # ## The vehicle is in the same lane as the ego vehicle
-                        dct_vehicle[lane_idx][-2] = True
-                    except:
-                        pass
+                # ## Find the nearest vehicle in lane_idx, ahead of or behind the ego vehicle if specified
+                actor_index.match_nearest(
+                    lane_idx,
+                    direction if direction in ("ahead", "behind") else None,
+                )
         idx_other_vehicle = len(dct_text["participant"]) - 1
 
         if self.debug:
-            print("dct_vehicle:")
-            pprint(dct_vehicle)
+            print("actor_index.matched:")
+            pprint(actor_index.matched)
 
-        for lane in dct_vehicle.keys():
-            for idx, vehicle in enumerate(dct_vehicle[lane]):
-                if not vehicle:
+        for lane in actor_index.matched.keys():
+            for idx, is_matched in enumerate(actor_index.matched[lane]):
+                if not is_matched:
                     # ## The vehicle is not registered in the text modality
                     # ## Register the vehicle in the text modality
                     if lane < ego_lane_idx:
@@ -175,7 +235,7 @@ class TrafficComposer:
                         # "speed_limit_unit": "km/h"
                         "type": dct_visual[lane][idx][0],
                     }
-                    dct_vehicle[lane][idx] = True
+                    actor_index.matched[lane][idx] = True
 
         if self.debug:
             print("dct_aligned:")
@@ -183,61 +243,262 @@ class TrafficComposer:
 
         return dct_aligned
 
-    def main(self):
+    def open_writer(self, shard_name="part-00000"):
+        """
+        The writer of the merged IRs, following self.ir_format and self.ir_layout
+        """
+        return open_ir_writer(
+            self.save_dir,
+            fmt=self.ir_format,
+            layout=self.ir_layout,
+            shard_name=shard_name,
+        )
+
+    def merge_and_write(self, writer, scene_id, textual_ir_fp, visual_ir_fp):
+        """
+        Merge the textual IR and the visual IR of one scene and write the merged IR with writer
+        textual_ir_fp, visual_ir_fp: see `align_two_modalities`, or the references of the IRs, see `ir_ref`
+        """
+        merged_ir = self.align_two_modalities(
+            textual_ir_fp=resolve_ir_ref(textual_ir_fp),
+            visual_ir_fp=resolve_ir_ref(visual_ir_fp),
+        )
+        writer.write(scene_id, merged_ir)
+
+    def main(self, workers=1, chunk_size=None):
+        """
+        Merge the textual IR and the visual IR of every scene.
+        Args:
+            workers (int): The number of worker processes. 1 runs the merge in the current process.
+            chunk_size (int): The number of scenes submitted to a worker process at a time.
+                By default, every worker receives about 4 chunks.
+        """
         os.makedirs(self.save_dir, exist_ok=True)
+        if self.ir_layout == "shard" and not self.incremental:
+            # ## The shards of a previous run would shadow the new results
+            remove_shards(self.save_dir)
+
+        # ## pair the files of each scene by scene id
+        textual_source = ir_source(self.textual_ir_dir)
+        visual_source = ir_source(self.visual_ir_dir)
+        scene_index = SceneIndex(
+            {
+                "image": (self.source_img_dir, None),
+                "textual_ir": textual_source,
+                "visual_ir": visual_source,
+            }
+        )
+        scene_index.report_incomplete()
+
+        # ## tasks: (scene_id, textual_ir_ref, visual_ir_ref, input_hash), generated lazily;
+        # ## the IRs stored in shards are only loaded by the process merging them, see `ir_ref`
+        iter_tasks = (
+            (
+                scene_id,
+                ir_ref(textual_source, textual_ref),
+                ir_ref(visual_source, visual_ref),
+                None,
+            )
+            for scene_id, _, textual_ref, visual_ref in scene_index.iter_refs()
+        )
+        num_scenes = len(scene_index)
+        if self.incremental:
+            manifest = BuildManifest(self.save_dir, self.version())
+            set_saved_scene_ids = list_saved_scene_ids(self.save_dir)
+            # ## the number of the scenes to merge is only known once all of them are hashed
+            num_scenes = None
+            ls_num_skipped = [0]
+
+            def iter_outdated(iter_tasks):
+                for scene_id, textual_ref, visual_ref, _ in iter_tasks:
+                    input_hash = hash_ir_refs(textual_ref, visual_ref)
+                    if scene_id in set_saved_scene_ids and manifest.is_up_to_date(
+                        scene_id, input_hash
+                    ):
+                        ls_num_skipped[0] += 1
+                        continue
+                    yield scene_id, textual_ref, visual_ref, input_hash
+
+            iter_tasks = iter_outdated(iter_tasks)
+
+        # ## In the incremental shard layout, the new shards shadow the merged IRs of the existing shards
+        shard_idx_base = next_shard_index(self.save_dir)
+
+        if workers <= 1:
+            with self.open_writer(f"part-{shard_idx_base:05d}") as writer:
+                for scene_id, textual_ir_ref, visual_ir_ref, input_hash in tqdm(
+                    iter_tasks, total=num_scenes
+                ):
+                    self.merge_and_write(
+                        writer, scene_id, textual_ir_ref, visual_ir_ref
+                    )
+                    if self.incremental:
+                        manifest.update(scene_id, input_hash)
+        else:
+            self.merge_parallel(
+                iter_tasks,
+                workers,
+                chunk_size,
+                shard_idx_base,
+                manifest if self.incremental else None,
+                num_scenes=num_scenes if num_scenes is not None else len(scene_index),
+            )
+
+        if self.incremental:
+            print(f"{ls_num_skipped[0]} scenes are up to date and skipped.")
+            manifest.retain(scene_index.complete_scene_ids())
+            manifest.save()
 
-        # ## Generate the source image name list
-        ls_source_img_names = os.listdir(self.source_img_dir)
-        ls_source_img_names = [x for x in ls_source_img_names if is_image_file(x)]
-        ls_source_img_names.sort()
-
-        # ## load the visual IR file name list
-        ls_visual_ir_files = os.listdir(self.visual_ir_dir)
-        ls_visual_ir_files = [x for x in ls_visual_ir_files if x.endswith(".yaml")]
-        ls_visual_ir_files.sort()
-
-        # ## load the textual IR file name list
-        ls_textual_ir_files = os.listdir(self.textual_ir_dir)
-        ls_textual_ir_files = [x for x in ls_textual_ir_files if x.endswith(".yaml")]
-        ls_textual_ir_files.sort()
-
-        for idx, source_img_name in enumerate(tqdm(ls_source_img_names)):
-            source_img_name_no_ext = ".".join(source_img_name.split(".")[:-1])
-            source_img_path = os.path.join(self.source_img_dir, source_img_name)
-
-            # ## locate the visual IR file
-            visual_ir_file_name = ls_visual_ir_files[idx]
-            assert visual_ir_file_name.startswith(
-                f"{source_img_name_no_ext}."
-            ), f"{visual_ir_file_name} does not match {source_img_name}"
-
-            # ## locate the textual IR file
-            textual_ir_file_name = ls_textual_ir_files[idx]
-            assert textual_ir_file_name.startswith(
-                f"{source_img_name_no_ext}."
-            ), f"{textual_ir_file_name} does not match {source_img_name}"
-
-            merged_ir = self.align_two_modalities(
-                textual_ir_fp=os.path.join(self.textual_ir_dir, textual_ir_file_name),
-                visual_ir_fp=os.path.join(self.visual_ir_dir, visual_ir_file_name),
+    def merge_parallel(
+        self, iter_tasks, workers, chunk_size, shard_idx_base, manifest, num_scenes
+    ):
+        """
+        Merge the tasks with a process pool, see `main`
+        iter_tasks: iterable of tasks, consumed chunk by chunk as the workers need them
+        manifest: BuildManifest or None, updated with the input hashes of the merged chunks
+        num_scenes: the number of tasks, or an upper bound of it, to size the chunks and the progress bar
+        """
+        # ## Every chunk is written to its own files or shard,
+        # ## so the output does not depend on the completion order
+        if chunk_size is None:
+            chunk_size = max(1, num_scenes // (workers * 4))
+        iter_tasks = iter(iter_tasks)
+        iter_chunks = enumerate(
+            iter(lambda: list(itertools.islice(iter_tasks, chunk_size)), [])
+        )
+
+        num_merged_total = 0
+        dct_worker_stat = defaultdict(
+            lambda: [0, 0.0]
+        )  # {pid: [num_scenes, busy_time]}
+        t_start = time.time()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+
+            def submit_next():
+                """
+                return: whether a chunk is submitted, i.e., there are tasks left
+                """
+                for chunk_idx, chunk in iter_chunks:
+                    future = executor.submit(
+                        _merge_chunk,
+                        self,
+                        f"part-{shard_idx_base + chunk_idx:05d}",
+                        [task[:3] for task in chunk],
+                    )
+                    dct_future2chunk[future] = chunk
+                    return True
+                return False
+
+            # ## at most 2 chunks per worker are pending, so the tasks are generated as the workers go
+            dct_future2chunk = {}
+            for _ in range(workers * 2):
+                if not submit_next():
+                    break
+            with tqdm(total=num_scenes) as pbar:
+                while len(dct_future2chunk) > 0:
+                    set_done, _ = wait(dct_future2chunk, return_when=FIRST_COMPLETED)
+                    for future in set_done:
+                        pid, num_merged, busy_time = future.result()
+                        dct_worker_stat[pid][0] += num_merged
+                        dct_worker_stat[pid][1] += busy_time
+                        num_merged_total += num_merged
+                        pbar.update(num_merged)
+                        if manifest is not None:
+                            for scene_id, _, _, input_hash in dct_future2chunk[future]:
+                                manifest.update(scene_id, input_hash)
+                        del dct_future2chunk[future]
+                        submit_next()
+        wall_time = time.time() - t_start
+        num_scenes = num_merged_total
+
+        print(
+            f"Merged {num_scenes} scenes with {workers} workers in {wall_time:.2f}s "
+            f"({num_scenes / max(wall_time, 1e-9):.1f} scenes/s)"
+        )
+        for pid, (num_merged, busy_time) in sorted(dct_worker_stat.items()):
+            print(
+                f"  worker {pid}: {num_merged} scenes in {busy_time:.2f}s "
+                f"({num_merged / max(busy_time, 1e-9):.1f} scenes/s)"
             )
 
-            # ## Save results to YAML files
-            with open(
-                os.path.join(self.save_dir, f"{source_img_name_no_ext}.yaml"), "w"
-            ) as f:
-                yaml.dump(merged_ir, f)
+    def version(self):
+        """
+        The version of the merged IRs for the incremental mode, changing with the code and the output options
+        """
+        return code_version(
+            [
+                os.path.abspath(__file__),
+                sys.modules[LaneActorIndex.__module__].__file__,
+                # ## the loading and the serialization of the IRs, and the pairing of the scenes
+                sys.modules[load_ir.__module__].__file__,
+                sys.modules[open_ir_writer.__module__].__file__,
+                sys.modules[SceneIndex.__module__].__file__,
+            ],
+            {"ir_format": self.ir_format, "ir_layout": self.ir_layout},
+        )
+
+
+def _merge_chunk(runner, shard_name, ls_tasks):
+    """
+    Merge a chunk of scenes in a worker process
+    return: (pid, the number of merged scenes, the time spent on the chunk)
+    """
+    t_start = time.time()
+    with runner.open_writer(shard_name) as writer:
+        for task in ls_tasks:
+            runner.merge_and_write(writer, *task)
+    return os.getpid(), len(ls_tasks), time.time() - t_start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Align the textual IR and the visual IR to the merged IR"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="the number of worker processes for the merge stage",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        help="the number of scenes submitted to a worker process at a time",
+    )
+    parser.add_argument(
+        "--ir_format",
+        type=str,
+        default="yaml",
+        choices=IR_FORMATS,
+        help="the format of the saved merged IRs",
+    )
+    parser.add_argument(
+        "--ir_layout",
+        type=str,
+        default="files",
+        choices=IR_LAYOUTS,
+        help="save one merged IR file per scene, or pack them into shards",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only merge the scenes whose textual or visual IR changed since the last run",
+    )
+    args = parser.parse_args()
 
-            # # ## Save results to JSON files
-            # with open(os.path.join(self.save_dir, f"{source_img_name}.json"), "w") as f:
-            #     json.dump(merged_ir, f)
+    return args
 
 
 if __name__ == "__main__":
+    args = parse_args()
     runner = TrafficComposer(
         source_image_dir=SOURCE_IMAGE_DIR,
         textual_ir_dir=TEXTUAL_IR_LOAD_DIR,
         visual_ir_dir=VISUAL_IR_LOAD_DIR,
         save_dir=MERGED_IR_SAVE_DIR,
+        ir_format=args.ir_format,
+        ir_layout=args.ir_layout,
+        incremental=args.incremental,
     )
-    runner.main()
+    runner.main(workers=args.workers, chunk_size=args.chunk_size)